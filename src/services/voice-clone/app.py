@@ -27,6 +27,8 @@ engine = None
 # Default model configuration
 DEFAULT_MODEL_PATH = "bosonai/higgs-audio-v2-generation-3B-base"
 DEFAULT_AUDIO_TOKENIZER_PATH = "bosonai/higgs-audio-v2-tokenizer"
+# Voice library built from voice_examples with `python -m higgs_audio.serve.voice_library`, if any
+DEFAULT_VOICE_LIBRARY_PATH = None
 SAMPLE_RATE = 24000
 
 DEFAULT_SYSTEM_PROMPT = (
@@ -200,13 +202,14 @@ def normalize_text(transcript: str):
 
 
 @spaces.GPU
-def initialize_engine(model_path, audio_tokenizer_path) -> bool:
+def initialize_engine(model_path, audio_tokenizer_path, voice_library_path=None) -> bool:
     """
     Initialize the HiggsAudioServeEngine with the specified model and tokenizer.
     
     Args:
         model_path: Path to the model to load
         audio_tokenizer_path: Path to the audio tokenizer to load
+        voice_library_path: Path to the voice library of the voice presets, if any
         
     Returns:
         True if initialization was successful, False otherwise
@@ -218,6 +221,7 @@ def initialize_engine(model_path, audio_tokenizer_path) -> bool:
             model_name_or_path=model_path,
             audio_tokenizer_name_or_path=audio_tokenizer_path,
             device=get_current_device(),
+            voice_library_path=voice_library_path,
         )
         logger.info(f"Successfully initialized HiggsAudioServeEngine with model: {model_path}")
         return True
@@ -260,6 +264,9 @@ def prepare_chatml_sample(
         # Custom reference audio
         audio_base64 = encode_audio_file(reference_audio)
         ref_text = reference_text or ""
+    elif engine is not None and engine.voice_library is not None and voice_preset in engine.voice_library:
+        # Voice preset of the voice library, whose codes and transcript tokens are precomputed
+        messages.extend(engine.voice_library.reference_messages(voice_preset))
     elif voice_preset != "EMPTY":
         # Voice preset
         voice_path, ref_text = get_voice_preset(voice_preset)
@@ -322,7 +329,7 @@ def text_to_speech(
     global engine
 
     if engine is None:
-        initialize_engine(DEFAULT_MODEL_PATH, DEFAULT_AUDIO_TOKENIZER_PATH)
+        initialize_engine(DEFAULT_MODEL_PATH, DEFAULT_AUDIO_TOKENIZER_PATH, DEFAULT_VOICE_LIBRARY_PATH)
 
     try:
         # Prepare ChatML sample
@@ -658,7 +665,7 @@ def create_ui():
 
 def main():
     """Main function to parse arguments and launch the UI."""
-    global DEFAULT_MODEL_PATH, DEFAULT_AUDIO_TOKENIZER_PATH, VOICE_PRESETS
+    global DEFAULT_MODEL_PATH, DEFAULT_AUDIO_TOKENIZER_PATH, DEFAULT_VOICE_LIBRARY_PATH, VOICE_PRESETS
 
     parser = argparse.ArgumentParser(description="Gradio UI for Text-to-Speech using HiggsAudioServeEngine")
     parser.add_argument(
@@ -670,10 +677,17 @@ def main():
     )
     parser.add_argument("--host", type=str, default="0.0.0.0", help="Host for the Gradio interface.")
     parser.add_argument("--port", type=int, default=7860, help="Port for the Gradio interface.")
+    parser.add_argument(
+        "--voice-library",
+        type=str,
+        default=None,
+        help="Voice library of the voice presets, built with `python -m higgs_audio.serve.voice_library`.",
+    )
 
     args = parser.parse_args()
 
     # Update default values if provided via command line
+    DEFAULT_VOICE_LIBRARY_PATH = args.voice_library
     VOICE_PRESETS = load_voice_presets()
 
     # Create and launch the UI
@@ -0,0 +1,76 @@
+"""
+Benchmark of the audio tokenizer decode, with and without `HiggsAudioTokenizer.prepare_for_inference`.
+
+Builds a decode-only tokenizer with random weights (or loads one with `--audio-tokenizer`), and decodes random codes
+with the weight-normalized convolutions, with the weight norm folded, and with the folded decoder compiled by each
+backend. Reports the real-time factor (decode time / audio duration) of every variant. The parity of the variants is
+checked by `tests/test_codec_inference.py`.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.codec_decode --seconds 10 --backends torchscript compile
+"""
+
+import argparse
+import time
+import torch
+from copy import deepcopy
+
+from higgs_audio.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer, load_higgs_audio_tokenizer
+
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def _time_decode(tokenizer: HiggsAudioTokenizer, codes: torch.LongTensor, device: str, repeats: int) -> float:
+    """Return the best time, in seconds, to decode the codes."""
+    best = float("inf")
+    for _ in range(repeats):
+        _synchronize(device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            tokenizer.decode(codes)
+        _synchronize(device)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the audio tokenizer decode")
+    parser.add_argument("--audio-tokenizer", type=str, default=None, help="Defaults to random weights.")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration of the decoded audio.")
+    parser.add_argument("--backends", type=str, nargs="*", default=["torchscript"], choices=["torchscript", "compile"])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    if args.audio_tokenizer is not None:
+        tokenizer = load_higgs_audio_tokenizer(args.audio_tokenizer, device=args.device, decode_only=True)
+    else:
+        tokenizer = HiggsAudioTokenizer(decode_only=True, device=args.device).to(args.device).eval()
+
+    num_frames = int(args.seconds * tokenizer.tps)
+    codes = torch.randint(0, tokenizer.codebook_size, (1, tokenizer.num_codebooks, num_frames), device=args.device)
+    # Computes the weight-normalized weights without autograd, so that the tokenizer can be copied
+    with torch.no_grad():
+        tokenizer.decode(codes)
+
+    variants = {"weight norm": tokenizer}
+    for backend in [None] + args.backends:
+        variants[f"folded, {backend or 'eager'}"] = deepcopy(tokenizer).prepare_for_inference(backend)
+
+    print(f"decoding {args.seconds:.1f} s of audio ({num_frames} frames), device {args.device}")
+    for name, variant in variants.items():
+        # Warm up, e.g., the compilation
+        _time_decode(variant, codes, args.device, 2)
+        seconds = _time_decode(variant, codes, args.device, args.repeats)
+        print(f"{name:24s} {seconds * 1000:9.1f} ms   RTF {seconds / args.seconds:.4f}")
+
+
+if __name__ == "__main__":
+    main()
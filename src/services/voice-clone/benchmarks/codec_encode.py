@@ -0,0 +1,70 @@
+"""
+Benchmark of the windowed encode of the audio tokenizer, for long reference clips.
+
+Builds an encode-only tokenizer with random weights (or loads one with `--audio-tokenizer`), and encodes random audio
+at once (`win_duration=None`) and by windows of every `--win-durations`. The semantic teacher is downloaded either
+way. Every windowed encode is first checked against the encode at once, which must emit the same codes. Reports the
+time and, on CUDA, the peak memory of every way.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.codec_encode --seconds 180 --win-durations 10 30
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+
+from higgs_audio.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer, load_higgs_audio_tokenizer
+
+
+def _encode(tokenizer: HiggsAudioTokenizer, wv: np.ndarray, win_duration, device: str):
+    """Return the codes, the time in seconds and the peak memory in MiB (`None` on CPU) of an encode."""
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    codes = tokenizer.encode(wv, tokenizer.sampling_rate, win_duration=win_duration)
+    peak_memory = None
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 2**20
+    return codes, time.perf_counter() - start, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the windowed encode of the audio tokenizer")
+    parser.add_argument("--audio-tokenizer", type=str, default=None, help="Defaults to random weights.")
+    parser.add_argument("--seconds", type=float, default=120.0, help="Duration of the encoded audio.")
+    parser.add_argument("--win-durations", type=float, nargs="*", default=[10.0, 30.0])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    if args.audio_tokenizer is not None:
+        tokenizer = load_higgs_audio_tokenizer(args.audio_tokenizer, device=args.device, encode_only=True)
+    else:
+        tokenizer = HiggsAudioTokenizer(encode_only=True, device=args.device).to(args.device)
+    tokenizer.prepare_for_inference()
+
+    wv = np.random.default_rng(0).uniform(-0.5, 0.5, int(args.seconds * tokenizer.sampling_rate)).astype(np.float32)
+    print(f"encoding {args.seconds:.1f} s of audio, device {args.device}")
+    reference, seconds, peak_memory = _encode(tokenizer, wv, None, args.device)
+    results = {"at once": (seconds, peak_memory)}
+    for win_duration in args.win_durations:
+        codes, seconds, peak_memory = _encode(tokenizer, wv, win_duration, args.device)
+        num_mismatches = (codes != reference).sum().item() if codes.shape == reference.shape else codes.numel()
+        print(f"windows of {win_duration:.1f} s: {num_mismatches} codes differ out of {reference.numel()}")
+        assert num_mismatches == 0
+        results[f"windows of {win_duration:.1f} s"] = (seconds, peak_memory)
+
+    for name, (seconds, peak_memory) in results.items():
+        memory = f"{peak_memory:9.1f} MiB" if peak_memory is not None else "n/a"
+        print(f"{name:18s} {seconds * 1000:9.1f} ms   peak memory {memory}")
+
+
+if __name__ == "__main__":
+    main()
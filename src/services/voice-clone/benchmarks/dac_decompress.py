@@ -0,0 +1,64 @@
+"""
+Benchmark of the batched chunk decode of `CodecMixin.decompress`.
+
+Builds a DAC model with random weights, compresses random audio by chunks of `--win-duration` seconds, and decompresses
+it with one chunk per forward pass and with every `--batch-sizes`. Every batched decompress is first checked against
+the one-chunk decompress. Reports the time and the real-time factor (decode time / audio duration) of every batch size.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.dac_decompress --seconds 60 --batch-sizes 4 16
+"""
+
+import argparse
+import time
+import torch
+from audiotools import AudioSignal
+
+from higgs_audio.audio_processing.descriptaudiocodec.dac.model import dac as dac2
+
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched chunk decode of DAC decompress")
+    parser.add_argument("--seconds", type=float, default=30.0, help="Duration of the decompressed audio.")
+    parser.add_argument("--win-duration", type=float, default=1.0, help="Duration of every chunk.")
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[4, 16])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    model = dac2.DAC(sample_rate=16000).to(args.device).eval()
+    signal = AudioSignal(torch.randn(1, 1, int(args.seconds * model.sample_rate)) * 0.1, model.sample_rate)
+    dac_file = model.compress(signal, win_duration=args.win_duration)
+    num_chunks = dac_file.codes.shape[-1] // dac_file.chunk_length
+    print(f"decompressing {args.seconds:.1f} s of audio ({num_chunks} chunks), device {args.device}")
+
+    reference = None
+    for batch_size in [1] + args.batch_sizes:
+        # Warm up
+        model.decompress(dac_file, batch_size=batch_size)
+        _synchronize(args.device)
+        start = time.perf_counter()
+        recons = model.decompress(dac_file, batch_size=batch_size).audio_data
+        _synchronize(args.device)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = recons
+        error = (recons - reference).abs().max().item()
+        assert recons.shape == reference.shape and error <= args.atol, f"batch size {batch_size}: error {error:.2e}"
+        print(
+            f"batch size {batch_size:3d} {seconds * 1000:9.1f} ms   RTF {seconds / args.seconds:.4f}"
+            f"   max abs error {error:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Micro-benchmark of the per-step overhead of the decoding loop of HiggsAudioModel.
+
+Generates audio tokens with a tiny random-weight model, so the decoder layers are cheap and the work done around them
+by `HiggsAudioModel._sample` (mode tracking, sampling, bookkeeping of the generated tokens and masks) shows up. The
+time spent in the decoder layers (`_forward_core`) is measured separately, the rest of each step is the overhead.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.decode_loop --num-steps 500
+"""
+
+import argparse
+import time
+import torch
+from copy import deepcopy
+
+from higgs_audio.model import HiggsAudioConfig, HiggsAudioModel
+from higgs_audio.model.static_kv_cache import LazyResetStaticCache
+
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-step overhead of the decoding loop")
+    parser.add_argument("--num-steps", type=int, default=500, help="Audio tokens generated per run.")
+    parser.add_argument("--prompt-len", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-codebooks", type=int, default=8)
+    parser.add_argument("--codebook-size", type=int, default=1024)
+    parser.add_argument("--kv-cache-lengths", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = HiggsAudioConfig(
+        text_config=dict(
+            model_type="llama",
+            vocab_size=128300,
+            hidden_size=args.hidden_size,
+            intermediate_size=2 * args.hidden_size,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+        ),
+        audio_adapter_type="dual_ffn_fast_forward",
+        audio_dual_ffn_layers=list(range(0, args.num_layers, 2)),
+        skip_audio_tower=True,
+        encode_whisper_embed=False,
+        use_delay_pattern=True,
+        audio_num_codebooks=args.num_codebooks,
+        audio_codebook_size=args.codebook_size,
+        audio_stream_bos_id=args.codebook_size,
+        audio_stream_eos_id=args.codebook_size + 1,
+    )
+    config._attn_implementation = "sdpa"
+    config.text_config._attn_implementation = "sdpa"
+    model = HiggsAudioModel(config).eval().to(args.device)
+
+    cache_config = deepcopy(config.text_config)
+    cache_config.num_hidden_layers += len(config.audio_dual_ffn_layers)
+    kv_caches = {
+        length: LazyResetStaticCache(
+            config=cache_config, max_batch_size=1, max_cache_len=length, device=args.device, dtype=model.dtype
+        )
+        for length in sorted(args.kv_cache_lengths)
+    }
+
+    # A text prompt that asks for audio right away
+    input_ids = torch.randint(100, 1000, (1, args.prompt_len), device=args.device)
+    input_ids[0, -1] = config.audio_out_bos_token_id
+
+    # Time the decoder layers, everything else in a step is the overhead of the loop
+    forward_core = model._forward_core
+    layer_time = [0.0]
+
+    def timed_forward_core(*fn_args, **fn_kwargs):
+        _synchronize(args.device)
+        start = time.perf_counter()
+        outputs = forward_core(*fn_args, **fn_kwargs)
+        _synchronize(args.device)
+        layer_time[0] += time.perf_counter() - start
+        return outputs
+
+    model._forward_core = timed_forward_core
+
+    def run():
+        for kv_cache in kv_caches.values():
+            kv_cache.reset()
+        return model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=args.num_steps,
+            use_cache=True,
+            do_sample=True,
+            top_k=50,
+            # Keep generating audio for the whole run
+            suppress_tokens=[config.audio_stream_eos_id],
+            past_key_values_buckets=kv_caches,
+            seed=0,
+        )
+
+    run()
+    step_ms, layer_ms = [], []
+    for _ in range(args.repeats):
+        layer_time[0] = 0.0
+        _synchronize(args.device)
+        start = time.perf_counter()
+        _, audio_sequences = run()
+        _synchronize(args.device)
+        num_steps = sum(audio_sequence.shape[1] for audio_sequence in audio_sequences)
+        step_ms.append((time.perf_counter() - start) / num_steps * 1000)
+        layer_ms.append(layer_time[0] / num_steps * 1000)
+
+    step, layer = min(step_ms), min(layer_ms)
+    print(f"{num_steps} audio steps, device {args.device}, buckets {sorted(args.kv_cache_lengths)}")
+    print(f"per step:        {step:8.3f} ms")
+    print(f"decoder layers:  {layer:8.3f} ms")
+    print(f"loop overhead:   {step - layer:8.3f} ms ({(step - layer) / step:.0%} of the step)")
+
+
+if __name__ == "__main__":
+    main()
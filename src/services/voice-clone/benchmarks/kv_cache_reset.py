@@ -0,0 +1,88 @@
+"""
+Micro-benchmark of the KV cache reset done by HiggsAudioServeEngine before every request.
+
+Compares the full reset of `StaticCache` with the reset of `LazyResetStaticCache`, which only clears the positions
+written by the previous request, for the default KV cache buckets of the engine.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.kv_cache_reset --num-written 600
+"""
+
+import argparse
+import time
+import torch
+from transformers import LlamaConfig
+from transformers.cache_utils import StaticCache
+
+from higgs_audio.model.static_kv_cache import LazyResetStaticCache
+
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def _time_resets(buckets, reset_fn, write_fn, device: str, repeats: int) -> float:
+    """Return the mean time, in milliseconds, to reset all the buckets after a request."""
+    total = 0.0
+    for _ in range(repeats):
+        for kv_cache in buckets:
+            write_fn(kv_cache)
+        _synchronize(device)
+        start = time.perf_counter()
+        for kv_cache in buckets:
+            reset_fn(kv_cache)
+        _synchronize(device)
+        total += time.perf_counter() - start
+    return total / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-request reset of the KV cache buckets")
+    parser.add_argument("--num-layers", type=int, default=28, help="Cached layers, including the dual-FFN ones.")
+    parser.add_argument("--num-key-value-heads", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--kv-cache-lengths", type=int, nargs="+", default=[1024, 4096, 8192])
+    parser.add_argument("--num-written", type=int, default=600, help="Positions written by the previous request.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    config = LlamaConfig(
+        hidden_size=args.num_key_value_heads * args.head_dim,
+        num_attention_heads=args.num_key_value_heads,
+        num_key_value_heads=args.num_key_value_heads,
+        num_hidden_layers=args.num_layers,
+    )
+    lengths = sorted(args.kv_cache_lengths)
+    last_length = next((length for length in lengths if length >= args.num_written), lengths[-1])
+
+    buckets = [
+        LazyResetStaticCache(config=config, max_batch_size=1, max_cache_len=length, device=args.device, dtype=dtype)
+        for length in lengths
+    ]
+
+    def write(kv_cache: LazyResetStaticCache):
+        # A request fills the smaller buckets before it is promoted, and never reaches the larger ones
+        if kv_cache.max_cache_len > last_length:
+            return
+        num_written = min(args.num_written, kv_cache.max_cache_len)
+        for key, value in zip(kv_cache.key_cache, kv_cache.value_cache):
+            key[:, :, :num_written] = 1
+            value[:, :, :num_written] = 1
+        kv_cache.mark_written(num_written)
+
+    full_ms = _time_resets(buckets, StaticCache.reset, write, args.device, args.repeats)
+    lazy_ms = _time_resets(buckets, LazyResetStaticCache.reset, write, args.device, args.repeats)
+    total_bytes = sum(
+        t.numel() * t.element_size() for kv_cache in buckets for t in kv_cache.key_cache + kv_cache.value_cache
+    )
+    print(f"buckets: {args.kv_cache_lengths}, {total_bytes / 2**30:.2f} GiB, {args.num_written} positions written")
+    print(f"StaticCache.reset:          {full_ms:8.3f} ms per request")
+    print(f"LazyResetStaticCache.reset: {lazy_ms:8.3f} ms per request ({full_ms / max(lazy_ms, 1e-9):.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
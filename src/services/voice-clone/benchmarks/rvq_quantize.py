@@ -0,0 +1,86 @@
+"""
+Benchmark of the nearest-neighbour search of the residual vector quantizer, `EuclideanCodebook.quantize`.
+
+Builds the residual vector quantizer of the audio tokenizer with random codebooks, and encodes random latents with the
+blocked search, for several `quantize_block_size`s, and with the whole distance matrix at once, as before. Every
+blocked encode is first checked to return the same indices. Reports the time and, on CUDA, the peak memory of each.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.rvq_quantize --seconds 300 --block-sizes 256 1024 4096
+"""
+
+import argparse
+import time
+import torch
+
+from higgs_audio.audio_processing.quantization.core_vq_lsx_version import EuclideanCodebook
+from higgs_audio.audio_processing.quantization.vq import ResidualVectorQuantizer
+
+
+def _reference_quantize(self, x):
+    embed = self.embed.t()
+    dist = -(x.pow(2).sum(1, keepdim=True) - 2 * x @ embed + embed.pow(2).sum(0, keepdim=True))
+    return dist.max(dim=-1).indices
+
+
+def _encode(quantizer: ResidualVectorQuantizer, latents: torch.Tensor, frame_rate: int, device: str):
+    """Return the indices, the time in seconds and the peak memory in MiB (`None` on CPU) of an encode."""
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.no_grad():
+        indices = quantizer.encode(latents, frame_rate)
+    peak_memory = None
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 2**20
+    return indices, time.perf_counter() - start, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the nearest-neighbour search of the RVQ")
+    parser.add_argument("--seconds", type=float, default=120.0, help="Duration of the encoded latents.")
+    parser.add_argument("--frame-rate", type=int, default=25)
+    parser.add_argument("--dim", type=int, default=896, help="The quantizer dimension, D + semantic dimension.")
+    parser.add_argument("--n-q", type=int, default=8)
+    parser.add_argument("--bins", type=int, default=1024)
+    parser.add_argument("--block-sizes", type=int, nargs="*", default=[256, 1024, 4096])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    # Random codebooks, instead of the zeros that k-means initialization starts from
+    quantizer = ResidualVectorQuantizer(dimension=args.dim, n_q=args.n_q, bins=args.bins, kmeans_init=False)
+    quantizer = quantizer.to(args.device).eval()
+    num_frames = int(args.seconds * args.frame_rate)
+    latents = torch.randn(1, args.dim, num_frames, device=args.device)
+    print(f"encoding {num_frames} frames with {args.n_q} codebooks of {args.bins} codes, device {args.device}")
+
+    blocked_quantize = EuclideanCodebook.quantize
+    EuclideanCodebook.quantize = _reference_quantize
+    try:
+        _encode(quantizer, latents, args.frame_rate, args.device)
+        reference, seconds, peak_memory = _encode(quantizer, latents, args.frame_rate, args.device)
+    finally:
+        EuclideanCodebook.quantize = blocked_quantize
+    results = {"whole matrix": (seconds, peak_memory)}
+
+    for block_size in args.block_sizes:
+        EuclideanCodebook.quantize_block_size = block_size
+        _encode(quantizer, latents, args.frame_rate, args.device)
+        indices, seconds, peak_memory = _encode(quantizer, latents, args.frame_rate, args.device)
+        num_mismatches = (indices != reference).sum().item()
+        assert num_mismatches == 0, f"blocks of {block_size}: {num_mismatches} indices differ"
+        results[f"blocks of {block_size}"] = (seconds, peak_memory)
+
+    for name, (seconds, peak_memory) in results.items():
+        memory = f"{peak_memory:9.1f} MiB" if peak_memory is not None else "n/a"
+        print(f"{name:16s} {seconds * 1000:9.1f} ms   peak memory {memory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the streaming decode of the audio tokenizer, with `HiggsAudioStreamingDecoder`.
+
+Builds a decode-only tokenizer with random weights (or loads one with `--audio-tokenizer`), and decodes random codes
+block by block, as they arrive during generation, in three ways:
+    - stateful: `HiggsAudioStreamingDecoder`, which carries the state of the decoder between blocks.
+    - windows: every block decoded on its own, with the overlap of `HiggsAudioStreamDecoder` with `stateful=False`.
+    - growing: all the codes so far decoded again at every block, keeping the new samples.
+Reports the total time and the real-time factor (decode time / audio duration) of every way. The equivalence of the
+stateful and the offline decode is checked by `tests/test_streaming_decoder.py`.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.streaming_decode --seconds 20 --chunk-size 16
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+
+from higgs_audio.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer, load_higgs_audio_tokenizer
+
+
+def _synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def _stream_stateful(tokenizer: HiggsAudioTokenizer, codes: torch.LongTensor, chunk_size: int) -> np.ndarray:
+    decoder = tokenizer.streaming_decoder()
+    chunks = [decoder.push(codes[:, i : i + chunk_size]) for i in range(0, codes.shape[-1], chunk_size)]
+    chunks.append(decoder.flush())
+    return np.concatenate(chunks)
+
+
+def _stream_windows(
+    tokenizer: HiggsAudioTokenizer, codes: torch.LongTensor, chunk_size: int, overlap: int
+) -> np.ndarray:
+    chunks = []
+    for i in range(0, codes.shape[-1], chunk_size):
+        start = max(0, i - overlap)
+        chunks.append(tokenizer.decode(codes[None, :, start : i + chunk_size])[0, 0])
+    return np.concatenate(chunks)
+
+
+def _stream_growing(tokenizer: HiggsAudioTokenizer, codes: torch.LongTensor, chunk_size: int) -> np.ndarray:
+    chunks, num_samples = [], 0
+    for i in range(0, codes.shape[-1], chunk_size):
+        wv = tokenizer.decode(codes[None, :, : i + chunk_size])[0, 0]
+        chunks.append(wv[num_samples:])
+        num_samples = wv.shape[-1]
+    return np.concatenate(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming decode of the audio tokenizer")
+    parser.add_argument("--audio-tokenizer", type=str, default=None, help="Defaults to random weights.")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration of the decoded audio.")
+    parser.add_argument("--chunk-size", type=int, default=16, help="The number of frames of every block.")
+    parser.add_argument("--overlap", type=int, default=4, help="The number of frames decoded again by windows.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    if args.audio_tokenizer is not None:
+        tokenizer = load_higgs_audio_tokenizer(args.audio_tokenizer, device=args.device, decode_only=True)
+    else:
+        tokenizer = HiggsAudioTokenizer(decode_only=True, device=args.device).to(args.device)
+    tokenizer.prepare_for_inference()
+
+    num_frames = int(args.seconds * tokenizer.tps)
+    codes = torch.randint(0, tokenizer.codebook_size, (tokenizer.num_codebooks, num_frames), device=args.device)
+
+    print(f"decoding {args.seconds:.1f} s of audio ({num_frames} frames) by blocks of {args.chunk_size} frames")
+    ways = {
+        "stateful": lambda: _stream_stateful(tokenizer, codes, args.chunk_size),
+        "windows": lambda: _stream_windows(tokenizer, codes, args.chunk_size, args.overlap),
+        "growing": lambda: _stream_growing(tokenizer, codes, args.chunk_size),
+    }
+    for name, decode in ways.items():
+        with torch.no_grad():
+            decode()
+            _synchronize(args.device)
+            start = time.perf_counter()
+            decode()
+            _synchronize(args.device)
+        seconds = time.perf_counter() - start
+        print(f"{name:10s} {seconds * 1000:9.1f} ms   RTF {seconds / args.seconds:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the rANS entropy coder of the audio codes, `RansCoder`.
+
+Fits the frequency tables of every codebook on an archive of `AudioCodeFile`s (`--archive`, e.g., the files written by
+`HiggsAudioServeEngine.save_audio_codes`), or on random Zipf-distributed codes, and encodes held-out codes. Every
+encode is first checked to decode back to the codes. Reports the bits per code, against the 10-bit lanes of
+`AudioCodeFile` and `int64`, and the encode and decode throughput.
+
+Usage (from src/services/voice-clone):
+    python -m benchmarks.token_entropy --archive archive/ --save-tables rans_tables.npz
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+
+from higgs_audio.audio_processing.audio_code_file import AudioCodeFile, is_audio_code_file
+from higgs_audio.audio_processing.quantization.rans import RansCoder
+
+
+def _read_archive(path: str):
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            if is_audio_code_file(file_path):
+                with AudioCodeFile(file_path) as code_file:
+                    yield code_file.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rANS entropy coder of the audio codes")
+    parser.add_argument("--archive", type=str, default=None, help="Defaults to random Zipf-distributed codes.")
+    parser.add_argument("--num-codebooks", type=int, default=8)
+    parser.add_argument("--alphabet-size", type=int, default=1024)
+    parser.add_argument("--scale-bits", type=int, default=15)
+    parser.add_argument("--lanes-per-codebook", type=int, default=None)
+    parser.add_argument("--held-out", type=float, default=0.1, help="The fraction of the archive to encode.")
+    parser.add_argument("--save-tables", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.archive is not None:
+        arrays = list(_read_archive(args.archive))
+        if len(arrays) == 0:
+            raise ValueError(f"No audio code files in {args.archive}.")
+    else:
+        rng = np.random.default_rng(0)
+        p = 1.0 / np.arange(1, args.alphabet_size + 1) ** 1.1
+        arrays = [rng.choice(args.alphabet_size, size=(args.num_codebooks, 1500), p=p / p.sum()) for _ in range(40)]
+    num_held_out = max(1, int(len(arrays) * args.held_out))
+    train, test = arrays[:-num_held_out] or arrays, arrays[-num_held_out:]
+
+    coder = RansCoder.fit(train, args.num_codebooks, args.alphabet_size, scale_bits=args.scale_bits)
+    if args.save_tables is not None:
+        coder.save(args.save_tables)
+    print(f"fitted on {sum(a.shape[1] for a in train)} frames, table entropy {coder.entropy().mean():.3f} bits/code")
+
+    num_codes, num_bytes, encode_seconds, decode_seconds = 0, 0, 0.0, 0.0
+    for codes in test:
+        start = time.perf_counter()
+        data = coder.encode(codes, lanes_per_codebook=args.lanes_per_codebook)
+        encode_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = coder.decode(data)
+        decode_seconds += time.perf_counter() - start
+        assert decoded.shape == codes.shape and (decoded == codes).all()
+        num_codes += codes.size
+        num_bytes += len(data)
+
+    bits_per_code = num_bytes * 8 / num_codes
+    print(f"encoded {num_codes} codes: {bits_per_code:.3f} bits/code")
+    print(f"  {10 / bits_per_code:.2f}x smaller than 10-bit lanes, {64 / bits_per_code:.2f}x smaller than int64")
+    print(
+        f"  encode {num_codes / encode_seconds / 1e6:.2f} M codes/s, "
+        f"decode {num_codes / decode_seconds / 1e6:.2f} M codes/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
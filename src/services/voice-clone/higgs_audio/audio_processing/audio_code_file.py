@@ -0,0 +1,222 @@
+"""Random-access, memory-mapped file format for the codes of an audio codec."""
+
+import json
+import math
+import numpy as np
+import os
+import struct
+from typing import Any, Dict, Optional
+
+
+class AudioCodeFile:
+    """A file of codec codes of shape `(num_codebooks, num_frames)`, read through a memory map.
+
+    The file starts with a fixed header: the magic `HACF`, the format version, the number of bits of every code (10 or
+    16), the number of codebooks, the flags (bit 0: the codes follow the delay pattern), the sample rate, the frame
+    rate (`tps`), the number of frames of a chunk, the number of frames and the length of a JSON metadata blob, which
+    follows the header. The codes follow the metadata, aligned to 64 bytes, by chunks of `chunk_frames` frames. Every
+    chunk holds one lane per codebook, and every lane the codes of its frames, either as `uint16` or packed by 4 into
+    5 bytes. All the chunks have the same size, the last one being padded, so the chunk of any frame is found without
+    an index, and a slice only reads the chunks it covers.
+
+    The codes of `HiggsAudioTokenizer` and DAC fit in 10 bits, 6.4x smaller than `int64`. The generated audio tokens,
+    which include the audio stream bos and eos tokens, need 16.
+
+    Args:
+        path (`str`):
+            The file to read.
+    """
+
+    MAGIC = b"HACF"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHHHIdIQI")
+    ALIGNMENT = 64
+    DELAY_PATTERN_FLAG = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size or header[:4] != self.MAGIC:
+                raise ValueError(f"{path} is not an audio code file.")
+            (
+                _,
+                version,
+                self.bits,
+                self.num_codebooks,
+                flags,
+                self.sample_rate,
+                self.tps,
+                self.chunk_frames,
+                self.num_frames,
+                metadata_length,
+            ) = self.HEADER.unpack(header)
+            if version != self.VERSION:
+                raise ValueError(f"{path} has version {version} of the audio code file format, not {self.VERSION}.")
+            self.metadata: Dict[str, Any] = json.loads(f.read(metadata_length)) if metadata_length > 0 else {}
+        self.delay_pattern = bool(flags & self.DELAY_PATTERN_FLAG)
+        self._data_offset = _align(self.HEADER.size + metadata_length, self.ALIGNMENT)
+        self._lane_bytes = _lane_bytes(self.chunk_frames, self.bits)
+        num_chunks = math.ceil(self.num_frames / self.chunk_frames)
+        self._data: Optional[np.memmap] = None
+        if num_chunks > 0:
+            self._data = np.memmap(
+                path,
+                dtype=np.uint8,
+                mode="r",
+                offset=self._data_offset,
+                shape=(num_chunks, self.num_codebooks, self._lane_bytes),
+            )
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        codes: np.ndarray,
+        sample_rate: int,
+        tps: float,
+        delay_pattern: bool = False,
+        bits: Optional[int] = None,
+        chunk_frames: int = 256,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> "AudioCodeFile":
+        """Write the codes of shape `(num_codebooks, num_frames)` to `path`, and open the file.
+
+        Args:
+            path (`str`):
+                The file to write. It is written to a temporary file first, and renamed.
+            codes (`np.ndarray`):
+                The codes, non-negative integers.
+            sample_rate (`int`):
+                The sample rate of the audio the codes decode to.
+            tps (`float`):
+                The number of frames per second.
+            delay_pattern (`bool`, *optional*, defaults to `False`):
+                Whether the codes follow the delay pattern.
+            bits (`int`, *optional*):
+                10 or 16. Defaults to 10 if all the codes fit in 10 bits, else 16.
+            chunk_frames (`int`, *optional*, defaults to 256):
+                The number of frames of a chunk, a multiple of 4.
+            metadata (`dict`, *optional*):
+                JSON-serializable metadata stored in the header.
+        """
+        codes = np.asarray(codes)
+        if codes.ndim != 2:
+            raise ValueError(f"Expected codes of shape (num_codebooks, num_frames), got {codes.shape}.")
+        if chunk_frames <= 0 or chunk_frames % 4 != 0:
+            raise ValueError(f"`chunk_frames` must be a positive multiple of 4, got {chunk_frames}.")
+        max_code = int(codes.max()) if codes.size > 0 else 0
+        if codes.size > 0 and codes.min() < 0:
+            raise ValueError("The codes must be non-negative.")
+        if bits is None:
+            bits = 10 if max_code < 2**10 else 16
+        if bits not in (10, 16):
+            raise ValueError(f"`bits` must be 10 or 16, got {bits}.")
+        if max_code >= 2**bits:
+            raise ValueError(f"The codes do not fit in {bits} bits.")
+
+        num_codebooks, num_frames = codes.shape
+        num_chunks = math.ceil(num_frames / chunk_frames)
+        # (num_codebooks, num_chunks * chunk_frames) -> (num_chunks, num_codebooks, chunk_frames)
+        padded = np.zeros((num_codebooks, num_chunks * chunk_frames), dtype=np.uint16)
+        padded[:, :num_frames] = codes
+        lanes = padded.reshape(num_codebooks, num_chunks, chunk_frames).transpose(1, 0, 2)
+        data = _pack(lanes, bits)
+
+        metadata_bytes = json.dumps(metadata).encode("utf-8") if metadata else b""
+        flags = cls.DELAY_PATTERN_FLAG if delay_pattern else 0
+        header = cls.HEADER.pack(
+            cls.MAGIC,
+            cls.VERSION,
+            bits,
+            num_codebooks,
+            flags,
+            sample_rate,
+            tps,
+            chunk_frames,
+            num_frames,
+            len(metadata_bytes),
+        )
+        prefix = header + metadata_bytes
+        prefix += b"\0" * (_align(len(prefix), cls.ALIGNMENT) - len(prefix))
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(prefix)
+            f.write(np.ascontiguousarray(data).tobytes())
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    @property
+    def duration(self) -> float:
+        """The duration of the codes, in seconds."""
+        return self.num_frames / self.tps
+
+    def frame_at(self, seconds: float) -> int:
+        """The frame that contains the time offset `seconds`."""
+        return min(max(0, int(seconds * self.tps)), self.num_frames)
+
+    def read(self, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """The codes of the frames `[start, end)`, of shape `(num_codebooks, end - start)`, as `int64`.
+
+        Only the chunks that hold these frames are read.
+        """
+        end = self.num_frames if end is None else min(end, self.num_frames)
+        start = max(0, start)
+        if end <= start:
+            return np.zeros((self.num_codebooks, 0), dtype=np.int64)
+        first_chunk, last_chunk = start // self.chunk_frames, (end - 1) // self.chunk_frames
+        lanes = _unpack(self._data[first_chunk : last_chunk + 1], self.bits, self.chunk_frames)
+        codes = lanes.transpose(1, 0, 2).reshape(self.num_codebooks, -1)
+        offset = first_chunk * self.chunk_frames
+        return codes[:, start - offset : end - offset].astype(np.int64)
+
+    def read_seconds(self, start: float = 0.0, end: Optional[float] = None) -> np.ndarray:
+        """The codes between the time offsets `start` and `end` (the end of the file if `None`), in seconds."""
+        return self.read(self.frame_at(start), self.frame_at(end) if end is not None else None)
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self) -> "AudioCodeFile":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_audio_code_file(path: str) -> bool:
+    """Whether `path` is an `AudioCodeFile`, from its magic."""
+    with open(path, "rb") as f:
+        return f.read(len(AudioCodeFile.MAGIC)) == AudioCodeFile.MAGIC
+
+
+def _align(size: int, alignment: int) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+
+def _lane_bytes(chunk_frames: int, bits: int) -> int:
+    return chunk_frames * 2 if bits == 16 else chunk_frames // 4 * 5
+
+
+def _pack(lanes: np.ndarray, bits: int) -> np.ndarray:
+    """Pack the `uint16` codes of shape `(..., chunk_frames)` into bytes of shape `(..., lane_bytes)`."""
+    if bits == 16:
+        return lanes.astype("<u2").view(np.uint8)
+    # 4 codes of 10 bits -> the 5 low bytes of a little-endian uint64
+    groups = lanes.astype(np.uint64).reshape(*lanes.shape[:-1], lanes.shape[-1] // 4, 4)
+    words = groups[..., 0] | (groups[..., 1] << 10) | (groups[..., 2] << 20) | (groups[..., 3] << 30)
+    packed = words.astype("<u8").view(np.uint8).reshape(*words.shape, 8)[..., :5]
+    return packed.reshape(*lanes.shape[:-1], lanes.shape[-1] // 4 * 5)
+
+
+def _unpack(data: np.ndarray, bits: int, chunk_frames: int) -> np.ndarray:
+    """Inverse of `_pack`, the codes of shape `(..., chunk_frames)` as `uint16`."""
+    if bits == 16:
+        return np.ascontiguousarray(data).view("<u2")
+    packed = np.asarray(data).reshape(*data.shape[:-1], chunk_frames // 4, 5)
+    padded = np.zeros((*packed.shape[:-1], 8), dtype=np.uint8)
+    padded[..., :5] = packed
+    words = padded.view("<u8")[..., 0]
+    shifts = np.array([0, 10, 20, 30], dtype=np.uint64)
+    codes = (words[..., None] >> shifts) & np.uint64(0x3FF)
+    return codes.reshape(*data.shape[:-1], chunk_frames).astype(np.uint16)
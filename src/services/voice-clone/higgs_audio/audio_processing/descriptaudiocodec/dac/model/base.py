@@ -9,6 +9,9 @@ import tqdm
 from audiotools import AudioSignal
 from torch import nn
 
+from ....audio_code_file import AudioCodeFile
+from ....audio_code_file import is_audio_code_file
+
 SUPPORTED_VERSIONS = ["1.0.0"]
 
 
@@ -43,14 +46,48 @@ class DACFile:
             np.save(f, artifacts)
         return path
 
+    def save_code_file(self, path, tps: float):
+        """Save the codes as an `AudioCodeFile`, with the metadata in its
+        header, so that a time range can be read without loading the whole
+        file. `tps` is the frame rate of the codes.
+        """
+        nb, nq, _ = self.codes.shape
+        metadata = {
+            "input_db": np.asarray(self.input_db, dtype=np.float32).tolist(),
+            "original_length": self.original_length,
+            "chunk_length": self.chunk_length,
+            "channels": self.channels,
+            "padding": self.padding,
+            "dac_version": SUPPORTED_VERSIONS[-1],
+            "batch_size": nb,
+        }
+        codes = self.codes.numpy().reshape(nb * nq, -1)
+        AudioCodeFile.write(str(path), codes, self.sample_rate, tps, metadata=metadata).close()
+        return path
+
     @classmethod
     def load(cls, path):
+        if is_audio_code_file(path):
+            return cls.load_code_file(path)
         artifacts = np.load(path, allow_pickle=True)[()]
         codes = torch.from_numpy(artifacts["codes"].astype(int))
         if artifacts["metadata"].get("dac_version", None) not in SUPPORTED_VERSIONS:
             raise RuntimeError(f"Given file {path} can't be loaded with this version of descript-audio-codec.")
         return cls(codes=codes, **artifacts["metadata"])
 
+    @classmethod
+    def load_code_file(cls, path):
+        with AudioCodeFile(str(path)) as code_file:
+            metadata = dict(code_file.metadata)
+            codes = code_file.read()
+            sample_rate = code_file.sample_rate
+        if metadata.get("dac_version", None) not in SUPPORTED_VERSIONS:
+            raise RuntimeError(f"Given file {path} can't be loaded with this version of descript-audio-codec.")
+        nb = metadata.pop("batch_size")
+        codes = torch.from_numpy(codes).reshape(nb, -1, codes.shape[-1])
+        input_db = torch.tensor(metadata.pop("input_db"))
+        return cls(codes=codes, input_db=input_db, sample_rate=sample_rate, **metadata)
+
 
 class CodecMixin:
     @property
@@ -231,6 +268,7 @@ class CodecMixin:
         self,
         obj: Union[str, Path, DACFile],
         verbose: bool = False,
+        batch_size: int = 1,
     ) -> AudioSignal:
         """Reconstruct audio from a given .dac file
 
@@ -240,6 +278,10 @@ class CodecMixin:
             .dac file location or corresponding DACFile object.
         verbose : bool, optional
             Prints progress if True, by default False
+        batch_size : int, optional
+            Number of chunks decoded together, stacked along the batch
+            dimension of one forward pass, by default 1. The chunks are
+            decoded independently, so the audio does not depend on it.
 
         Returns
         -------
@@ -259,10 +301,23 @@ class CodecMixin:
         chunk_length = obj.chunk_length
         recons = []
 
-        for i in range_fn(0, codes.shape[-1], chunk_length):
-            c = codes[..., i : i + chunk_length].to(self.device)
+        # `compress` pads every chunk to `chunk_length` frames, a shorter last
+        # chunk (if any) is decoded on its own
+        n_full = codes.shape[-1] // chunk_length
+        batches = [(i, min(batch_size, n_full - i)) for i in range(0, n_full, batch_size)]
+        if codes.shape[-1] > n_full * chunk_length:
+            batches.append((n_full, 1))
+
+        for j in range_fn(len(batches)):
+            i, n = batches[j]
+            c = codes[..., i * chunk_length : (i + n) * chunk_length].to(self.device)
+            # [B, N, n * T] -> [n * B, N, T], chunk-major
+            nb, nq, _ = c.shape
+            c = c.reshape(nb, nq, n, -1).permute(2, 0, 1, 3).reshape(n * nb, nq, -1)
             z = self.quantizer.from_codes(c)[0]
             r = self.decode(z)
+            # [n * B, 1, L] -> [B, 1, n * L]
+            r = r.reshape(n, nb, *r.shape[1:]).permute(1, 2, 0, 3).reshape(nb, r.shape[1], -1)
             recons.append(r.to(original_device))
 
         recons = torch.cat(recons, dim=-1)
@@ -19,6 +19,7 @@ from vector_quantize_pytorch import ResidualFSQ
 from .descriptaudiocodec.dac.model import dac as dac2
 from .quantization.vq import ResidualVectorQuantizer
 from .semantic_module import Encoder, Decoder
+from .streaming_decoder import HiggsAudioStreamingDecoder
 
 
 class EncodedResult:
@@ -26,6 +27,34 @@ class EncodedResult:
         self.audio_codes = audio_codes
 
 
+def _conv_output_length(module: nn.Module, length: int) -> int:
+    """The output length of a stack of convolutions, e.g., `dac2.Encoder`, on an input of `length` samples."""
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv1d):
+            kernel_size, stride = layer.kernel_size[0], layer.stride[0]
+            dilation, padding = layer.dilation[0], layer.padding[0]
+            length = (length + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+    return length
+
+
+def _conv_context(module: nn.Module, hop_length: int) -> int:
+    """The number of output frames of context, on each side of a window, after which the outputs of a stack of
+    convolutions on the window are those on the whole input. `hop_length` is the number of input samples per frame.
+
+    Modeled on `CodecMixin.get_delay`: the reach of every convolution is scaled by the stride of its input. The
+    convolutions of residual branches are counted as if they were stacked, which can only overestimate the context.
+    """
+    left = right = 0
+    stride = 1
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv1d):
+            kernel_size, dilation, padding = layer.kernel_size[0], layer.dilation[0], layer.padding[0]
+            left += padding * stride
+            right += (dilation * (kernel_size - 1) - padding) * stride
+            stride *= layer.stride[0]
+    return math.ceil(max(left, right) / hop_length)
+
+
 class HiggsAudioFeatureExtractor(nn.Module):
     def __init__(self, sampling_rate=16000):
         super().__init__()
@@ -61,8 +90,12 @@ class HiggsAudioTokenizer(nn.Module):
         vq_scale: int = 1,
         semantic_sample_rate: int = None,
         device: str = "cuda",
+        decode_only: bool = False,
+        encode_only: bool = False,
     ):
         super().__init__()
+        if decode_only and encode_only:
+            raise ValueError("`decode_only` and `encode_only` cannot both be set.")
         self.hop_length = np.prod(ratios)
         self.semantic_techer = semantic_techer
 
@@ -71,25 +104,33 @@ class HiggsAudioTokenizer(nn.Module):
         self.target_bandwidths = target_bandwidths
         self.n_q = n_q
         self.sample_rate = sample_rate
-        self.encoder = dac2.Encoder(64, ratios, D)
-
-        self.decoder_2 = dac2.Decoder(D, 1024, ratios)
+        # With decode_only, only the submodules used by `decode` are built: the quantizer, fc_post2 and decoder_2.
+        # The semantic teacher and the encoders are skipped, so `encode` and `forward` are not available.
+        # With encode_only, the decoders and the projections that feed them are skipped, so `decode` and `forward` are
+        # not available.
+        self.decode_only = decode_only
+        self.encode_only = encode_only
+        if not decode_only:
+            self.encoder = dac2.Encoder(64, ratios, D)
+
+        if not encode_only:
+            self.decoder_2 = dac2.Decoder(D, 1024, ratios)
         self.last_layer_semantic = last_layer_semantic
         self.device = device
         if semantic_techer == "hubert_base":
-            self.semantic_model = AutoModel.from_pretrained("facebook/hubert-base-ls960")
+            semantic_model_name = "facebook/hubert-base-ls960"
             self.semantic_sample_rate = 16000
             self.semantic_dim = 768
             self.encoder_semantic_dim = 768
 
         elif semantic_techer == "wavlm_base_plus":
-            self.semantic_model = AutoModel.from_pretrained("microsoft/wavlm-base-plus")
+            semantic_model_name = "microsoft/wavlm-base-plus"
             self.semantic_sample_rate = 16000
             self.semantic_dim = 768
             self.encoder_semantic_dim = 768
 
         elif semantic_techer == "hubert_base_general":
-            self.semantic_model = AutoModel.from_pretrained("ZhenYe234/hubert_base_general_audio")
+            semantic_model_name = "ZhenYe234/hubert_base_general_audio"
             self.semantic_sample_rate = 16000
             self.semantic_dim = 768
             self.encoder_semantic_dim = 768
@@ -98,21 +139,28 @@ class HiggsAudioTokenizer(nn.Module):
         if semantic_sample_rate is not None:
             self.semantic_sample_rate = semantic_sample_rate
 
-        self.semantic_model.eval()
+        # The semantic teacher is only used to encode
+        if not decode_only:
+            self.semantic_model = AutoModel.from_pretrained(semantic_model_name)
+            self.semantic_model.eval()
 
-        # make the semantic model parameters do not need gradient
-        for param in self.semantic_model.parameters():
-            param.requires_grad = False
+            # make the semantic model parameters do not need gradient
+            for param in self.semantic_model.parameters():
+                param.requires_grad = False
 
         self.semantic_downsample_factor = int(self.hop_length / (self.sample_rate / self.semantic_sample_rate) / 320)
 
         self.quantizer_dim = int((D + self.encoder_semantic_dim) // vq_scale)
-        self.encoder_semantic = Encoder(input_channels=self.semantic_dim, encode_channels=self.encoder_semantic_dim)
-        self.decoder_semantic = Decoder(
-            code_dim=self.encoder_semantic_dim,
-            output_channels=self.semantic_dim,
-            decode_channels=self.semantic_dim,
-        )
+        if not decode_only:
+            self.encoder_semantic = Encoder(
+                input_channels=self.semantic_dim, encode_channels=self.encoder_semantic_dim
+            )
+        if not decode_only and not encode_only:
+            self.decoder_semantic = Decoder(
+                code_dim=self.encoder_semantic_dim,
+                output_channels=self.semantic_dim,
+                decode_channels=self.semantic_dim,
+            )
 
         # out_D=D+768
         if isinstance(bins, int):  # RVQ
@@ -127,9 +175,12 @@ class HiggsAudioTokenizer(nn.Module):
             self.quantizer = ResidualFSQ(dim=self.quantizer_dim, levels=bins, num_quantizers=n_q)
             self.quantizer_type = "RFSQ"
 
-        self.fc_prior = nn.Linear(D + self.encoder_semantic_dim, self.quantizer_dim)
-        self.fc_post1 = nn.Linear(self.quantizer_dim, self.encoder_semantic_dim)
-        self.fc_post2 = nn.Linear(self.quantizer_dim, D)
+        if not decode_only:
+            self.fc_prior = nn.Linear(D + self.encoder_semantic_dim, self.quantizer_dim)
+        if not decode_only and not encode_only:
+            self.fc_post1 = nn.Linear(self.quantizer_dim, self.encoder_semantic_dim)
+        if not encode_only:
+            self.fc_post2 = nn.Linear(self.quantizer_dim, D)
 
         self.downsample_mode = downsample_mode
         if downsample_mode == "avg":
@@ -212,7 +263,17 @@ class HiggsAudioTokenizer(nn.Module):
             target = self.semantic_pooling(target.transpose(1, 2)).transpose(1, 2)
         return target
 
+    def _check_encoder(self):
+        if self.decode_only:
+            raise RuntimeError("The audio tokenizer was loaded with `decode_only=True` and cannot encode audio.")
+
+    def _check_decoder(self):
+        if self.encode_only:
+            raise RuntimeError("The audio tokenizer was loaded with `encode_only=True` and cannot decode codes.")
+
     def forward(self, x: torch.Tensor, bw: int):
+        self._check_encoder()
+        self._check_decoder()
         e_semantic_input = self.get_regress_target(x).detach()
 
         e_semantic = self.encoder_semantic(e_semantic_input.transpose(1, 2))
@@ -246,7 +307,14 @@ class HiggsAudioTokenizer(nn.Module):
         sr=None,
         loudness_normalize=False,
         loudness_threshold=-23.0,
+        win_duration: Optional[float] = 30.0,
     ):
+        """Encode an audio file or waveform into codes of shape `(num_codebooks, num_frames)`.
+
+        The audio is encoded by windows of `win_duration` seconds (see `_xcodec_encode`), which bounds the memory of
+        long clips without changing the codes. With `win_duration=None`, it is encoded at once.
+        """
+        self._check_encoder()
         if isinstance(audio_path_or_wv, str):
             wv, sr = librosa.load(audio_path_or_wv, mono=True, sr=None)
         else:
@@ -270,44 +338,103 @@ class HiggsAudioTokenizer(nn.Module):
         else:
             input_values = torch.from_numpy(wv).float().unsqueeze(0)
         with torch.no_grad():
-            encoder_outputs = self._xcodec_encode(input_values)
+            win_frames = math.ceil(win_duration * self.frame_rate) if win_duration is not None else None
+            encoder_outputs = self._xcodec_encode(input_values, win_frames=win_frames)
             vq_code = encoder_outputs.audio_codes[0]
         return vq_code
 
-    def _xcodec_encode(self, x: torch.Tensor, target_bw: Optional[int] = None) -> torch.Tensor:
-        bw = target_bw
+    def _xcodec_encode(
+        self, x: torch.Tensor, target_bw: Optional[int] = None, win_frames: Optional[int] = None
+    ) -> torch.Tensor:
+        """Encode the audio `x` of shape `(batch_size, 1, num_samples)`.
 
-        e_semantic_input = self.get_regress_target(x).detach()
+        The semantic teacher attends over the whole clip, so it runs once on all of it. The acoustic encoder, the
+        semantic encoder and the quantizer run on windows of `win_frames` frames (all the frames if `None`), with the
+        context of their receptive fields on both sides, so the codes are those of the whole clip and the peak memory
+        of the convolutions does not grow with its length.
+        """
+        bw = target_bw
 
-        e_semantic = self.encoder_semantic(e_semantic_input.transpose(1, 2))
-        e_acoustic = self.encoder(x)
+        e_semantic_input = self.get_regress_target(x).detach().transpose(1, 2)
+        num_semantic_frames = e_semantic_input.shape[2]
 
-        if e_acoustic.shape[2] != e_semantic.shape[2]:
+        # Plan the alignment of the acoustic and semantic frames up front, so the acoustic encoder runs once
+        if _conv_output_length(self.encoder, x.shape[-1]) != num_semantic_frames:
             pad_size = 160 * self.semantic_downsample_factor
-            e_acoustic = self.encoder(F.pad(x[:, 0, :], (pad_size, pad_size)).unsqueeze(0))
+            x = F.pad(x, (pad_size, pad_size))
+        num_frames = min(_conv_output_length(self.encoder, x.shape[-1]), num_semantic_frames)
 
-        if e_acoustic.shape[2] != e_semantic.shape[2]:
-            if e_acoustic.shape[2] > e_semantic.shape[2]:
-                e_acoustic = e_acoustic[:, :, : e_semantic.shape[2]]
-            else:
-                e_semantic = e_semantic[:, :, : e_acoustic.shape[2]]
+        hop_length = int(self.hop_length)
+        acoustic_context = _conv_context(self.encoder, hop_length)
+        semantic_context = _conv_context(self.encoder_semantic, 1)
+        if win_frames is None:
+            win_frames = max(num_frames, 1)
 
-        e = torch.cat([e_acoustic, e_semantic], dim=1)
+        codes = []
+        for start in range(0, num_frames, win_frames):
+            end = min(start + win_frames, num_frames)
 
-        e = self.fc_prior(e.transpose(1, 2))
+            acoustic_start = max(0, start - acoustic_context)
+            e_acoustic = self.encoder(x[..., acoustic_start * hop_length : (end + acoustic_context) * hop_length])
+            e_acoustic = e_acoustic[:, :, start - acoustic_start : end - acoustic_start]
 
-        if self.quantizer_type == "RVQ":
-            e = e.transpose(1, 2)
-            quantized, codes, bandwidth, commit_loss = self.quantizer(e, self.frame_rate, bw)
-            codes = codes.permute(1, 0, 2)
-        else:
-            quantized, codes = self.quantizer(e)
-            codes = codes.permute(0, 2, 1)
+            semantic_start = max(0, start - semantic_context)
+            e_semantic = self.encoder_semantic(e_semantic_input[..., semantic_start : end + semantic_context])
+            e_semantic = e_semantic[:, :, start - semantic_start : end - semantic_start]
+
+            e = torch.cat([e_acoustic, e_semantic], dim=1)
+
+            e = self.fc_prior(e.transpose(1, 2))
+
+            if self.quantizer_type == "RVQ":
+                e = e.transpose(1, 2)
+                quantized, window_codes, bandwidth, commit_loss = self.quantizer(e, self.frame_rate, bw)
+                window_codes = window_codes.permute(1, 0, 2)
+            else:
+                quantized, window_codes = self.quantizer(e)
+                window_codes = window_codes.permute(0, 2, 1)
+            codes.append(window_codes)
 
         # return codes
-        return EncodedResult(codes)
+        return EncodedResult(torch.cat(codes, dim=-1))
+
+    def prepare_for_inference(self, backend: Optional[str] = None) -> "HiggsAudioTokenizer":
+        """Fold the weight norm of the convolutions into plain weights, and freeze the tokenizer.
+
+        The DAC encoder and decoder use weight-normalized convolutions, whose weight is recomputed from `weight_g`
+        and `weight_v` at every forward pass. Folding computes it once, with the same function, so the outputs do not
+        change. The parameters no longer require gradients. The state dict then holds plain `weight`s, and cannot be
+        loaded back into a tokenizer that was not prepared.
+
+        Args:
+            backend (`str`, *optional*):
+                How to run `decoder_2`, the acoustic decoder: `"torchscript"` to script and freeze it (the result can
+                be saved with `torch.jit.save(tokenizer.decoder_2, path)`), or `"compile"` to compile it with
+                `torch.compile` and dynamic shapes. Defaults to running it eagerly.
+
+        Returns:
+            The tokenizer, prepared in place.
+        """
+        if backend not in (None, "torchscript", "compile"):
+            raise ValueError(f"Unknown backend {backend}, expected None, 'torchscript' or 'compile'.")
+        for module in self.modules():
+            if hasattr(module, "weight_g") and hasattr(module, "weight_v"):
+                torch.nn.utils.remove_weight_norm(module)
+        self.eval()
+        self.requires_grad_(False)
+
+        if backend is not None and not self.encode_only:
+            if backend == "torchscript":
+                self.decoder_2 = torch.jit.freeze(torch.jit.script(self.decoder_2))
+            else:
+                self.decoder_2 = torch.compile(self.decoder_2, dynamic=True)
+        return self
 
-    def decode(self, vq_code: torch.Tensor) -> torch.Tensor:
+    def _codes_to_latents(self, vq_code: torch.Tensor) -> torch.Tensor:
+        """The input of `decoder_2` for the codes of shape `(batch_size, num_codebooks, num_frames)`.
+
+        Every frame is mapped independently, so the codes can be mapped block by block.
+        """
         if self.quantizer_type == "RVQ":
             vq_code = vq_code.permute(1, 0, 2)
             quantized = self.quantizer.decode(vq_code)
@@ -315,13 +442,34 @@ class HiggsAudioTokenizer(nn.Module):
         else:
             vq_code = vq_code.permute(0, 2, 1)
             quantized = self.quantizer.get_output_from_indices(vq_code)
-        quantized_acoustic = self.fc_post2(quantized).transpose(1, 2)
+        return self.fc_post2(quantized).transpose(1, 2)
+
+    def decode(self, vq_code: torch.Tensor) -> torch.Tensor:
+        self._check_decoder()
+        quantized_acoustic = self._codes_to_latents(vq_code)
 
         o = self.decoder_2(quantized_acoustic)
         return o.cpu().numpy()
 
+    def streaming_decoder(self) -> "HiggsAudioStreamingDecoder":
+        """A `HiggsAudioStreamingDecoder` of the codes, which decodes them block by block as they are generated,
+        with the same result as `decode`."""
+        return HiggsAudioStreamingDecoder(self)
+
 
-def load_higgs_audio_tokenizer(tokenizer_name_or_path, device="cuda"):
+# Submodules used by `HiggsAudioTokenizer.decode`, the only ones loaded with `decode_only=True`
+_DECODER_SUBMODULES = ("quantizer.", "fc_post2.", "decoder_2.")
+# Submodules only used by `HiggsAudioTokenizer.decode` and `forward`, skipped with `encode_only=True`
+_DECODER_ONLY_SUBMODULES = ("fc_post1.", "fc_post2.", "decoder_2.", "decoder_semantic.")
+
+
+def load_higgs_audio_tokenizer(tokenizer_name_or_path, device="cuda", decode_only=False, encode_only=False):
+    """Load a `HiggsAudioTokenizer` from a local directory or the Hugging Face Hub.
+
+    With `decode_only=True`, only the submodules used by `decode` are built and loaded, which skips the download and
+    the loading of the semantic teacher and of the encoders. Meant for deployments whose voices are already tokenized.
+    With `encode_only=True`, the decoders are skipped instead, e.g., to tokenize reference audios offline.
+    """
     is_local = os.path.exists(tokenizer_name_or_path)
     if not is_local:
         tokenizer_path = snapshot_download(tokenizer_name_or_path)
@@ -333,8 +481,18 @@ def load_higgs_audio_tokenizer(tokenizer_name_or_path, device="cuda"):
     model = HiggsAudioTokenizer(
         **config,
         device=device,
+        decode_only=decode_only,
+        encode_only=encode_only,
     )
-    parameter_dict = torch.load(model_path, map_location=device)
+    if decode_only or encode_only:
+        # Memory-map the checkpoint so the weights of the skipped submodules are never read
+        parameter_dict = torch.load(model_path, map_location="cpu", mmap=True)
+        if decode_only:
+            parameter_dict = {k: v for k, v in parameter_dict.items() if k.startswith(_DECODER_SUBMODULES)}
+        else:
+            parameter_dict = {k: v for k, v in parameter_dict.items() if not k.startswith(_DECODER_ONLY_SUBMODULES)}
+    else:
+        parameter_dict = torch.load(model_path, map_location=device)
     model.load_state_dict(parameter_dict, strict=False)
     model.to(device)
     model.eval()
@@ -31,6 +31,7 @@
 
 """Core vector quantization implementation."""
 
+import threading
 import typing as tp
 
 from einops import rearrange, repeat
@@ -93,6 +94,32 @@ def kmeans(samples, num_clusters: int, num_iters: int = 10):
     return means, bins
 
 
+class DistanceWorkspace:
+    """Preallocated buffer of the distance tiles of `EuclideanCodebook.quantize`, shared by the codebooks of the
+    residual quantizers, so the stages do not allocate one each. Every thread gets its own buffer, which only grows.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __reduce__(self):
+        # The buffers are not copied or pickled with the module
+        return (DistanceWorkspace, ())
+
+    def get(self, num_rows: int, num_cols: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        buffer = getattr(self._local, "buffer", None)
+        if (
+            buffer is None
+            or buffer.dtype != dtype
+            or buffer.device != device
+            or buffer.shape[0] < num_rows
+            or buffer.shape[1] != num_cols
+        ):
+            buffer = torch.empty(num_rows, num_cols, dtype=dtype, device=device)
+            self._local.buffer = buffer
+        return buffer[:num_rows]
+
+
 class EuclideanCodebook(nn.Module):
     """Codebook with Euclidean distance.
     Args:
@@ -109,6 +136,9 @@ class EuclideanCodebook(nn.Module):
             randomly selected vector from the current batch.
     """
 
+    # Number of frames of a tile of the distance matrix in `quantize`
+    quantize_block_size: int = 1024
+
     def __init__(
         self,
         dim: int,
@@ -134,6 +164,9 @@ class EuclideanCodebook(nn.Module):
         self.register_buffer("cluster_size", torch.zeros(codebook_size))
         self.register_buffer("embed", embed)
         self.register_buffer("embed_avg", embed.clone())
+        # Replaced by the workspace shared by all the stages in `ResidualVectorQuantization`
+        self.workspace = DistanceWorkspace()
+        self._embed_norms_cache = None
 
     @torch.jit.ignore
     def init_embed_(self, data):
@@ -142,6 +175,7 @@ class EuclideanCodebook(nn.Module):
 
         embed, cluster_size = kmeans(data, self.codebook_size, self.kmeans_iters)
         self.embed.data.copy_(embed)
+        self._embed_norms_cache = None
         self.embed_avg.data.copy_(embed.clone())
         self.cluster_size.data.copy_(cluster_size)
         self.inited.data.copy_(torch.Tensor([True]))
@@ -151,6 +185,7 @@ class EuclideanCodebook(nn.Module):
     def replace_(self, samples, mask):
         modified_codebook = torch.where(mask[..., None], sample_vectors(samples, self.codebook_size), self.embed)
         self.embed.data.copy_(modified_codebook)
+        self._embed_norms_cache = None
 
     def expire_codes_(self, batch_samples):
         if self.threshold_ema_dead_code == 0:
@@ -168,10 +203,35 @@ class EuclideanCodebook(nn.Module):
         x = rearrange(x, "... d -> (...) d")
         return x
 
+    def _embed_norms(self) -> torch.Tensor:
+        """The squared norms of the codes, of shape [1, codebook_size], cached until the codebook changes."""
+        key = (self.embed.data_ptr(), self.embed.dtype, self.embed.device)
+        if self._embed_norms_cache is None or self._embed_norms_cache[0] != key:
+            self._embed_norms_cache = (key, self.embed.t().pow(2).sum(0, keepdim=True))
+        return self._embed_norms_cache[1]
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._embed_norms_cache = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
     def quantize(self, x):
+        # Nearest code of every frame, -(|x|^2 - 2 x.e + |e|^2) maximized over tiles of `quantize_block_size` frames.
+        # The tiles reuse the workspace, and go through the same rounding as the whole distance matrix would (scaling
+        # by -2 is exact, and x2 - 2 m == -2 m + x2), so the indices are the same.
         embed = self.embed.t()
-        dist = -(x.pow(2).sum(1, keepdim=True) - 2 * x @ embed + embed.pow(2).sum(0, keepdim=True))
-        embed_ind = dist.max(dim=-1).indices
+        embed_norms = self._embed_norms()
+        x_norms = x.pow(2).sum(1, keepdim=True)
+        num_frames = x.shape[0]
+        block_size = min(self.quantize_block_size, max(num_frames, 1))
+        workspace = self.workspace.get(block_size, self.codebook_size, x.dtype, x.device)
+        embed_ind = torch.empty(num_frames, dtype=torch.long, device=x.device)
+        for start in range(0, num_frames, block_size):
+            end = min(start + block_size, num_frames)
+            dist = workspace[: end - start]
+            torch.matmul(x[start:end], embed, out=dist)
+            dist.mul_(-2).add_(x_norms[start:end]).add_(embed_norms).neg_()
+            embed_ind[start:end] = dist.max(dim=-1).indices
         return embed_ind
 
     def postprocess_emb(self, embed_ind, shape):
@@ -218,6 +278,7 @@ class EuclideanCodebook(nn.Module):
             )
             embed_normalized = self.embed_avg / cluster_size.unsqueeze(1)
             self.embed.data.copy_(embed_normalized)
+            self._embed_norms_cache = None
 
         return quantize, embed_ind
 
@@ -318,6 +379,9 @@ class ResidualVectorQuantization(nn.Module):
     def __init__(self, *, num_quantizers, **kwargs):
         super().__init__()
         self.layers = nn.ModuleList([VectorQuantization(**kwargs) for _ in range(num_quantizers)])
+        workspace = DistanceWorkspace()
+        for layer in self.layers:
+            layer._codebook.workspace = workspace
 
     def forward(self, x, n_q: tp.Optional[int] = None):
         quantized_out = 0.0
@@ -0,0 +1,206 @@
+"""Vectorized rANS entropy coder for the codes of an audio codec."""
+
+import hashlib
+import numpy as np
+import struct
+from typing import Iterable, Optional
+
+
+class RansCoder:
+    """Lossless entropy coder of codes of shape `(num_codebooks, num_frames)`, with one static frequency table per
+    codebook.
+
+    The coder is an interleaved rANS with 32-bit states and 16-bit renormalization words. The frames of every
+    codebook are dealt to `lanes_per_codebook` independent lanes, frame `t` going to lane `t % lanes_per_codebook`,
+    and all the lanes of all the codebooks advance in lock-step, so encoding and decoding are a loop over
+    `num_frames / lanes_per_codebook` steps of NumPy operations over the lanes, instead of a loop over the codes like
+    `ArithmeticCoder`. Every lane emits at most one word per code.
+
+    The tables are fitted on archived codes with `fit`, and saved with `save`. Every symbol of the alphabet gets a
+    non-zero frequency, so codes unseen when fitting are still coded, at a higher cost. The encoded bytes hold a
+    checksum of the tables, and decoding with other tables raises.
+
+    Args:
+        freqs (`np.ndarray` of shape `(num_codebooks, alphabet_size)`):
+            The frequencies of the symbols of every codebook, positive, each row summing to `2 ** scale_bits`.
+        scale_bits (`int`):
+            The precision of the frequencies, at most 16.
+    """
+
+    MAGIC = b"HRNS"
+    # num_codebooks, num_frames, lanes_per_codebook, checksum of the tables
+    HEADER = struct.Struct("<4sHIH8s")
+    STATE_LOW = 1 << 16
+    WORD_BITS = 16
+
+    def __init__(self, freqs: np.ndarray, scale_bits: int):
+        freqs = np.asarray(freqs, dtype=np.int64)
+        if scale_bits > 16:
+            raise ValueError(f"`scale_bits` must be at most 16, got {scale_bits}.")
+        if (freqs <= 0).any() or (freqs.sum(axis=1) != 1 << scale_bits).any():
+            raise ValueError(f"The frequencies must be positive and sum to 2 ** {scale_bits} for every codebook.")
+        self.freqs = freqs
+        self.scale_bits = scale_bits
+        self.num_codebooks, self.alphabet_size = freqs.shape
+        self.cumfreqs = np.concatenate([np.zeros((self.num_codebooks, 1), np.int64), freqs.cumsum(axis=1)[:, :-1]], 1)
+        # The symbol of every slot of `[0, 2 ** scale_bits)`, for the decoder
+        self.slot_symbols = np.stack([np.repeat(np.arange(self.alphabet_size, dtype=np.uint16), row) for row in freqs])
+        self.checksum = hashlib.blake2b(freqs.astype("<i8").tobytes() + bytes([scale_bits]), digest_size=8).digest()
+
+    @classmethod
+    def fit(
+        cls,
+        codes: Iterable[np.ndarray],
+        num_codebooks: int,
+        alphabet_size: int,
+        scale_bits: int = 15,
+    ) -> "RansCoder":
+        """Fit the frequency tables on archived codes, an iterable of arrays of shape `(num_codebooks, num_frames)`.
+
+        The counts are scaled to `2 ** scale_bits - alphabet_size`, and every symbol gets one more, so that no
+        frequency is zero. The remainder of the rounding goes to the largest fractional parts.
+        """
+        counts = np.zeros((num_codebooks, alphabet_size), dtype=np.int64)
+        for array in codes:
+            array = np.asarray(array)
+            for q in range(num_codebooks):
+                counts[q] += np.bincount(array[q], minlength=alphabet_size)[:alphabet_size]
+        total = 1 << scale_bits
+        if alphabet_size > total:
+            raise ValueError(f"An alphabet of {alphabet_size} symbols needs more than {scale_bits} scale bits.")
+        budget = total - alphabet_size
+        scaled = counts * budget / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        freqs = 1 + np.floor(scaled).astype(np.int64)
+        remainder = total - freqs.sum(axis=1)
+        order = np.argsort(-(scaled - np.floor(scaled)), axis=1, kind="stable")
+        for q in range(num_codebooks):
+            freqs[q, order[q, : remainder[q]]] += 1
+        return cls(freqs, scale_bits)
+
+    def save(self, path: str):
+        np.savez(path, freqs=self.freqs, scale_bits=self.scale_bits)
+
+    @classmethod
+    def load(cls, path: str) -> "RansCoder":
+        tables = np.load(path)
+        return cls(tables["freqs"], int(tables["scale_bits"]))
+
+    def entropy(self) -> np.ndarray:
+        """The entropy of the table of every codebook, in bits per code: the rate of codes distributed like it."""
+        p = self.freqs / (1 << self.scale_bits)
+        return -(p * np.log2(p)).sum(axis=1)
+
+    def encode(self, codes: np.ndarray, lanes_per_codebook: Optional[int] = None) -> bytes:
+        """Encode the codes of shape `(num_codebooks, num_frames)`.
+
+        Every lane costs 8 bytes of state and word count, so `lanes_per_codebook` defaults to one lane per 256
+        frames, up to 32.
+        """
+        codes = np.asarray(codes)
+        if codes.ndim != 2 or codes.shape[0] != self.num_codebooks:
+            raise ValueError(f"Expected codes of shape ({self.num_codebooks}, num_frames), got {codes.shape}.")
+        if codes.size > 0 and (codes.min() < 0 or codes.max() >= self.alphabet_size):
+            raise ValueError(f"The codes must be in [0, {self.alphabet_size}).")
+        num_frames = codes.shape[1]
+        if lanes_per_codebook is None:
+            lanes_per_codebook = min(32, max(1, num_frames // 256))
+        symbols, valid, lane_codebooks = self._to_lanes(codes.astype(np.int64), lanes_per_codebook)
+        num_lanes, num_steps = symbols.shape
+
+        freqs = self.freqs[lane_codebooks[:, None], symbols]
+        cumfreqs = self.cumfreqs[lane_codebooks[:, None], symbols]
+        # The states are renormalized below this before encoding a symbol, so that they stay below 2 ** 32
+        x_max = (self.STATE_LOW >> self.scale_bits << self.WORD_BITS) * freqs
+
+        x = np.full(num_lanes, self.STATE_LOW, dtype=np.uint64)
+        words = np.zeros((num_steps, num_lanes), dtype=np.uint16)
+        emitted = np.zeros((num_steps, num_lanes), dtype=bool)
+        # rANS is last in, first out: encode backwards, so that the decoder goes forwards
+        for t in range(num_steps - 1, -1, -1):
+            f = freqs[:, t].astype(np.uint64)
+            emit = valid[:, t] & (x >= x_max[:, t].astype(np.uint64))
+            words[t] = (x & np.uint64(0xFFFF)).astype(np.uint16)
+            emitted[t] = emit
+            x = np.where(emit, x >> np.uint64(self.WORD_BITS), x)
+            encoded = ((x // f) << np.uint64(self.scale_bits)) + x % f + cumfreqs[:, t].astype(np.uint64)
+            x = np.where(valid[:, t], encoded, x)
+
+        # Every lane: its final state (2 words), then its words in the order the decoder reads them
+        lane_words = words.T[emitted.T]
+        num_words = emitted.sum(axis=0).astype("<u4")
+        states = np.stack([x >> np.uint64(self.WORD_BITS), x & np.uint64(0xFFFF)], axis=1).astype("<u2")
+        header = self.HEADER.pack(self.MAGIC, self.num_codebooks, num_frames, lanes_per_codebook, self.checksum)
+        return b"".join([header, num_words.tobytes(), states.tobytes(), lane_words.astype("<u2").tobytes()])
+
+    def decode(self, data: bytes) -> np.ndarray:
+        """Decode the codes encoded by `encode`, of shape `(num_codebooks, num_frames)`, as `int64`."""
+        num_codebooks, num_frames, lanes_per_codebook = self._read_header(data)
+        num_lanes = num_codebooks * lanes_per_codebook
+        offset = self.HEADER.size
+        num_words = np.frombuffer(data, dtype="<u4", count=num_lanes, offset=offset).astype(np.int64)
+        offset += num_lanes * 4
+        states = np.frombuffer(data, dtype="<u2", count=2 * num_lanes, offset=offset).astype(np.uint64)
+        offset += num_lanes * 4
+        # One more word, so that the lanes that do not read still index a word
+        words = np.zeros(int(num_words.sum()) + 1, dtype=np.uint64)
+        words[:-1] = np.frombuffer(data, dtype="<u2", count=len(words) - 1, offset=offset)
+
+        _, valid, lane_codebooks = self._to_lanes(np.zeros((num_codebooks, num_frames), np.int64), lanes_per_codebook)
+        num_steps = valid.shape[1]
+        x = (states[0::2] << np.uint64(self.WORD_BITS)) | states[1::2]
+        position = np.concatenate([[0], num_words.cumsum()[:-1]])
+        end = position + num_words
+        mask = np.uint64((1 << self.scale_bits) - 1)
+        symbols = np.zeros((num_lanes, num_steps), dtype=np.int64)
+        for t in range(num_steps):
+            slot = x & mask
+            s = self.slot_symbols[lane_codebooks, slot.astype(np.int64)].astype(np.int64)
+            f = self.freqs[lane_codebooks, s].astype(np.uint64)
+            c = self.cumfreqs[lane_codebooks, s].astype(np.uint64)
+            decoded = f * (x >> np.uint64(self.scale_bits)) + slot - c
+            x = np.where(valid[:, t], decoded, x)
+            symbols[:, t] = s
+            read = valid[:, t] & (x < np.uint64(self.STATE_LOW))
+            x = np.where(read, (x << np.uint64(self.WORD_BITS)) | words[np.where(read, position, -1)], x)
+            position += read
+
+        if (x != self.STATE_LOW).any() or (position != end).any():
+            raise ValueError("The encoded codes are corrupted.")
+        return self._from_lanes(symbols, num_codebooks, num_frames, lanes_per_codebook)
+
+    def bits_per_code(self, data: bytes) -> float:
+        """The number of bits per code of encoded codes, headers included."""
+        num_codebooks, num_frames, _ = self._read_header(data)
+        return len(data) * 8 / max(num_codebooks * num_frames, 1)
+
+    def _read_header(self, data: bytes):
+        magic, num_codebooks, num_frames, lanes_per_codebook, checksum = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("The data was not encoded by a `RansCoder`.")
+        if checksum != self.checksum or num_codebooks != self.num_codebooks:
+            raise ValueError("The data was encoded with other frequency tables.")
+        return num_codebooks, num_frames, lanes_per_codebook
+
+    @staticmethod
+    def _to_lanes(codes: np.ndarray, lanes_per_codebook: int):
+        """Deal the frames to the lanes: `(num_codebooks, num_frames)` -> `(num_codebooks * lanes, num_steps)`, with
+        the mask of the frames that exist and the codebook of every lane."""
+        num_codebooks, num_frames = codes.shape
+        num_steps = -(-num_frames // lanes_per_codebook)
+        padded = np.zeros((num_codebooks, num_steps * lanes_per_codebook), dtype=np.int64)
+        padded[:, :num_frames] = codes
+        symbols = padded.reshape(num_codebooks, num_steps, lanes_per_codebook).transpose(0, 2, 1)
+        valid = (np.arange(num_steps * lanes_per_codebook) < num_frames).reshape(num_steps, lanes_per_codebook).T
+        valid = np.broadcast_to(valid, (num_codebooks, lanes_per_codebook, num_steps))
+        lane_codebooks = np.repeat(np.arange(num_codebooks), lanes_per_codebook)
+        return (
+            symbols.reshape(num_codebooks * lanes_per_codebook, num_steps),
+            valid.reshape(num_codebooks * lanes_per_codebook, num_steps),
+            lane_codebooks,
+        )
+
+    @staticmethod
+    def _from_lanes(symbols: np.ndarray, num_codebooks: int, num_frames: int, lanes_per_codebook: int) -> np.ndarray:
+        num_steps = symbols.shape[1]
+        codes = symbols.reshape(num_codebooks, lanes_per_codebook, num_steps).transpose(0, 2, 1)
+        return codes.reshape(num_codebooks, num_steps * lanes_per_codebook)[:, :num_frames]
@@ -0,0 +1,230 @@
+"""Stateful streaming decoding of the codes of `HiggsAudioTokenizer`, equivalent to its offline `decode`."""
+
+import math
+import numpy as np
+from abc import ABC, abstractmethod
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.weight_norm import WeightNorm
+from typing import List
+
+from .descriptaudiocodec.dac.model import dac as dac2
+
+
+def _conv_weight(conv: nn.Module) -> torch.Tensor:
+    """The weight of a convolution, computed from `weight_g` and `weight_v` if it is weight-normalized."""
+    for hook in conv._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(conv).detach()
+    return conv.weight.detach()
+
+
+class _StreamingLayer(ABC):
+    """A layer of the decoder that is fed its input sequence block by block.
+
+    `push` returns the outputs that no later input can change, and `push(..., final=True)` the remaining ones. The
+    concatenation of the outputs is the output of the offline layer on the concatenation of the inputs.
+    """
+
+    def reset(self):
+        pass
+
+    @abstractmethod
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        pass
+
+
+class _StreamingPointwise(_StreamingLayer):
+    def __init__(self, module: nn.Module):
+        self.module = module
+
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        return self.module(x)
+
+
+class _StreamingConv1d(_StreamingLayer):
+    """`nn.Conv1d` with stride 1 and "same" zero padding. Keeps the inputs of the outputs not emitted yet."""
+
+    def __init__(self, conv: nn.Conv1d):
+        kernel_size, dilation, padding = conv.kernel_size[0], conv.dilation[0], conv.padding[0]
+        if conv.stride[0] != 1 or conv.groups != 1 or 2 * padding != (kernel_size - 1) * dilation:
+            raise ValueError(f"Cannot stream {conv}, only convolutions with stride 1 and same padding are supported.")
+        self.weight = _conv_weight(conv)
+        self.bias = conv.bias.detach() if conv.bias is not None else None
+        self.dilation = dilation
+        self.padding = padding
+        self.receptive_field = (kernel_size - 1) * dilation
+        self.reset()
+
+    def reset(self):
+        # The inputs from position `num_emitted - padding`, the left padding included
+        self.buffer = None
+
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        buffer = F.pad(x, (self.padding, 0)) if self.buffer is None else torch.cat([self.buffer, x], dim=-1)
+        if final:
+            buffer = F.pad(buffer, (0, self.padding))
+        num_outputs = buffer.shape[-1] - self.receptive_field
+        if num_outputs <= 0:
+            self.buffer = buffer
+            return x[..., :0].new_empty((x.shape[0], self.weight.shape[0], 0))
+        y = F.conv1d(buffer, self.weight, self.bias, dilation=self.dilation)
+        self.buffer = buffer[..., num_outputs:]
+        return y
+
+
+class _StreamingConvTranspose1d(_StreamingLayer):
+    """`nn.ConvTranspose1d`. Keeps the inputs that still contribute to the outputs not emitted yet.
+
+    Output `t` is position `t + padding` of the unpadded transposed convolution, which sums the contributions of the
+    inputs `n` with `n * stride <= t + padding < n * stride + kernel_size`. It is final once the input
+    `(t + padding) // stride` is known.
+    """
+
+    def __init__(self, conv: nn.ConvTranspose1d):
+        self.kernel_size, self.stride = conv.kernel_size[0], conv.stride[0]
+        self.padding, self.output_padding = conv.padding[0], conv.output_padding[0]
+        if conv.dilation[0] != 1 or conv.groups != 1 or self.output_padding > self.padding:
+            raise ValueError(f"Cannot stream {conv}.")
+        self.weight = _conv_weight(conv)
+        self.bias = conv.bias.detach() if conv.bias is not None else None
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+        # The position of the first input of the buffer, the number of inputs and the number of outputs emitted
+        self.buffer_start = 0
+        self.num_inputs = 0
+        self.num_emitted = 0
+
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        buffer = x if self.buffer is None else torch.cat([self.buffer, x], dim=-1)
+        self.num_inputs += x.shape[-1]
+        if final:
+            end = (
+                (self.num_inputs - 1) * self.stride - 2 * self.padding + self.kernel_size + self.output_padding
+                if self.num_inputs > 0
+                else 0
+            )
+        else:
+            end = self.num_inputs * self.stride - self.padding
+        if end <= self.num_emitted:
+            self.buffer = buffer
+            return x.new_empty((x.shape[0], self.weight.shape[1], 0))
+
+        z = F.conv_transpose1d(buffer, self.weight, self.bias, stride=self.stride)
+        offset = self.padding - self.buffer_start * self.stride
+        y = z[..., self.num_emitted + offset : end + offset]
+        self.num_emitted = end
+        # Drop the inputs that do not contribute to the next outputs
+        buffer_start = max(0, math.ceil((end + self.padding - self.kernel_size + 1) / self.stride))
+        self.buffer = buffer[..., buffer_start - self.buffer_start :]
+        self.buffer_start = buffer_start
+        return y
+
+
+class _StreamingSequential(_StreamingLayer):
+    def __init__(self, layers: List[_StreamingLayer]):
+        self.layers = layers
+
+    def reset(self):
+        for layer in self.layers:
+            layer.reset()
+
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        for layer in self.layers:
+            x = layer.push(x, final)
+        return x
+
+
+class _StreamingResidualUnit(_StreamingLayer):
+    """`ResidualUnit`: the skip connection holds the inputs until the block emits the matching outputs."""
+
+    def __init__(self, block: _StreamingLayer):
+        self.block = block
+        self.reset()
+
+    def reset(self):
+        self.block.reset()
+        self.pending = None
+
+    def push(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        y = self.block.push(x, final)
+        pending = x if self.pending is None else torch.cat([self.pending, x], dim=-1)
+        self.pending = pending[..., y.shape[-1] :]
+        return pending[..., : y.shape[-1]] + y
+
+
+def _to_streaming(module: nn.Module) -> _StreamingLayer:
+    # Unwrap `torch.compile`
+    module = getattr(module, "_orig_mod", module)
+    if isinstance(module, dac2.Decoder):
+        return _to_streaming(module.model)
+    if isinstance(module, dac2.DecoderBlock):
+        return _to_streaming(module.block)
+    if isinstance(module, dac2.ResidualUnit):
+        return _StreamingResidualUnit(_to_streaming(module.block))
+    if isinstance(module, nn.Sequential):
+        return _StreamingSequential([_to_streaming(layer) for layer in module])
+    if isinstance(module, nn.ConvTranspose1d):
+        return _StreamingConvTranspose1d(module)
+    if isinstance(module, nn.Conv1d):
+        return _StreamingConv1d(module)
+    if isinstance(module, (dac2.Snake1d, nn.Identity, nn.Tanh)):
+        return _StreamingPointwise(module)
+    raise TypeError(f"Cannot stream a {type(module).__name__}.")
+
+
+class HiggsAudioStreamingDecoder:
+    """Decode the codes of a `HiggsAudioTokenizer` block by block, carrying the state of its decoder between blocks.
+
+    The acoustic decoder is a stack of non-causal convolutions, so the last samples decoded from a block of codes
+    still depend on the codes of the next blocks. Instead of decoding growing (or overlapping) windows of codes, every
+    convolution and transposed convolution keeps the left context it needs, and every residual unit the inputs of its
+    skip connection, so each code goes through the decoder once. `push` returns the samples that the later codes
+    cannot change, and `flush` the remaining ones. Their concatenation is the offline `decode` of all the codes, up to
+    the rounding of the convolutions.
+
+    The decoder must run eagerly, i.e., not be scripted by `HiggsAudioTokenizer.prepare_for_inference`.
+
+    Args:
+        audio_tokenizer (`HiggsAudioTokenizer`):
+            The audio tokenizer whose codes are decoded.
+    """
+
+    def __init__(self, audio_tokenizer):
+        self.audio_tokenizer = audio_tokenizer
+        audio_tokenizer._check_decoder()
+        if isinstance(audio_tokenizer.decoder_2, torch.jit.ScriptModule):
+            raise ValueError("Cannot stream a scripted decoder, prepare the tokenizer with another backend.")
+        self._decoder = _to_streaming(audio_tokenizer.decoder_2)
+        self.reset()
+
+    def reset(self):
+        """Start a new audio segment."""
+        self._decoder.reset()
+        self.num_codes = 0
+        self._no_latents = None
+
+    @torch.no_grad()
+    def push(self, codes: torch.LongTensor) -> np.ndarray:
+        """Add a block of codes of shape `(num_codebooks, num_frames)`.
+
+        Returns:
+            The samples that are final, possibly none.
+        """
+        self.num_codes += codes.shape[-1]
+        latents = self.audio_tokenizer._codes_to_latents(codes.unsqueeze(0).to(self.audio_tokenizer.device))
+        self._no_latents = latents[..., :0]
+        return self._decoder.push(latents, final=False)[0, 0].cpu().numpy()
+
+    @torch.no_grad()
+    def flush(self) -> np.ndarray:
+        """Return the remaining samples of the segment, and start a new one."""
+        if self.num_codes == 0:
+            self.reset()
+            return np.zeros(0, dtype=np.float32)
+        wv = self._decoder.push(self._no_latents, final=True)[0, 0].cpu().numpy()
+        self.reset()
+        return wv
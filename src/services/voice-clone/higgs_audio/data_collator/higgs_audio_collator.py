@@ -10,13 +10,36 @@ from typing import List, Optional
 from transformers.models.whisper.processing_whisper import WhisperProcessor
 
 from ..dataset.chatml_dataset import ChatMLDatasetSample, RankedChatMLDatasetSampleTuple
-from ..model.utils import build_delay_pattern_mask
+from ..model.utils import build_delay_pattern_segments
 
 
 def _ceil_to_nearest(n, round_to):
     return (n + round_to - 1) // round_to * round_to
 
 
+def _build_delay_pattern_segments_reusing(
+    segments: List[torch.LongTensor],
+    delayed_segments: List[Optional[torch.LongTensor]],
+    bos_token_id: int,
+    pad_token_id: int,
+) -> torch.LongTensor:
+    """`build_delay_pattern_segments`, reusing the segments whose delay pattern is already applied (the not None
+    `delayed_segments`) instead of building them again."""
+    if all(delayed is None for delayed in delayed_segments):
+        return build_delay_pattern_segments(segments, bos_token_id=bos_token_id, pad_token_id=pad_token_id)
+    to_build = [segment for segment, delayed in zip(segments, delayed_segments) if delayed is None]
+    built = []
+    if len(to_build) > 0:
+        built_concat = build_delay_pattern_segments(to_build, bos_token_id=bos_token_id, pad_token_id=pad_token_id)
+        num_codebooks = built_concat.shape[0]
+        built = list(built_concat.split([segment.shape[1] + num_codebooks - 1 for segment in to_build], dim=1))
+    built = iter(built)
+    return torch.cat(
+        [delayed.to(segments[0].device) if delayed is not None else next(built) for delayed in delayed_segments],
+        dim=1,
+    )
+
+
 @dataclass
 class HiggsAudioBatchInput:
     input_ids: torch.LongTensor  # shape (bsz, seq_len).
@@ -237,6 +260,7 @@ class HiggsAudioSampleCollator:
                     audio_speaker_indices=torch.tensor([]),
                     # FIXME(sxjscience): The logic here is not correct for audio_label_ids_concat.
                     audio_label_ids_concat=sample.audio_label_ids_concat,
+                    audio_ids_delayed=sample.audio_ids_delayed,
                 )
                 # audio_in_chunk_len = len(torch.where(modified_input_ids == self.audio_in_token_id)[0])
                 # assert audio_in_chunk_len == processed_sample.num_audios(), f"Mismatch: audio_in_chunk_len={audio_in_chunk_len}, processed_sample.num_audios()={processed_sample.num_audios()}"
@@ -250,7 +274,9 @@ class HiggsAudioSampleCollator:
         # Get the ids for audio-in and audio-out for each batch
         audio_in_wv_l = []
         audio_in_ids_l = []
+        audio_in_delayed_ids_l = []
         audio_out_ids_l = []
+        audio_out_delayed_ids_l = []
         audio_out_ids_group_loc_l = []
         audio_in_label_ids_l = None
         audio_out_label_ids_l = None
@@ -278,6 +304,9 @@ class HiggsAudioSampleCollator:
                 audio_in_ids_l.extend(
                     [processed_batch[i].get_audio_codes(idx)[: self.audio_num_codebooks, :] for idx in audio_in_ids]
                 )
+                audio_in_delayed_ids_l.extend(
+                    [processed_batch[i].get_audio_codes_delayed(idx) for idx in audio_in_ids]
+                )
                 if processed_batch[i].audio_label_ids_concat is not None:
                     if audio_in_label_ids_l is None:
                         audio_in_label_ids_l = []
@@ -291,6 +320,7 @@ class HiggsAudioSampleCollator:
             audio_out_ids_l.extend(
                 [processed_batch[i].get_audio_codes(idx)[: self.audio_num_codebooks, :] for idx in audio_out_ids]
             )
+            audio_out_delayed_ids_l.extend([processed_batch[i].get_audio_codes_delayed(idx) for idx in audio_out_ids])
             audio_out_ids_group_loc_l.append(i)
             if processed_batch[i].reward is not None:
                 reward_l.append(processed_batch[i].reward)
@@ -376,18 +406,20 @@ class HiggsAudioSampleCollator:
                         ],
                         dim=1,
                     )
-                    if self.use_delay_pattern:
-                        audio_codes = build_delay_pattern_mask(
-                            audio_codes.unsqueeze(0),
-                            bos_token_id=self.audio_stream_bos_id,
-                            pad_token_id=self.audio_stream_eos_id,
-                        )[0].squeeze(0)
                 new_audio_in_ids_l.append(audio_codes)
-            audio_in_ids = torch.cat(new_audio_in_ids_l, dim=1).long()
-            audio_in_ids_start = torch.cumsum(
-                torch.tensor([0] + [audio_codes.shape[1] for audio_codes in new_audio_in_ids_l[:-1]]),
-                dim=0,
-            )
+            audio_in_ids_len_l = [audio_codes.shape[1] for audio_codes in new_audio_in_ids_l]
+            if self.use_delay_pattern and not self.disable_audio_codes_transform:
+                # Apply the delay pattern to all the segments at once
+                audio_in_ids = _build_delay_pattern_segments_reusing(
+                    new_audio_in_ids_l,
+                    audio_in_delayed_ids_l,
+                    bos_token_id=self.audio_stream_bos_id,
+                    pad_token_id=self.audio_stream_eos_id,
+                ).long()
+                audio_in_ids_len_l = [length + audio_in_ids.shape[0] - 1 for length in audio_in_ids_len_l]
+            else:
+                audio_in_ids = torch.cat(new_audio_in_ids_l, dim=1).long()
+            audio_in_ids_start = torch.cumsum(torch.tensor([0] + audio_in_ids_len_l[:-1]), dim=0)
         else:
             audio_in_ids = torch.zeros((0, 0), dtype=torch.long)
             audio_in_ids_start = torch.zeros(0, dtype=torch.long)
@@ -434,18 +466,6 @@ class HiggsAudioSampleCollator:
                             ],
                             dim=1,
                         )
-                    if self.use_delay_pattern:
-                        audio_codes = build_delay_pattern_mask(
-                            audio_codes.unsqueeze(0),
-                            bos_token_id=self.audio_stream_bos_id,
-                            pad_token_id=self.audio_stream_eos_id,
-                        )[0].squeeze(0)
-                        if return_labels:
-                            label_audio_ids = build_delay_pattern_mask(
-                                label_audio_ids.unsqueeze(0),
-                                bos_token_id=-100,
-                                pad_token_id=-100,
-                            )[0].squeeze(0)
                 new_audio_out_ids_l.append(audio_codes)
 
                 if return_labels:
@@ -453,13 +473,27 @@ class HiggsAudioSampleCollator:
                         label_audio_ids[:] = -100
                     label_audio_ids_l.append(label_audio_ids)
 
-            audio_out_ids = torch.cat(new_audio_out_ids_l, dim=1).long()
-            if return_labels:
-                label_audio_ids = torch.cat(label_audio_ids_l, dim=1).long()
-            audio_out_ids_start = torch.cumsum(
-                torch.tensor([0] + [audio_codes.shape[1] for audio_codes in new_audio_out_ids_l[:-1]]),
-                dim=0,
-            )
+            audio_out_ids_len_l = [audio_codes.shape[1] for audio_codes in new_audio_out_ids_l]
+            if self.use_delay_pattern and not self.disable_audio_codes_transform:
+                # Apply the delay pattern to all the segments at once
+                audio_out_ids = _build_delay_pattern_segments_reusing(
+                    new_audio_out_ids_l,
+                    audio_out_delayed_ids_l,
+                    bos_token_id=self.audio_stream_bos_id,
+                    pad_token_id=self.audio_stream_eos_id,
+                ).long()
+                if return_labels:
+                    label_audio_ids = build_delay_pattern_segments(
+                        label_audio_ids_l,
+                        bos_token_id=-100,
+                        pad_token_id=-100,
+                    ).long()
+                audio_out_ids_len_l = [length + audio_out_ids.shape[0] - 1 for length in audio_out_ids_len_l]
+            else:
+                audio_out_ids = torch.cat(new_audio_out_ids_l, dim=1).long()
+                if return_labels:
+                    label_audio_ids = torch.cat(label_audio_ids_l, dim=1).long()
+            audio_out_ids_start = torch.cumsum(torch.tensor([0] + audio_out_ids_len_l[:-1]), dim=0)
             audio_out_ids_start_group_loc = torch.tensor(audio_out_ids_group_loc_l, dtype=torch.long)
         else:
             audio_out_ids = torch.zeros((0, 0), dtype=torch.long)
@@ -13,12 +13,16 @@ class AudioContent:
     duration: Optional[float] = None
     row_id: Optional[int] = None
     type: str = "audio"
+    # Id of a voice of a `VoiceLibrary`, whose precomputed codes are used instead of the audio
+    voice_id: Optional[str] = None
 
 
 @dataclass
 class TextContent:
     text: str
     type: str = "text"
+    # Token ids of the text, e.g., a transcript tokenized ahead of time, used instead of tokenizing the text
+    token_ids: Optional[List[int]] = None
 
 
 @dataclass
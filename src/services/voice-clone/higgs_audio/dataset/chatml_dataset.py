@@ -44,6 +44,9 @@ class ChatMLDatasetSample:
     )
     # Here `audio_seq_len` is the length of the concatenated audio tokens.`
     reward: Optional[float] = None
+    # The audio segments with the stream bos and eos tokens and the delay pattern already applied, one per audio,
+    # e.g., the ones of a `VoiceLibrary`. The collator builds the segments that are None.
+    audio_ids_delayed: Optional[List[Optional[torch.LongTensor]]] = None
 
     def num_audios(self):
         return max(len(self.audio_waveforms_start), len(self.audio_ids_start))
@@ -57,6 +60,11 @@ class ChatMLDatasetSample:
 
         return self.audio_ids_concat[:, code_start:code_end]
 
+    def get_audio_codes_delayed(self, idx):
+        if self.audio_ids_delayed is None:
+            return None
+        return self.audio_ids_delayed[idx]
+
     def get_audio_codes_labels(self, idx):
         if self.audio_label_ids_concat is None:
             return None
@@ -417,7 +425,10 @@ def prepare_chatml_sample(sample: Union[ChatMLSample, Dict], tokenizer):
 
             for content in content_l:
                 if content.type == "text":
-                    text_tokens = tokenizer.encode(content.text, add_special_tokens=False)
+                    if content.token_ids is not None:
+                        text_tokens = list(content.token_ids)
+                    else:
+                        text_tokens = tokenizer.encode(content.text, add_special_tokens=False)
                     input_tokens.extend(text_tokens)
                     if role == "assistant" and (sample.start_index is None or turn_id >= sample.start_index):
                         label_tokens.extend(text_tokens)
@@ -51,6 +51,9 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
         output_hidden_states=None,
         output_audio_hidden_states=False,
         cache_position=None,
+        compute_text_logits=True,
+        compute_audio_logits=True,
+        num_logits_to_keep=0,
     ):
         """
         Args:
@@ -64,15 +67,24 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
                 Mask to avoid performing attention on padding token indices
             position_ids (`torch.Tensor` of shape `(batch_size, seq_len)`):
                 Position ids for the input tokens
+            compute_text_logits (`bool`):
+                Whether to apply the text head. During generation, the text logits are not needed while decoding audio
+                tokens.
+            compute_audio_logits (`bool`):
+                Whether to apply the audio head. During generation, the audio logits are only needed while decoding
+                audio tokens.
+            num_logits_to_keep (`int`):
+                Only compute the logits of the last `num_logits_to_keep` positions. During generation, only the last
+                position is sampled, and projecting a long prompt onto the text vocabulary dominates the prefill.
+                The logits of all the positions are computed if 0.
 
         Returns:
             logits (`torch.Tensor` of shape `(batch_size, seq_len, vocab_size)`):
-                Logits for text tokens
+                Logits for text tokens. None if `compute_text_logits` is False.
             audio_logits (`torch.Tensor` of shape `(num_audio_out_tokens, audio_num_codebooks * audio_codebook_size)`):
-                Logits for audio tokens. We ensure `num_text_tokens + num_audio_tokens == batch_size * seq_len`
+                Logits for audio tokens. We ensure `num_text_tokens + num_audio_tokens == batch_size * seq_len`. None if
+                `compute_audio_logits` is False.
         """
-        logits = self.text_lm_head(hidden_states)
-
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
@@ -122,7 +134,13 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
 
         next_cache = next_decoder_cache if use_cache else None
 
-        audio_logits = self.audio_lm_head(hidden_states[audio_out_mask])
+        # The transformer layers above need all the positions, the heads only the kept ones
+        kept_hidden_states, kept_audio_out_mask = hidden_states, audio_out_mask
+        if num_logits_to_keep > 0:
+            kept_hidden_states = hidden_states[:, -num_logits_to_keep:]
+            kept_audio_out_mask = audio_out_mask[:, -num_logits_to_keep:]
+        logits = self.text_lm_head(kept_hidden_states) if compute_text_logits else None
+        audio_logits = self.audio_lm_head(kept_hidden_states[kept_audio_out_mask]) if compute_audio_logits else None
 
         if output_audio_hidden_states:
             audio_hidden_states = hidden_states[audio_out_mask]
@@ -0,0 +1,194 @@
+"""Sampling of the audio tokens of all the codebooks of a decoding step in a single pass."""
+
+import torch
+from typing import List, Optional, Tuple, Union
+from transformers.generation import LogitsProcessorList
+from transformers.generation.logits_process import (
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+class RepetitionWindow:
+    """Counts of the audio tokens of each codebook over the last `window_len` generated positions.
+
+    Used by the repetition aware sampling: instead of comparing the sampled tokens to the last `window_len` columns
+    of the audio tokens at every step, the tokens of the window are kept in a ring buffer and their counts in a
+    `(num_codebooks, vocab_size)` table, so a step is one lookup, one increment and one decrement per codebook.
+
+    Args:
+        initial (`torch.LongTensor` of shape `(..., num_codebooks, num_positions)`):
+            The audio tokens generated so far. The last `window_len` positions fill the window. The leading dimensions
+            are the batch dimensions, if any.
+        window_len (`int`):
+            The number of positions in the window.
+        vocab_size (`int`):
+            The size of the vocabulary of a codebook, the stream bos and eos tokens included.
+    """
+
+    def __init__(self, initial: torch.LongTensor, window_len: int, vocab_size: int):
+        self.window_len = window_len
+        initial = initial[..., -window_len:]
+        self.tokens = initial.new_zeros((*initial.shape[:-1], window_len))
+        self.counts = initial.new_zeros((*initial.shape[:-1], vocab_size))
+        self.tokens[..., : initial.shape[-1]] = initial
+        self.counts.scatter_add_(-1, initial, torch.ones_like(initial))
+        self.length = initial.shape[-1]
+        self._ones = initial.new_ones((*initial.shape[:-1], 1))
+
+    def count(self, tokens: torch.LongTensor) -> torch.LongTensor:
+        """The number of occurrences in the window of `tokens`, of shape `(..., num_codebooks)`."""
+        return self.counts.gather(-1, tokens.unsqueeze(-1)).squeeze(-1)
+
+    def push(self, tokens: torch.LongTensor):
+        """Add the tokens of a new position, of shape `(..., num_codebooks)`, dropping the oldest one if needed."""
+        slot = self.length % self.window_len
+        if self.length >= self.window_len:
+            self.counts.scatter_add_(-1, self.tokens[..., slot : slot + 1], -self._ones)
+        self.tokens[..., slot] = tokens
+        self.counts.scatter_add_(-1, tokens.unsqueeze(-1), self._ones)
+        self.length += 1
+
+
+class AudioTokenSampler:
+    """Sample the audio tokens of all the codebooks at once, with no data-dependent shapes.
+
+    Replaces the chain of logits warpers, the sampling, the repetition aware resampling and the forcing of the delay
+    pattern of a decoding step:
+        - The temperature, top-k and top-p warpers at the end of `logits_processor`, the ones added by `generate`, are
+          applied together, with a single `topk` (or sort, without top-k) of the scores. The processors before them
+          are applied as usual.
+        - The samples are drawn with the exponential race (`argmax(probs / noise)` with `noise ~ Exp(1)`), which is
+          equivalent to `torch.multinomial` and needs a single draw of noise for the sample and its resampling.
+        - The repetition aware resampling draws a token from the unprocessed logits for every codebook and keeps it
+          where the sampled token repeats too often in the `RepetitionWindow`, instead of gathering those codebooks.
+        - The codebooks not started yet (stream bos) or already finished (stream eos) by the delay pattern are set
+          with masks.
+
+    The results only depend on `torch_generator` when it is given. The logits can have leading batch dimensions, so
+    the same sampler serves one sequence or a batch of them.
+
+    Args:
+        logits_processor (`LogitsProcessorList`):
+            The logits processors of the generation.
+        do_sample (`bool`):
+            Whether to sample the tokens, or to take the most likely ones.
+        ras_win_max_num_repeat (`int`, *optional*, defaults to 2):
+            The number of occurrences in the repetition window from which a token is resampled.
+        audio_stream_bos_id (`int`, *optional*):
+            The audio stream bos token, forced by the delay pattern.
+        audio_stream_eos_id (`int`, *optional*):
+            The audio stream eos token, forced by the delay pattern.
+    """
+
+    def __init__(
+        self,
+        logits_processor: LogitsProcessorList,
+        do_sample: bool,
+        ras_win_max_num_repeat: int = 2,
+        audio_stream_bos_id: Optional[int] = None,
+        audio_stream_eos_id: Optional[int] = None,
+    ):
+        self.do_sample = do_sample
+        self.ras_win_max_num_repeat = ras_win_max_num_repeat
+        self.audio_stream_bos_id = audio_stream_bos_id
+        self.audio_stream_eos_id = audio_stream_eos_id
+        self.temperature = 1.0
+        self.top_k: Optional[int] = None
+        self.top_p: Optional[float] = None
+        self.min_tokens_to_keep = 1
+
+        # Fuse the warpers at the end of the list, in the order `generate` adds them
+        processors = list(logits_processor)
+        if processors and type(processors[-1]) is TopPLogitsWarper and processors[-1].filter_value == -float("inf"):
+            self.top_p = processors[-1].top_p
+            self.min_tokens_to_keep = processors.pop().min_tokens_to_keep
+        if processors and type(processors[-1]) is TopKLogitsWarper and processors[-1].filter_value == -float("inf"):
+            self.top_k = processors.pop().top_k
+        if processors and type(processors[-1]) is TemperatureLogitsWarper:
+            self.temperature = processors.pop().temperature
+        self.logits_processor = LogitsProcessorList(processors)
+
+    def warp(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        """Apply the temperature, top-k and top-p to the scores."""
+        if self.temperature != 1.0:
+            scores = scores / self.temperature
+        vocab_size = scores.shape[-1]
+        if self.top_p is None and (self.top_k is None or self.top_k >= vocab_size):
+            return scores
+
+        # The top-p filter only needs the candidates kept by top-k, in decreasing order
+        if self.top_k is not None and self.top_k < vocab_size:
+            kept_scores, kept_indices = torch.topk(scores, self.top_k, dim=-1)
+        else:
+            kept_scores, kept_indices = torch.sort(scores, dim=-1, descending=True)
+        if self.top_p is not None:
+            # Remove the tokens that come after the most likely ones that add up to `top_p`
+            kept_probs = kept_scores.softmax(dim=-1)
+            probs_before = kept_probs.cumsum(dim=-1) - kept_probs
+            rank = torch.arange(kept_scores.shape[-1], device=scores.device)
+            kept_scores = kept_scores.masked_fill(
+                (probs_before >= self.top_p) & (rank >= self.min_tokens_to_keep), -float("inf")
+            )
+        return torch.full_like(scores, -float("inf")).scatter(-1, kept_indices, kept_scores)
+
+    def sample(
+        self,
+        logits: torch.FloatTensor,
+        torch_generator: Optional[torch.Generator] = None,
+        repetition_window: Optional[Union[RepetitionWindow, List[RepetitionWindow]]] = None,
+        num_delay: Optional[Union[int, torch.LongTensor]] = None,
+        num_remaining_delays: Optional[Union[int, torch.LongTensor]] = None,
+    ) -> Tuple[torch.LongTensor, torch.FloatTensor]:
+        """Sample the audio tokens of a decoding step.
+
+        Args:
+            logits (`torch.FloatTensor` of shape `(..., num_codebooks, vocab_size)`):
+                The audio logits of the step.
+            torch_generator (`torch.Generator`, *optional*):
+                The generator of the random draws.
+            repetition_window (`RepetitionWindow` or `List[RepetitionWindow]`, *optional*):
+                The tokens of the last steps. If given, the tokens that occur `ras_win_max_num_repeat` times or more
+                in it are resampled from the unprocessed logits. A batch of sequences can pass the window of every
+                row, for logits of shape `(batch_size, num_codebooks, vocab_size)`.
+            num_delay (`int` or `torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The index of the last codebook started by the delay pattern. The codebooks after it are set to the
+                audio stream bos token.
+            num_remaining_delays (`int` or `torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The number of codebooks that have not emitted the audio stream eos token yet. The codebooks before
+                them are set to the audio stream eos token.
+
+        Returns:
+            The tokens of shape `(..., num_codebooks)`, and the processed scores they were sampled from.
+        """
+        scores = self.warp(self.logits_processor(None, logits))
+
+        num_draws = int(self.do_sample) + int(repetition_window is not None)
+        if num_draws > 0:
+            noise = torch.empty((num_draws, *logits.shape), dtype=torch.float32, device=logits.device)
+            # A zero would turn the masked tokens into NaN, which `argmax` picks
+            noise.exponential_(generator=torch_generator).clamp_min_(torch.finfo(torch.float32).tiny)
+        if self.do_sample:
+            tokens = torch.argmax(scores.softmax(dim=-1) / noise[0], dim=-1)
+        else:
+            tokens = torch.argmax(scores, dim=-1)
+        if repetition_window is not None:
+            resampled_tokens = torch.argmax(logits.softmax(dim=-1) / noise[-1], dim=-1)
+            if isinstance(repetition_window, RepetitionWindow):
+                counts = repetition_window.count(tokens)
+            else:
+                counts = torch.stack([window.count(row) for window, row in zip(repetition_window, tokens)])
+            is_repeated = counts >= self.ras_win_max_num_repeat
+            tokens = torch.where(is_repeated, resampled_tokens, tokens)
+
+        codebook = torch.arange(logits.shape[-2], device=logits.device)
+        if num_delay is not None:
+            if isinstance(num_delay, torch.Tensor):
+                num_delay = num_delay.unsqueeze(-1)
+            tokens = tokens.masked_fill(codebook > num_delay, self.audio_stream_bos_id)
+        if num_remaining_delays is not None:
+            if isinstance(num_remaining_delays, torch.Tensor):
+                num_remaining_delays = num_remaining_delays.unsqueeze(-1)
+            tokens = tokens.masked_fill(codebook < logits.shape[-2] - num_remaining_delays, self.audio_stream_eos_id)
+        return tokens, scores
@@ -0,0 +1,51 @@
+"""Preallocated tensor filled column by column, used for the per-sequence state of the decoding loop."""
+
+import torch
+from typing import Union
+
+
+class ColumnBuffer:
+    """2D tensor that grows by columns, e.g., the tokens generated so far, without being reallocated at every step.
+
+    The columns are written in place after the last filled one, where `torch.cat` would allocate and copy the whole
+    tensor at every decoding step. `view` returns the filled columns without copying them. The views stay valid after
+    later appends, since the filled columns are never written again.
+
+    Args:
+        initial (`torch.Tensor` of shape `(num_rows, num_columns)`):
+            The first columns. The buffer has the same dtype and device.
+        num_reserved (`int`):
+            The number of columns preallocated past the initial ones, e.g., the maximum number of decoding steps.
+            When an append does not fit, the buffer is reallocated with `num_reserved` free columns past the appended
+            ones, or with twice its capacity if that is larger.
+    """
+
+    def __init__(self, initial: torch.Tensor, num_reserved: int):
+        self.num_reserved = max(num_reserved, 1)
+        self.length = initial.shape[1]
+        self.data = initial.new_empty((initial.shape[0], self.length + self.num_reserved))
+        self.data[:, : self.length] = initial
+
+    def _grow(self, num_columns: int) -> int:
+        end = self.length + num_columns
+        if end > self.data.shape[1]:
+            data = self.data.new_empty((self.data.shape[0], max(end + self.num_reserved, 2 * self.data.shape[1])))
+            data[:, : self.length] = self.data[:, : self.length]
+            self.data = data
+        return end
+
+    def append(self, columns: torch.Tensor):
+        """Append the columns of a tensor of shape `(num_rows, num_columns)`."""
+        end = self._grow(columns.shape[1])
+        self.data[:, self.length : end] = columns
+        self.length = end
+
+    def append_constant(self, value: Union[int, float, bool], num_columns: int = 1):
+        """Append `num_columns` columns filled with `value`."""
+        end = self._grow(num_columns)
+        self.data[:, self.length : end] = value
+        self.length = end
+
+    def view(self) -> torch.Tensor:
+        """The filled columns, of shape `(num_rows, length)`."""
+        return self.data[:, : self.length]
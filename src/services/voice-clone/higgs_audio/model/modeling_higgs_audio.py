@@ -7,7 +7,7 @@ import glob
 import functools
 import os
 from collections import defaultdict, OrderedDict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from safetensors.torch import load_file
 from typing import Optional, Tuple, Union, List, Dict, Any
@@ -31,6 +31,12 @@ from transformers.generation import (
     LogitsProcessorList,
     StoppingCriteriaList,
 )
+from transformers.generation.logits_process import (
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.stopping_criteria import EosTokenCriteria, MaxLengthCriteria
 from transformers.generation.utils import GenerateNonBeamOutput
 from transformers.utils import logging, ModelOutput
 
@@ -43,6 +49,10 @@ from .configuration_higgs_audio import HiggsAudioConfig, HiggsAudioEncoderConfig
 from .custom_modules import PartiallyFrozenLinear, PartiallyFrozenEmbedding
 from .cuda_graph_runner import CUDAGraphRunner
 from .audio_head import HiggsAudioDecoderProjector
+from .paged_kv_cache import PagedKVCache, PagedKVCacheBatch
+from .static_kv_cache import LazyResetStaticCache, StaticKVCacheMasks
+from .column_buffer import ColumnBuffer
+from .audio_sampler import AudioTokenSampler, RepetitionWindow
 
 logger = logging.get_logger(__name__)
 
@@ -835,6 +845,101 @@ class HiggsAudioGenerationOutput(ModelOutput):
     past_key_values: Optional[Tuple[Tuple[Tuple[torch.FloatTensor]]]] = None
 
 
+@dataclass
+class HiggsAudioDecodeState:
+    """
+    Per-sequence state of the decoding loop in `HiggsAudioModel._sample`.
+
+    The tokens and masks that grow at every step are kept in preallocated `ColumnBuffer`s, and the values that drive
+    the control flow of the loop (the last token, the start of the current audio segment, whether the sequence is
+    finished) are tracked on the host, so a decoding step does not reallocate the sequence. The cache position of a
+    decoding step is built from the length of `audio_discrete_codes_mask_buffer`, and the paged and lazily reset KV
+    caches count their positions on the host, so the length of the cache is not read from the device either.
+
+    A step still reads back:
+        - the sampled text token in text mode.
+        - the sampled codes in audio mode, until a codebook emits the audio stream eos.
+        - the result of the stopping criteria that return tensors, e.g., the stop strings.
+        - the merged length and the leading padding of the step in `merge_input_ids_with_audio_features`.
+
+    Args:
+        input_ids_buffer (`ColumnBuffer` of shape `(1, sequence_length)`):
+            The text tokens generated so far. Consecutive <|AUDIO_OUT|> tokens are collapsed into one.
+        input_ids_full_buffer (`ColumnBuffer` of shape `(1, sequence_length)`):
+            All the text tokens generated so far, including every <|AUDIO_OUT|> placeholder.
+        model_kwargs (`dict`):
+            The kwargs forwarded to `HiggsAudioModel.forward`, e.g., `audio_out_ids` and `attention_mask`. The growing
+            ones are views of the buffers below.
+        last_token_id (`int`):
+            The last token of `input_ids`, which determines the generation mode of the next step.
+        cur_len (`int`):
+            The length of the sequence stored in the KV cache.
+        audio_out_ids_buffer (`ColumnBuffer` of shape `(num_codebooks, audio_length)`):
+            All the audio-out codes, from the prompt and generated.
+        attention_mask_buffer (`ColumnBuffer` of shape `(1, sequence_length)`, *optional*):
+            The attention mask of the text tokens, if any.
+        audio_discrete_codes_mask_buffer (`ColumnBuffer` of shape `(1, cur_len)`, *optional*):
+            The mask of the audio positions in the KV cache, passed as `cache_audio_discrete_codes_mask`. Only used
+            with `use_cache`.
+        audio_segment_start (`int`):
+            The start of the last audio segment in `audio_out_ids`.
+        audio_sequences (`list[torch.LongTensor]`):
+            The generated audio codes. Each element has shape `(num_codebooks, audio_length)`.
+        static_kv_cache_masks (`StaticKVCacheMasks`):
+            The attention masks of the last decoding step, updated in place by the next one with a static cache.
+        audio_sampler (`AudioTokenSampler`, *optional*):
+            The sampler of the audio tokens, created at the first audio step from the logits processors.
+        audio_repetition_window (`RepetitionWindow`, *optional*):
+            The last `ras_win_len` columns of `audio_out_ids`, if the repetition aware sampling is enabled.
+        torch_generator (`torch.Generator`, *optional*):
+            The generator used for sampling when a seed is provided.
+        generation_mode (`GenerationMode`):
+            The mode of the last decoding step.
+        num_delay (`int`):
+            The number of codebooks that have left the delay pattern bos region.
+        num_remaining_delays (`int`, *optional*):
+            The number of codebooks that still need to emit the audio stream eos token.
+        init_model_input (`bool`):
+            Whether the next step is the prefill step.
+        past_key_values_bucket (`int`, *optional*):
+            The length of the KV cache bucket currently used by the sequence.
+        eos_token_ids (`List[int]`, *optional*):
+            The eos tokens of the `EosTokenCriteria`, read once at the first step.
+        this_peer_finished (`bool`):
+            Whether one of the stopping criteria has been met.
+    """
+
+    input_ids_buffer: ColumnBuffer
+    input_ids_full_buffer: ColumnBuffer
+    model_kwargs: Dict[str, Any]
+    last_token_id: int
+    cur_len: int
+    audio_out_ids_buffer: ColumnBuffer
+    attention_mask_buffer: Optional[ColumnBuffer] = None
+    audio_discrete_codes_mask_buffer: Optional[ColumnBuffer] = None
+    audio_segment_start: int = 0
+    audio_sequences: List[torch.LongTensor] = field(default_factory=list)
+    static_kv_cache_masks: StaticKVCacheMasks = field(default_factory=StaticKVCacheMasks)
+    audio_sampler: Optional[AudioTokenSampler] = None
+    audio_repetition_window: Optional[RepetitionWindow] = None
+    torch_generator: Optional[torch.Generator] = None
+    generation_mode: GenerationMode = GenerationMode.TEXT
+    num_delay: int = 0
+    num_remaining_delays: Optional[int] = None
+    init_model_input: bool = True
+    past_key_values_bucket: Optional[int] = None
+    eos_token_ids: Optional[List[int]] = None
+    this_peer_finished: bool = False
+
+    @property
+    def input_ids(self) -> torch.LongTensor:
+        return self.input_ids_buffer.view()
+
+    @property
+    def input_ids_full(self) -> torch.LongTensor:
+        return self.input_ids_full_buffer.view()
+
+
 class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
     """Higgs-Audio is an end-to-end multimodal model with the capability to understand and generate text / audio.
 
@@ -1155,8 +1260,12 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
     ):
         # create position embeddings to be shared across the decoder layers
         # When past_key_values is passed in, we need to offset the position ids when calculating the position embeddings.
-        # Therefore, cache_position is used.
-        position_id_offset = cache_position[0] if use_cache else 0
+        # Therefore, cache_position is used. A batched decoding step has one position per row, of shape
+        # (batch_size, 1).
+        if use_cache:
+            position_id_offset = cache_position if cache_position.dim() == 2 else cache_position[0]
+        else:
+            position_id_offset = 0
         position_embeddings = self.rotary_emb(hidden_states, position_ids + position_id_offset)
 
         # decoder layers
@@ -1225,6 +1334,9 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         cache_audio_discrete_codes_mask: Optional[torch.LongTensor] = None,
         past_key_values_buckets: Optional[OrderedDict[int, Cache]] = None,
         reward: Optional[torch.FloatTensor] = None,
+        generation_mode: Optional[GenerationMode] = None,
+        num_logits_to_keep: int = 0,
+        static_kv_cache_masks: Optional[StaticKVCacheMasks] = None,
     ):
         """Forward pass for the Higgs-Audio model.
 
@@ -1273,6 +1385,17 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 The cached audio discrete codes mask. It will only be used when use_cache is turned on.
             past_key_values_buckets (:obj:`OrderedDict`):
                 The buckets of past key values.
+            generation_mode (:obj:`GenerationMode`):
+                The generation mode of the step, used to only compute the logits that will be sampled: the audio
+                logits in `AUDIO_IN_PROGRESS` mode, the text logits otherwise. Both are computed if not set. With a
+                static cache, it also tells whether a decoding step decodes an audio token.
+            num_logits_to_keep (:obj:`int`):
+                Only compute the logits of the last `num_logits_to_keep` positions, e.g., 1 during generation, where
+                only the last position is sampled. The logits of all the positions are computed if 0.
+            static_kv_cache_masks (:obj:`StaticKVCacheMasks`):
+                The attention masks of the previous decoding step of the sequence, with a static cache. The forward
+                pass builds them if needed, and the next decoding steps, with `generation_mode` set, only update the
+                column of their position instead of building the masks over the whole cache.
         """
         target_device = input_ids.device
 
@@ -1347,14 +1470,36 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         # re-check if we use the correct kv cache bucket after
         # the input_embeds has been merged with audio features
-        if past_key_values_buckets is not None and inputs_embeds.shape[1] > past_key_values.get_max_cache_shape():
-            past_key_values, self.current_past_key_values_bucket = self._prepare_kv_cache(
-                inputs_embeds.shape[1], None, past_key_values_buckets
-            )
+        if (
+            past_key_values_buckets is not None
+            and not isinstance(past_key_values, PagedKVCache)
+            and inputs_embeds.shape[1] > past_key_values.get_max_cache_shape()
+        ):
+            past_key_values, _ = self._prepare_kv_cache(inputs_embeds.shape[1], None, past_key_values_buckets)
 
         if use_cache and past_key_values is None:
             past_key_values = DynamicCache()
 
+        if isinstance(past_key_values, (PagedKVCache, LazyResetStaticCache)):
+            # Both caches count their positions on the host, so the new ones are recorded without a device read, also
+            # when `cache_position` is given. The new positions follow the cached ones.
+            num_cached_tokens = past_key_values.get_seq_length()
+            if isinstance(past_key_values, PagedKVCache):
+                # Take the pages of the new positions before the attention masks are sized to the cache
+                past_key_values.reserve(num_cached_tokens + inputs_embeds.shape[1])
+            else:
+                past_key_values.mark_written(num_cached_tokens + inputs_embeds.shape[1])
+            if cache_position is None:
+                cache_position = torch.arange(
+                    num_cached_tokens, num_cached_tokens + inputs_embeds.shape[1], device=inputs_embeds.device
+                )
+            if num_cached_tokens >= past_key_values.get_max_cache_shape():
+                raise ValueError(
+                    f"The current sequence length ({num_cached_tokens}) exceeds "
+                    f"the maximum cache shape. "
+                    f"Please consider increasing the cache size."
+                )
+
         if cache_position is None:
             past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
             cache_position = torch.arange(
@@ -1371,26 +1516,46 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         # Use torch compile
         use_static_cache = isinstance(past_key_values, StaticCache)
-
-        # Apply the LLM component
-        causal_mask = self._update_causal_mask(
-            attention_mask,
-            inputs_embeds,
-            cache_position,
-            past_key_values,
-            output_attentions,
+        # The decoding steps update the masks of the previous step instead of building them over the whole cache
+        update_static_kv_cache_masks = (
+            use_static_cache
+            and static_kv_cache_masks is not None
+            and static_kv_cache_masks.is_built
+            and generation_mode is not None
+            and inputs_embeds.shape[1] == 1
         )
 
         hidden_states = inputs_embeds
 
-        audio_discrete_codes_mask = audio_in_discrete_codes_mask | audio_out_mask
-        if cache_audio_discrete_codes_mask is not None and use_cache:
-            audio_discrete_codes_mask = torch.concat(
-                [cache_audio_discrete_codes_mask, audio_discrete_codes_mask], dim=1
+        if update_static_kv_cache_masks:
+            if static_kv_cache_masks.max_cache_len != past_key_values.get_max_cache_shape():
+                # The sequence was promoted to another bucket
+                static_kv_cache_masks.resize(past_key_values.get_max_cache_shape())
+            is_decoding_audio_token = generation_mode == GenerationMode.AUDIO_IN_PROGRESS
+            causal_mask, fast_forward_attention_mask, audio_attention_mask = static_kv_cache_masks.step(
+                cache_position, is_decoding_audio_token
             )
+            audio_discrete_codes_mask = (audio_in_discrete_codes_mask | audio_out_mask).reshape((-1, 1))
+        else:
+            # Apply the LLM component
+            causal_mask = self._update_causal_mask(
+                attention_mask,
+                inputs_embeds,
+                cache_position,
+                past_key_values,
+                output_attentions,
+            )
+
+            audio_discrete_codes_mask = audio_in_discrete_codes_mask | audio_out_mask
+            if cache_audio_discrete_codes_mask is not None and use_cache:
+                audio_discrete_codes_mask = torch.concat(
+                    [cache_audio_discrete_codes_mask, audio_discrete_codes_mask], dim=1
+                )
 
         # Generate the audio attention mask outside the layer to avoid recompilation
-        if use_static_cache:
+        if use_static_cache and not update_static_kv_cache_masks:
+            if static_kv_cache_masks is not None:
+                static_kv_cache_masks.build(causal_mask, audio_discrete_codes_mask)
             fast_forward_attention_mask, audio_attention_mask = self._prepare_all_static_kv_cache_masks(
                 hidden_states,
                 causal_mask,
@@ -1401,16 +1566,26 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             if hidden_states.shape[1] == 1:
                 audio_discrete_codes_mask = audio_discrete_codes_mask[:, -1:]
                 audio_discrete_codes_mask = audio_discrete_codes_mask.reshape((-1, 1)).contiguous()
-                is_decoding_audio_token = audio_discrete_codes_mask.item()
+                if generation_mode is not None:
+                    # Known by the decoding loop, which saves reading the mask back from the device
+                    is_decoding_audio_token = generation_mode == GenerationMode.AUDIO_IN_PROGRESS
+                else:
+                    is_decoding_audio_token = audio_discrete_codes_mask.item()
             else:
                 is_decoding_audio_token = False
 
         # Use the captured cuda graph runner for decoding
-        # if it exists, otherwise use the normal forward pass
+        # if it exists, otherwise use the normal forward pass.
+        # The graphs are bound to the cache they were captured with, which matters when several
+        # sets of KV cache buckets with the same lengths are used for interleaved decoding.
         if (
             past_key_values is not None
             and past_key_values.get_max_cache_shape() in self.decode_graph_runners
             and (input_ids.shape[-1] == 1)
+            and self.decode_graph_runners[past_key_values.get_max_cache_shape()][
+                is_decoding_audio_token
+            ].input_buffers["past_key_values"]
+            is past_key_values
         ):
             _forward_core = self.decode_graph_runners[past_key_values.get_max_cache_shape()][is_decoding_audio_token]
             is_using_cuda_graph = True
@@ -1458,6 +1633,9 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             output_attentions=output_attentions,
             output_audio_hidden_states=output_audio_hidden_states,
             cache_position=cache_position,
+            compute_text_logits=generation_mode != GenerationMode.AUDIO_IN_PROGRESS,
+            compute_audio_logits=generation_mode is None or generation_mode == GenerationMode.AUDIO_IN_PROGRESS,
+            num_logits_to_keep=num_logits_to_keep,
         )
 
         if audio_logits is not None:
@@ -1542,13 +1720,21 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         if self.config.audio_dual_ffn_layers is not None:
             num_layers += len(self.config.audio_dual_ffn_layers)
         """ Copy the key-value pairs from one cache to another. """
+        from_cache_size = from_cache.get_max_cache_shape()
+        assert to_cache.get_max_cache_shape() >= from_cache_size, (
+            f"The target cache size {to_cache.get_max_cache_shape()} is smaller than the source cache size {from_cache_size}."
+        )
+        # Past the positions written into the source cache, both caches only hold zeros
+        if isinstance(from_cache, LazyResetStaticCache) and isinstance(to_cache, LazyResetStaticCache):
+            from_cache_size = from_cache.num_written
+            to_cache.mark_written(from_cache_size)
         for layer_idx in range(num_layers):
-            from_cache_size = from_cache.get_max_cache_shape()
-            assert to_cache.get_max_cache_shape() >= from_cache_size, (
-                f"The target cache size {to_cache.get_max_cache_shape()} is smaller than the source cache size {from_cache_size}."
-            )
-            to_cache.key_cache[layer_idx][:, :, :from_cache_size, :] = from_cache.key_cache[layer_idx]
-            to_cache.value_cache[layer_idx][:, :, :from_cache_size, :] = from_cache.value_cache[layer_idx]
+            to_cache.key_cache[layer_idx][:, :, :from_cache_size, :] = from_cache.key_cache[layer_idx][
+                :, :, :from_cache_size, :
+            ]
+            to_cache.value_cache[layer_idx][:, :, :from_cache_size, :] = from_cache.value_cache[layer_idx][
+                :, :, :from_cache_size, :
+            ]
 
     def _prepare_kv_cache(
         self,
@@ -1576,90 +1762,84 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
     def _sample_audio_tokens(
         self,
-        hidden_states: torch.Tensor,
         audio_logits: torch.Tensor,
-        audio_out_ids: torch.Tensor,
-        do_sample: bool,
-        logits_processor: LogitsProcessorList,
+        sampler: AudioTokenSampler,
+        repetition_window: Optional[RepetitionWindow],
         device: torch.device,
         torch_generator: Optional[torch.Generator],
         generation_config: GenerationConfig,
         num_delay: int,
         num_remaining_delays: Optional[int],
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, int, Optional[int]]:
-        """Sample audio tokens and its corresponding text tokens from the logits"""
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, int, Optional[int], int]:
+        """Sample audio tokens and its corresponding text tokens from the logits
 
-        # parameters related to repetition aware sampling
-        ras_win_len = generation_config.generation_kwargs.get("ras_win_len", None)
-        ras_win_max_num_repeat = generation_config.generation_kwargs.get("ras_win_max_num_repeat", 2)
+        The next text token is also returned as an `int`, which is known on the host without reading `next_tokens`.
+        """
         audio_eos_token_id = generation_config.generation_kwargs.get("audio_eos_token_id", None)
         # In the audio generation mode, we sample from audio_logits and keep updating audio_out_ids.
         next_audio_token_logits = audio_logits.clone()[-1, :, :].float().to(device)
-        # TopP, TopK logits processor supports empty input_ids
-        next_audio_token_scores = logits_processor(None, next_audio_token_logits)
-
-        # token selection
-        if do_sample:
-            # next_audio_token_scores has been applied top_p, top_k, and temperature.
-            probs = nn.functional.softmax(next_audio_token_scores, dim=-1)
-            # TODO (joao): this OP throws "skipping cudagraphs due to ['incompatible ops']", find solution
-            next_audio_tokens = torch.multinomial(probs, num_samples=1, generator=torch_generator).squeeze(1)
-        else:
-            next_audio_tokens = torch.argmax(next_audio_token_scores, dim=-1)
-
-        # next_tokens: (num_codebooks, )
-        if ras_win_len is not None:
-            # check if there are repetitions over a window of tokens.
-            rep_num = (audio_out_ids[:, -ras_win_len:] == next_audio_tokens.unsqueeze(1)).sum(dim=1)
-
-            # if we saw repeated tokens in the most recent window of tokens, resample without temperature.
-            row_indices = torch.nonzero(rep_num >= ras_win_max_num_repeat).squeeze(1)
-            resampled_next_tokens = (
-                next_audio_token_logits[row_indices]
-                .softmax(dim=-1)
-                .multinomial(1, replacement=True, generator=torch_generator)
-                .squeeze(1)
-            )
-            next_audio_tokens[row_indices] = resampled_next_tokens
+        # The warpers, the repetition aware resampling and the delay pattern are applied by the sampler
+        next_audio_tokens, next_audio_token_scores = sampler.sample(
+            next_audio_token_logits,
+            torch_generator=torch_generator,
+            repetition_window=repetition_window,
+            num_delay=num_delay if self.use_delay_pattern else None,
+            num_remaining_delays=num_remaining_delays if self.use_delay_pattern else None,
+        )
 
-        # Force the next text tokens to be <|AUDIO_OUT|> in audio generation mode
-        next_tokens = torch.full(
-            (audio_logits.shape[0],),
-            self.config.audio_out_token_idx,
-            dtype=torch.long,
-            device=device,
+        num_delay, num_remaining_delays, next_token_id = self._update_delay_pattern(
+            next_audio_tokens, num_delay, num_remaining_delays, audio_eos_token_id
         )
 
-        # Handle delay_pattern
+        next_tokens = torch.full((1,), next_token_id, dtype=torch.long, device=device)
+        return (
+            next_tokens,
+            next_audio_tokens,
+            next_audio_token_logits,
+            next_audio_token_scores,
+            num_delay,
+            num_remaining_delays,
+            next_token_id,
+        )
+
+    def _update_delay_pattern(
+        self,
+        next_audio_tokens: torch.LongTensor,
+        num_delay: int,
+        num_remaining_delays: Optional[int],
+        audio_eos_token_id: Optional[int],
+        next_audio_token_ids: Optional[List[int]] = None,
+    ) -> Tuple[int, Optional[int], int]:
+        """Advance the delay pattern counters after the audio tokens of a step, and return them with the next text
+        token, which is <|AUDIO_OUT|> until the last codebook emits the audio stream eos.
+
+        `next_audio_token_ids` are the audio tokens of the step already read back to the host, e.g., with the ones of
+        the other sequences of a batch. They are only needed until a codebook emits the audio stream eos, and are
+        read from `next_audio_tokens` if not given.
+        """
+        # Force the next text tokens to be <|AUDIO_OUT|> in audio generation mode
+        next_token_id = self.config.audio_out_token_idx
+
+        # Handle delay_pattern, the sampler already forced the stream bos / eos tokens of the current counters
         if self.use_delay_pattern:
             if num_delay + 1 < next_audio_tokens.shape[0]:
-                next_audio_tokens[(num_delay + 1) :] = self.config.audio_stream_bos_id
                 num_delay += 1
             if num_remaining_delays is not None:
-                next_audio_tokens[: (self.audio_num_codebooks - num_remaining_delays)] = (
-                    self.config.audio_stream_eos_id
-                )
                 num_remaining_delays -= 1
             else:
-                all_eos_indices = (next_audio_tokens == self.config.audio_stream_eos_id).nonzero()
-                if torch.numel(all_eos_indices) > 0:
-                    all_eos_indices = all_eos_indices[0]
-                    last_eos_idx = all_eos_indices[-1]
-                    next_audio_tokens[:last_eos_idx] = self.config.audio_stream_eos_id
-                    num_remaining_delays = self.audio_num_codebooks - last_eos_idx - 1
+                # Read back the sampled codes to look for the first codebook that emitted the audio stream eos. Once
+                # found, the countdown above is tracked on the host and the codes are no longer read.
+                if next_audio_token_ids is None:
+                    next_audio_token_ids = next_audio_tokens.tolist()
+                if self.config.audio_stream_eos_id in next_audio_token_ids:
+                    first_eos_idx = next_audio_token_ids.index(self.config.audio_stream_eos_id)
+                    next_audio_tokens[:first_eos_idx] = self.config.audio_stream_eos_id
+                    num_remaining_delays = self.audio_num_codebooks - first_eos_idx - 1
             if num_remaining_delays is not None and num_remaining_delays <= 0:
-                next_tokens[...] = audio_eos_token_id
+                next_token_id = audio_eos_token_id
                 num_delay = 0
                 num_remaining_delays = None
-
-        return (
-            next_tokens,
-            next_audio_tokens,
-            next_audio_token_logits,
-            next_audio_token_scores,
-            num_delay,
-            num_remaining_delays,
-        )
+        return num_delay, num_remaining_delays, next_token_id
 
     def _sample_text_tokens(
         self,
@@ -1706,6 +1886,681 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         return next_tokens, next_audio_tokens, next_token_logits, next_token_scores
 
+    def _init_decode_state(
+        self,
+        input_ids: torch.LongTensor,
+        generation_config: GenerationConfig,
+        model_kwargs: Dict[str, Any],
+    ) -> "HiggsAudioDecodeState":
+        """Create the per-sequence state consumed by `_decode_step`.
+
+        Initializes the generation mode, the delay-pattern counters and the audio sequences based on the prompt.
+        """
+        # torch generator for sampling
+        seed = generation_config.generation_kwargs.get("seed", None)
+        if seed is not None:
+            torch_generator = torch.Generator(device=input_ids.device).manual_seed(seed)
+        else:
+            torch_generator = None
+
+        batch_size, cur_len = input_ids.shape
+        # The buffers are sized for the whole generation, so the decoding steps do not reallocate them
+        num_reserved = max(generation_config.max_length - cur_len, 0) if generation_config.max_length else 0
+        audio_discrete_codes_mask_buffer = None
+        if generation_config.use_cache:
+            # A prompt prefix restored into the KV cache comes with the audio mask of its positions, and only the
+            # remaining prompt tokens are passed as `input_ids`.
+            cached_prefix_mask = model_kwargs.get("cache_audio_discrete_codes_mask", None)
+            if cached_prefix_mask is not None:
+                cur_len += cached_prefix_mask.shape[1]
+                audio_discrete_codes_mask_buffer = ColumnBuffer(cached_prefix_mask, num_reserved)
+                cached_prefix_mask = audio_discrete_codes_mask_buffer.view()
+            else:
+                audio_discrete_codes_mask_buffer = ColumnBuffer(
+                    torch.zeros((batch_size, 0), dtype=torch.bool, device=input_ids.device), num_reserved
+                )
+            model_kwargs["cache_audio_discrete_codes_mask"] = cached_prefix_mask
+        attention_mask_buffer = None
+        if model_kwargs.get("attention_mask", None) is not None:
+            attention_mask_buffer = ColumnBuffer(model_kwargs["attention_mask"], num_reserved)
+            model_kwargs["attention_mask"] = attention_mask_buffer.view()
+        if model_kwargs.get("audio_out_ids", None) is not None and model_kwargs["audio_out_ids"].shape[0] > 0:
+            audio_out_ids_buffer = ColumnBuffer(model_kwargs["audio_out_ids"], num_reserved)
+            model_kwargs["audio_out_ids"] = audio_out_ids_buffer.view()
+        else:
+            audio_out_ids_buffer = ColumnBuffer(
+                torch.zeros((self.audio_num_codebooks, 0), dtype=torch.long, device=input_ids.device), num_reserved
+            )
+        state = HiggsAudioDecodeState(
+            input_ids_buffer=ColumnBuffer(input_ids, num_reserved),
+            # A tensor to keep track of all the audio placeholder tokens.
+            input_ids_full_buffer=ColumnBuffer(input_ids, num_reserved),
+            model_kwargs=model_kwargs,
+            last_token_id=int(input_ids[0, -1]),
+            cur_len=cur_len,
+            audio_out_ids_buffer=audio_out_ids_buffer,
+            attention_mask_buffer=attention_mask_buffer,
+            audio_discrete_codes_mask_buffer=audio_discrete_codes_mask_buffer,
+            torch_generator=torch_generator,
+        )
+
+        # Initialize the audio variables based on the input prompt.
+        if state.last_token_id == self.config.audio_out_token_idx:
+            state.audio_segment_start = int(model_kwargs["audio_out_ids_start"][-1])
+            state.audio_sequences = [model_kwargs["audio_out_ids"][:, state.audio_segment_start :]]
+            if self.use_delay_pattern:
+                last_audio_token_ids = model_kwargs["audio_out_ids"][:, -1].tolist()
+                state.num_delay = self.audio_num_codebooks - last_audio_token_ids.count(
+                    self.config.audio_stream_bos_id
+                )
+                if self.config.audio_stream_eos_id in last_audio_token_ids:
+                    first_eos_idx = last_audio_token_ids.index(self.config.audio_stream_eos_id)
+                    state.num_remaining_delays = self.audio_num_codebooks - first_eos_idx - 1
+        return state
+
+    def _append_audio_out_ids(self, state: "HiggsAudioDecodeState", next_audio_tokens: torch.LongTensor):
+        """Append the audio tokens of a step to `audio_out_ids` and to the repetition window."""
+        state.audio_out_ids_buffer.append(next_audio_tokens[:, None])
+        state.model_kwargs["audio_out_ids"] = state.audio_out_ids_buffer.view()
+        if state.audio_repetition_window is not None:
+            state.audio_repetition_window.push(next_audio_tokens)
+
+    def _next_generation_mode(
+        self, state: "HiggsAudioDecodeState", generation_config: GenerationConfig
+    ) -> GenerationMode:
+        """The generation mode of the next step of a sequence, which follows from its last token."""
+        audio_out_bos_token_id = generation_config.generation_kwargs.get("audio_out_bos_token_id", None)
+        if state.last_token_id == audio_out_bos_token_id:
+            return GenerationMode.AUDIO_INIT
+        if state.last_token_id == self.audio_out_token_idx:
+            return GenerationMode.AUDIO_IN_PROGRESS
+        return GenerationMode.TEXT
+
+    def _prepare_audio_sampling(
+        self,
+        state: "HiggsAudioDecodeState",
+        logits_processor: LogitsProcessorList,
+        generation_config: GenerationConfig,
+        vocab_size: int,
+    ):
+        """Create the audio sampler and the repetition window of a sequence at its first audio step."""
+        if state.audio_sampler is None:
+            state.audio_sampler = AudioTokenSampler(
+                logits_processor,
+                generation_config.do_sample,
+                ras_win_max_num_repeat=generation_config.generation_kwargs.get("ras_win_max_num_repeat", 2),
+                audio_stream_bos_id=self.config.audio_stream_bos_id,
+                audio_stream_eos_id=self.config.audio_stream_eos_id,
+            )
+        ras_win_len = generation_config.generation_kwargs.get("ras_win_len", None)
+        if ras_win_len and state.audio_repetition_window is None:
+            # The window starts with the audio tokens so far and follows the ones appended to `audio_out_ids`
+            state.audio_repetition_window = RepetitionWindow(
+                state.model_kwargs["audio_out_ids"], ras_win_len, vocab_size
+            )
+
+    def _advance_decode_state(
+        self,
+        state: "HiggsAudioDecodeState",
+        next_tokens: torch.LongTensor,
+        next_audio_tokens: Optional[torch.LongTensor],
+        next_token_id: int,
+        next_token_scores: torch.FloatTensor,
+        stopping_criteria: StoppingCriteriaList,
+        generation_config: GenerationConfig,
+        streamer: Optional["BaseStreamer"],
+    ):
+        """Append the tokens sampled by a step of `state.generation_mode` to the sequence.
+
+        Args:
+            next_tokens (`torch.LongTensor` of shape `(1,)`):
+                The next text token.
+            next_audio_tokens (`torch.LongTensor` of shape `(num_codebooks,)`, *optional*):
+                The next audio tokens, in audio mode and at the start of an audio segment.
+            next_token_id (`int`):
+                The next text token, known on the host.
+        """
+        model_kwargs = state.model_kwargs
+        is_audio_generation_mode = state.generation_mode == GenerationMode.AUDIO_IN_PROGRESS
+        if is_audio_generation_mode:
+            # update generated ids, model inputs, and length for next step
+            self._append_audio_out_ids(state, next_audio_tokens)
+            state.audio_sequences[-1] = model_kwargs["audio_out_ids"][:, state.audio_segment_start :]
+
+            if streamer is not None:
+                streamer.put(next_audio_tokens.cpu())
+        else:
+            if streamer is not None:
+                streamer.put(next_tokens.cpu())
+
+            if next_audio_tokens is not None:
+                # If the token is audio bos token, we will generate the audio placeholder token
+                # and the corrensponding audio stream bos token to start the audio generation.
+                state.audio_segment_start = state.audio_out_ids_buffer.length
+                if state.audio_segment_start == 0:
+                    # Initialize audio_out_ids
+                    model_kwargs["audio_out_ids_start"] = torch.tensor(
+                        [0], dtype=torch.long, device=next_tokens.device
+                    )
+                else:
+                    model_kwargs["audio_out_ids_start"] = torch.concat(
+                        [
+                            model_kwargs["audio_out_ids_start"],
+                            torch.tensor(
+                                [state.audio_segment_start],
+                                dtype=torch.long,
+                                device=next_tokens.device,
+                            ),
+                        ],
+                        dim=0,
+                    )
+                self._append_audio_out_ids(state, next_audio_tokens)
+                state.audio_sequences.append(model_kwargs["audio_out_ids"][:, state.audio_segment_start :])
+                if streamer is not None:
+                    streamer.put(next_audio_tokens.cpu())
+
+        # A finished sequence takes no more steps, so its next token never needs to be replaced by the padding token
+        tokenizer_length = generation_config.generation_kwargs.get("tokenizer_length", None)
+        if tokenizer_length is not None and next_token_id >= tokenizer_length:
+            raise ValueError(
+                f"Next generated token has value {next_token_id} which is greater than the tokenizer's vocabulary size {tokenizer_length}, this is undesired behavior."
+            )
+
+        # update generated ids, model inputs, and length for next step
+        if not is_audio_generation_mode or next_token_id != self.audio_out_token_idx:
+            # We only add one <|AUDIO_OUT|> token to the input_ids for simplicity.
+            state.input_ids_buffer.append(next_tokens[:, None])
+            state.last_token_id = next_token_id
+        state.input_ids_full_buffer.append(next_tokens[:, None])
+        state.this_peer_finished = self._is_finished(state, next_token_id, stopping_criteria, next_token_scores)
+        state.cur_len += 1
+
+    def _decode_step(
+        self,
+        state: "HiggsAudioDecodeState",
+        logits_processor: LogitsProcessorList,
+        stopping_criteria: StoppingCriteriaList,
+        generation_config: GenerationConfig,
+        streamer: Optional["BaseStreamer"],
+        past_key_values_buckets: Optional[OrderedDict[int, Cache]],
+        synced_gpus: bool = False,
+    ) -> Tuple[HiggsAudioModelOutputWithPast, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Run one forward pass and sample the next text / audio token of a single sequence.
+
+        All the sequence-specific variables live in `state`, so steps of different sequences can be interleaved
+        as long as each of them owns its own `past_key_values_buckets`. After the prefill, the steps of sequences with
+        paged KV caches can also be batched with `_decode_step_batch`.
+
+        Returns:
+            The model outputs, the processed scores and the raw logits of the head that was sampled from. The scores
+            and logits are None if the sampling was skipped because of `synced_gpus`.
+        """
+        output_attentions = generation_config.output_attentions
+        output_hidden_states = generation_config.output_hidden_states
+        do_sample = generation_config.do_sample
+        input_ids = state.input_ids
+        model_kwargs = state.model_kwargs
+
+        # Check which multimodal stage we are in
+        generation_mode = self._next_generation_mode(state, generation_config)
+        state.generation_mode = generation_mode
+
+        is_audio_generation_mode = generation_mode == GenerationMode.AUDIO_IN_PROGRESS
+
+        if state.init_model_input or not generation_config.use_cache:
+            model_inputs = {"input_ids": input_ids, **model_kwargs}
+        else:
+            model_inputs = {"input_ids": input_ids[:, -1:], **model_kwargs}
+
+            if is_audio_generation_mode and generation_config.use_cache:
+                model_inputs["audio_out_ids"] = model_kwargs["audio_out_ids"][:, -1:]
+                model_inputs["audio_out_ids_start"] = torch.zeros(1, dtype=torch.long, device=input_ids.device)
+            elif not is_audio_generation_mode:
+                del model_inputs["audio_out_ids"]
+                del model_inputs["audio_out_ids_start"]
+
+            if generation_config.use_cache:
+                # The new position follows the cached ones, which the audio mask of the cache counts on the host
+                num_cached_tokens = state.audio_discrete_codes_mask_buffer.length
+                model_inputs["cache_position"] = torch.arange(
+                    num_cached_tokens, num_cached_tokens + 1, device=input_ids.device
+                )
+
+                if "audio_features" in model_inputs and model_inputs["audio_features"] is not None:
+                    model_inputs["audio_features"] = model_inputs["audio_features"][:0, ...]
+                    model_inputs["audio_feature_attention_mask"] = model_inputs["audio_feature_attention_mask"][
+                        :0, ...
+                    ]
+
+                if "audio_in_ids" in model_inputs and model_inputs["audio_in_ids"] is not None:
+                    model_inputs["audio_in_ids"] = None
+                    model_inputs["audio_in_ids_start"] = None
+
+        # prepare variable output controls (note: some models won't accept all output controls)
+        model_inputs.update({"output_attentions": output_attentions} if output_attentions else {})
+        model_inputs.update({"output_hidden_states": output_hidden_states} if output_hidden_states else {})
+        # Only the head sampled in this mode is computed, and only for the last position
+        model_inputs["generation_mode"] = generation_mode
+        model_inputs["num_logits_to_keep"] = 1
+        model_inputs["static_kv_cache_masks"] = state.static_kv_cache_masks
+
+        if past_key_values_buckets is not None:
+            past_key_values, state.past_key_values_bucket = self._prepare_kv_cache(
+                state.cur_len,
+                state.past_key_values_bucket,
+                past_key_values_buckets,
+            )
+            if past_key_values is not None:
+                model_inputs.update({"past_key_values": past_key_values})
+            model_inputs["past_key_values_buckets"] = past_key_values_buckets
+
+        # forward pass to get next token
+        outputs = self(**model_inputs, return_dict=True)
+
+        # Same as `_update_model_kwargs_for_generation`, with the masks appended in place
+        # synced_gpus: don't waste resources running the code we don't need; kwargs must be updated before skipping
+        model_kwargs["past_key_values"] = outputs.past_key_values
+        if state.attention_mask_buffer is not None:
+            state.attention_mask_buffer.append_constant(1)
+            model_kwargs["attention_mask"] = state.attention_mask_buffer.view()
+        if state.audio_discrete_codes_mask_buffer is not None:
+            state.audio_discrete_codes_mask_buffer.append(
+                outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask
+            )
+            model_kwargs["cache_audio_discrete_codes_mask"] = state.audio_discrete_codes_mask_buffer.view()
+
+        if past_key_values_buckets is not None:
+            # The forward pass of the prefill moves to a larger bucket if the prompt merged with the audio features
+            # does not fit, and returns the cache it wrote to
+            state.past_key_values_bucket = next(
+                (length for length, cache in past_key_values_buckets.items() if cache is outputs.past_key_values),
+                state.past_key_values_bucket,
+            )
+            # Update the actual sequence length after the first forward pass, which merged the prompt with the audio
+            # features. The audio mask covers all the cached positions, so the cache does not need to be read.
+            if state.init_model_input:
+                state.cur_len = state.audio_discrete_codes_mask_buffer.length
+
+        # After the first forward pass, we can set init_model_input to False.
+        state.init_model_input = False
+
+        if synced_gpus and state.this_peer_finished:
+            return outputs, None, None
+
+        if is_audio_generation_mode:
+            # In audio generation mode, we sample the audio tokens from audio logits.
+            # It might also generate the audio eos token to end the audio generation.
+            self._prepare_audio_sampling(state, logits_processor, generation_config, outputs.audio_logits.shape[-1])
+            (
+                next_tokens,
+                next_audio_tokens,
+                next_token_logits,
+                next_token_scores,
+                state.num_delay,
+                state.num_remaining_delays,
+                next_token_id,
+            ) = self._sample_audio_tokens(
+                audio_logits=outputs.audio_logits,
+                sampler=state.audio_sampler,
+                repetition_window=state.audio_repetition_window,
+                device=input_ids.device,
+                torch_generator=state.torch_generator,
+                generation_config=generation_config,
+                num_delay=state.num_delay,
+                num_remaining_delays=state.num_remaining_delays,
+            )
+
+        else:
+            # In text generation mode, we sample the text tokens from text logits.
+            # It might also generate the audio placeholder token to start the audio generation.
+            next_tokens, next_audio_tokens, next_token_logits, next_token_scores = self._sample_text_tokens(
+                input_ids=input_ids,
+                logits=outputs.logits,
+                do_sample=do_sample,
+                logits_processor=logits_processor,
+                device=input_ids.device,
+                generation_mode=generation_mode,
+                torch_generator=state.torch_generator,
+            )
+            if generation_mode == GenerationMode.TEXT:
+                # Read back the sampled token, it decides the mode of the next step
+                next_token_id = int(next_tokens[0])
+            else:
+                next_token_id = self.audio_out_token_idx
+
+        self._advance_decode_state(
+            state,
+            next_tokens,
+            next_audio_tokens,
+            next_token_id,
+            next_token_scores,
+            stopping_criteria,
+            generation_config,
+            streamer,
+        )
+
+        return outputs, next_token_scores, next_token_logits
+
+    def _sampling_key(
+        self,
+        state: "HiggsAudioDecodeState",
+        logits_processor: LogitsProcessorList,
+        generation_config: GenerationConfig,
+    ) -> Optional[Tuple]:
+        """The sampling settings of a sequence. The rows of a batched decoding step with the same settings are sampled
+        together.
+
+        None if the sequence is sampled on its own: with its own generator, or with logits processors that depend on
+        the tokens of the sequence, i.e., anything but the temperature, top-k and top-p warpers.
+        """
+        if state.torch_generator is not None:
+            return None
+        warpers = []
+        for processor in logits_processor:
+            if type(processor) not in (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper):
+                return None
+            warpers.append((type(processor).__name__, tuple(sorted(vars(processor).items()))))
+        return (
+            generation_config.do_sample,
+            tuple(warpers),
+            generation_config.generation_kwargs.get("ras_win_len", None),
+            generation_config.generation_kwargs.get("ras_win_max_num_repeat", 2),
+        )
+
+    def _decode_step_batch(
+        self,
+        states: List["HiggsAudioDecodeState"],
+        logits_processors: List[LogitsProcessorList],
+        stopping_criteria: List[StoppingCriteriaList],
+        generation_configs: List[GenerationConfig],
+        streamers: List[Optional["BaseStreamer"]],
+        kv_caches: List[PagedKVCache],
+    ):
+        """Run one forward pass over several sequences, one decoding step each, and sample their next tokens.
+
+        The sequences must be past their prefill (`_decode_step`), and their KV caches must share a
+        `PagedKVCachePool`. Each row of the batch is the last token of a sequence, at the position that follows the
+        cached ones, and attends to its own cache through a `PagedKVCacheBatch`. The rows can be in different
+        generation modes: the text and audio rows are merged with `merge_input_ids_with_audio_features` like the
+        tokens of a single sequence, and the attention masks of every row are built from the audio mask of its cache.
+
+        The rows are sampled in groups of the same mode and the same `_sampling_key`, with one call to the text
+        sampler or the audio sampler per group. The sampled text tokens and the audio codes needed by the delay
+        pattern are read back once for the whole batch. The states are then updated like by `_decode_step`.
+
+        Args:
+            states (`List[HiggsAudioDecodeState]`):
+                The states of the sequences.
+            logits_processors, stopping_criteria, generation_configs, streamers:
+                The generation arguments of every sequence, in the order of `states`.
+            kv_caches (`List[PagedKVCache]`):
+                The KV caches of the sequences, in the order of `states`.
+        """
+        device = states[0].input_ids.device
+        modes = [self._next_generation_mode(state, config) for state, config in zip(states, generation_configs)]
+
+        # The text rows come first and the audio rows last, and the rows sampled together are consecutive
+        groups: Dict[Tuple, List[int]] = {}
+        for row, (state, logits_processor, config) in enumerate(zip(states, logits_processors, generation_configs)):
+            key = self._sampling_key(state, logits_processor, config)
+            groups.setdefault((modes[row], key if key is not None else object()), []).append(row)
+        mode_order = [GenerationMode.TEXT, GenerationMode.AUDIO_INIT, GenerationMode.AUDIO_IN_PROGRESS]
+        groups = sorted(groups.items(), key=lambda group: mode_order.index(group[0][0]))
+        order = [row for _, rows in groups for row in rows]
+        states, modes, kv_caches = [states[i] for i in order], [modes[i] for i in order], [kv_caches[i] for i in order]
+        logits_processors = [logits_processors[i] for i in order]
+        stopping_criteria = [stopping_criteria[i] for i in order]
+        generation_configs = [generation_configs[i] for i in order]
+        streamers = [streamers[i] for i in order]
+
+        is_audio = [mode == GenerationMode.AUDIO_IN_PROGRESS for mode in modes]
+        batch_size, num_audio_rows = len(states), sum(is_audio)
+        num_text_rows = batch_size - num_audio_rows
+        # The new position of every row follows its cached ones, which the audio mask of the cache counts on the host
+        num_cached_tokens = [state.audio_discrete_codes_mask_buffer.length for state in states]
+        for kv_cache, num_tokens in zip(kv_caches, num_cached_tokens):
+            kv_cache.reserve(num_tokens + 1)
+        past_key_values = PagedKVCacheBatch(kv_caches)
+        cache_position = torch.tensor(num_cached_tokens, dtype=torch.long).to(device, non_blocking=True)[:, None]
+
+        input_ids = torch.cat([state.input_ids[:, -1:] for state in states], dim=0)
+        inputs_embeds = self.embed_tokens(input_ids)
+        if num_audio_rows > 0:
+            audio_out_ids = torch.cat(
+                [state.model_kwargs["audio_out_ids"][:, -1:] for state in states[num_text_rows:]], dim=1
+            )
+            audio_out_embed = self._embed_audio_ids(audio_out_ids)
+            audio_out_ids_start = torch.arange(num_audio_rows, dtype=torch.long, device=device)
+        else:
+            audio_out_embed = audio_out_ids_start = None
+        (
+            inputs_embeds,
+            _,
+            _,
+            position_ids,
+            _,
+            _,
+            _,
+            audio_out_mask,
+        ) = merge_input_ids_with_audio_features(
+            None,
+            None,
+            None,
+            None,
+            audio_out_embed,
+            audio_out_ids_start,
+            self.audio_in_token_idx,
+            self.audio_out_token_idx,
+            inputs_embeds,
+            input_ids,
+            torch.ones_like(input_ids),
+            None,
+            pad_token_id=self.padding_idx,
+            round_to=1,
+            left_padding=True,
+        )
+
+        # Same as `_update_model_kwargs_for_generation`, the mode of every row tells whether its new position is audio
+        for state, row_is_audio in zip(states, is_audio):
+            if state.attention_mask_buffer is not None:
+                state.attention_mask_buffer.append_constant(1)
+                state.model_kwargs["attention_mask"] = state.attention_mask_buffer.view()
+            state.audio_discrete_codes_mask_buffer.append_constant(row_is_audio)
+            state.model_kwargs["cache_audio_discrete_codes_mask"] = state.audio_discrete_codes_mask_buffer.view()
+            # The masks of the single sequence steps do not follow the batched ones
+            state.static_kv_cache_masks = StaticKVCacheMasks()
+
+        # The masks of the single query of every row over the cache of its sequence, as built for a static cache
+        max_cache_len = past_key_values.get_max_cache_shape()
+        mask_shape = (batch_size, 1, 1, max_cache_len)
+        min_dtype = torch.finfo(inputs_embeds.dtype).min
+        is_audio_key = torch.zeros((batch_size, max_cache_len), dtype=torch.bool, device=device)
+        for row, state in enumerate(states):
+            is_audio_key[row, : state.audio_discrete_codes_mask_buffer.length] = (
+                state.audio_discrete_codes_mask_buffer.view()[0]
+            )
+        is_future_key = torch.arange(max_cache_len, device=device) > cache_position
+        causal_mask = torch.zeros(mask_shape, dtype=inputs_embeds.dtype, device=device).masked_fill(
+            is_future_key.view(mask_shape), min_dtype
+        )
+        fast_forward_attention_mask = causal_mask.masked_fill(
+            (audio_out_mask | is_audio_key).view(mask_shape), min_dtype
+        )
+        audio_attention_mask = causal_mask.masked_fill((~audio_out_mask | ~is_audio_key).view(mask_shape), min_dtype)
+        if num_text_rows == 0:
+            is_decoding_audio_token = True
+        elif num_audio_rows == 0:
+            is_decoding_audio_token = False
+        else:
+            # The fast-forward layers run for all the rows, and keep the hidden states of the audio ones
+            is_decoding_audio_token = None
+
+        hidden_states, _, _ = self._forward_core(
+            hidden_states=inputs_embeds,
+            causal_mask=causal_mask,
+            position_ids=position_ids,
+            audio_discrete_codes_mask=audio_out_mask,
+            cache_position=cache_position,
+            past_key_values=past_key_values,
+            use_cache=True,
+            audio_attention_mask=audio_attention_mask,
+            fast_forward_attention_mask=fast_forward_attention_mask,
+            output_attentions=False,
+            output_hidden_states=False,
+            is_decoding_audio_token=is_decoding_audio_token,
+        )
+        hidden_states = self.norm(hidden_states)
+        logits, audio_logits, _, _, _, _ = self.audio_decoder_proj(
+            hidden_states,
+            audio_out_mask,
+            attention_mask=causal_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            cache_position=cache_position,
+            compute_text_logits=num_text_rows > 0,
+            compute_audio_logits=num_audio_rows > 0,
+            num_logits_to_keep=1,
+        )
+        if audio_logits is not None:
+            audio_logits = audio_logits.view(-1, self.audio_num_codebooks, self.audio_codebook_size).float()
+
+        # Sample every group, and read back the tokens the host needs for all of them at once
+        sampled, reads, num_read = [], [], 0
+        start = 0
+        for (mode, _), rows in groups:
+            end = start + len(rows)
+            state, logits_processor, config = states[start], logits_processors[start], generation_configs[start]
+            if mode == GenerationMode.AUDIO_IN_PROGRESS:
+                for row in range(start, end):
+                    self._prepare_audio_sampling(
+                        states[row], logits_processors[row], generation_configs[row], audio_logits.shape[-1]
+                    )
+                num_delay = num_remaining_delays = None
+                if self.use_delay_pattern:
+                    # A codebook count of `num_codebooks` forces no codebook to the audio stream eos
+                    delays = torch.tensor(
+                        [
+                            [row_state.num_delay for row_state in states[start:end]],
+                            [
+                                (
+                                    self.audio_num_codebooks
+                                    if row_state.num_remaining_delays is None
+                                    else row_state.num_remaining_delays
+                                )
+                                for row_state in states[start:end]
+                            ],
+                        ],
+                        dtype=torch.long,
+                    ).to(device, non_blocking=True)
+                    num_delay, num_remaining_delays = delays[0], delays[1]
+                next_tokens = None
+                next_audio_tokens, next_token_scores = state.audio_sampler.sample(
+                    audio_logits[start - num_text_rows : end - num_text_rows],
+                    torch_generator=state.torch_generator,
+                    repetition_window=(
+                        [row_state.audio_repetition_window for row_state in states[start:end]]
+                        if state.audio_repetition_window is not None
+                        else None
+                    ),
+                    num_delay=num_delay,
+                    num_remaining_delays=num_remaining_delays,
+                )
+                # The codes are read until a codebook emits the audio stream eos, see `_update_delay_pattern`
+                is_read = self.use_delay_pattern and any(
+                    row_state.num_remaining_delays is None for row_state in states[start:end]
+                )
+                read_tensor = next_audio_tokens
+            else:
+                next_tokens, next_audio_tokens, _, next_token_scores = self._sample_text_tokens(
+                    logits=logits[start:end],
+                    input_ids=state.input_ids if end - start == 1 else input_ids[start:end],
+                    do_sample=config.do_sample,
+                    logits_processor=logits_processor,
+                    device=device,
+                    generation_mode=mode,
+                    torch_generator=state.torch_generator,
+                )
+                # The text tokens decide the mode of the next step
+                is_read = mode == GenerationMode.TEXT
+                read_tensor = next_tokens
+            sampled.append(
+                (mode, start, end, next_tokens, next_audio_tokens, next_token_scores, num_read if is_read else None)
+            )
+            if is_read:
+                reads.append(read_tensor.flatten())
+                num_read += read_tensor.numel()
+            start = end
+        read_ids = torch.cat(reads).tolist() if reads else []
+
+        for mode, start, end, next_tokens, next_audio_tokens, next_token_scores, read_start in sampled:
+            for row in range(start, end):
+                state, config, offset = states[row], generation_configs[row], row - start
+                state.generation_mode = mode
+                if mode == GenerationMode.AUDIO_IN_PROGRESS:
+                    row_audio_tokens = next_audio_tokens[offset]
+                    num_codebooks = row_audio_tokens.shape[0]
+                    row_audio_token_ids = (
+                        read_ids[read_start + offset * num_codebooks : read_start + (offset + 1) * num_codebooks]
+                        if read_start is not None
+                        else None
+                    )
+                    state.num_delay, state.num_remaining_delays, next_token_id = self._update_delay_pattern(
+                        row_audio_tokens,
+                        state.num_delay,
+                        state.num_remaining_delays,
+                        config.generation_kwargs.get("audio_eos_token_id", None),
+                        row_audio_token_ids,
+                    )
+                    row_tokens = torch.full((1,), next_token_id, dtype=torch.long, device=device)
+                    row_scores = next_token_scores[offset]
+                else:
+                    row_audio_tokens = next_audio_tokens
+                    row_tokens = next_tokens[offset : offset + 1]
+                    row_scores = next_token_scores[offset : offset + 1]
+                    if mode == GenerationMode.TEXT:
+                        next_token_id = read_ids[read_start + offset]
+                    else:
+                        next_token_id = self.audio_out_token_idx
+                self._advance_decode_state(
+                    state,
+                    row_tokens,
+                    row_audio_tokens,
+                    next_token_id,
+                    row_scores,
+                    stopping_criteria[row],
+                    config,
+                    streamers[row],
+                )
+
+    def _is_finished(
+        self,
+        state: "HiggsAudioDecodeState",
+        next_token_id: int,
+        stopping_criteria: StoppingCriteriaList,
+        next_token_scores: torch.Tensor,
+    ) -> bool:
+        """Whether a stopping criterion is met after the token `next_token_id` was appended to the sequence.
+
+        The maximum length and the eos tokens are checked on the host, from the length of `input_ids_full` and the
+        last token. The other criteria are called as usual, and the result is only read back from the device for the
+        ones that return a tensor, e.g., `StopStringCriteria`.
+        """
+        for criteria in stopping_criteria:
+            if isinstance(criteria, MaxLengthCriteria):
+                is_done = state.input_ids_full_buffer.length >= criteria.max_length
+            elif isinstance(criteria, EosTokenCriteria):
+                if state.eos_token_ids is None:
+                    state.eos_token_ids = criteria.eos_token_id.flatten().tolist()
+                is_done = next_token_id in state.eos_token_ids
+            else:
+                is_done = criteria(state.input_ids_full, next_token_scores)
+                if isinstance(is_done, torch.Tensor):
+                    is_done = bool(is_done.any())
+            if is_done:
+                return True
+        return False
+
     # Built on top of GenerationMixin._sample.
     # We revise the implementation to support generating both audio / text.
     def _sample(
@@ -1731,6 +2586,9 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         Otherwise, we will keep generating the text tokens.
 
+        The loop body lives in `_decode_step` and all the per-sequence variables in `HiggsAudioDecodeState`, which
+        allows the serve engine to batch the decoding steps of several requests with `_decode_step_batch`.
+
         Parameters:
             input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
                 The sequence used as a prompt for the generation.
@@ -1760,27 +2618,14 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             `model.config.is_encoder_decoder=True`.
         """
         assert input_ids.shape[0] == 1, "Only support batch_size=1 in _sample()"
-        audio_out_bos_token_id = generation_config.generation_kwargs.get("audio_out_bos_token_id", None)
-
-        # torch generator for sampling
-        seed = generation_config.generation_kwargs.get("seed", None)
-        if seed is not None:
-            torch_generator = torch.Generator(device=input_ids.device).manual_seed(seed)
-        else:
-            torch_generator = None
 
         # init values
-        pad_token_id = generation_config._pad_token_tensor
         output_attentions = generation_config.output_attentions
         output_hidden_states = generation_config.output_hidden_states
         output_scores = generation_config.output_scores
         output_logits = generation_config.output_logits
         return_dict_in_generate = generation_config.return_dict_in_generate
         max_length = generation_config.max_length
-        has_eos_stopping_criteria = any(hasattr(criteria, "eos_token_id") for criteria in stopping_criteria)
-        do_sample = generation_config.do_sample
-        # Used to track which past_key_va
-        self.current_past_key_values_bucket = None
 
         # init attention / hidden states / scores tuples
         scores = () if (return_dict_in_generate and output_scores) else None
@@ -1790,240 +2635,59 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         decoder_hidden_states = () if (return_dict_in_generate and output_hidden_states) else None
 
         # keep track of which sequences are already finished
-        batch_size, cur_len = input_ids.shape
-        this_peer_finished = False
-        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
-        if generation_config.use_cache:
-            model_kwargs["cache_audio_discrete_codes_mask"] = None
-
-        init_model_input = True
-        num_delay = 0
-        num_remaining_delays = None
-        audio_sequences = []
-        # A tensor to keep track of all the audio placeholder tokens.
-        input_ids_full = input_ids.clone()
-
-        # Initialize the audio variables based on the input prompt.
-        if input_ids[0][-1] == self.config.audio_out_token_idx:
-            audio_sequences = [model_kwargs["audio_out_ids"][:, model_kwargs["audio_out_ids_start"][-1] :]]
-            if self.use_delay_pattern:
-                num_delay = (
-                    self.audio_num_codebooks
-                    - (model_kwargs["audio_out_ids"][:, -1] == self.config.audio_stream_bos_id).sum()
-                )
-                all_eos_indices = (model_kwargs["audio_out_ids"][:, -1] == self.config.audio_stream_eos_id).nonzero()
-                if torch.numel(all_eos_indices) > 0:
-                    all_eos_indices = all_eos_indices[0]
-                    last_eos_idx = all_eos_indices[-1]
-                    num_remaining_delays = self.audio_num_codebooks - last_eos_idx - 1
+        state = self._init_decode_state(input_ids, generation_config, model_kwargs)
 
         while self._has_unfinished_sequences(
-            this_peer_finished,
+            state.this_peer_finished,
             synced_gpus,
             device=input_ids.device,
-            cur_len=cur_len,
+            cur_len=state.cur_len,
             max_length=max_length,
         ):
-            # Check which multimodal stage we are in
-            # FIXME: Assume single input generation
-            if input_ids[0][-1] == audio_out_bos_token_id:
-                generation_mode = GenerationMode.AUDIO_INIT
-            elif input_ids[0][-1] == self.audio_out_token_idx:
-                generation_mode = GenerationMode.AUDIO_IN_PROGRESS
-            else:
-                generation_mode = GenerationMode.TEXT
-
-            is_audio_generation_mode = generation_mode == GenerationMode.AUDIO_IN_PROGRESS
-
-            if init_model_input or not generation_config.use_cache:
-                model_inputs = {"input_ids": input_ids, **model_kwargs}
-            else:
-                model_inputs = {"input_ids": input_ids[:, -1:], **model_kwargs}
-
-                if is_audio_generation_mode and generation_config.use_cache:
-                    model_inputs["audio_out_ids"] = model_kwargs["audio_out_ids"][:, -1:]
-                    model_inputs["audio_out_ids_start"] = torch.tensor([0], dtype=torch.long, device=input_ids.device)
-                elif not is_audio_generation_mode:
-                    del model_inputs["audio_out_ids"]
-                    del model_inputs["audio_out_ids_start"]
-
-                if generation_config.use_cache:
-                    if "audio_features" in model_inputs and model_inputs["audio_features"] is not None:
-                        model_inputs["audio_features"] = model_inputs["audio_features"][:0, ...]
-                        model_inputs["audio_feature_attention_mask"] = model_inputs["audio_feature_attention_mask"][
-                            :0, ...
-                        ]
-
-                    if "audio_in_ids" in model_inputs and model_inputs["audio_in_ids"] is not None:
-                        model_inputs["audio_in_ids"] = None
-                        model_inputs["audio_in_ids_start"] = None
-
-            # prepare variable output controls (note: some models won't accept all output controls)
-            model_inputs.update({"output_attentions": output_attentions} if output_attentions else {})
-            model_inputs.update({"output_hidden_states": output_hidden_states} if output_hidden_states else {})
-
-            if past_key_values_buckets is not None:
-                past_key_values, self.current_past_key_values_bucket = self._prepare_kv_cache(
-                    cur_len,
-                    self.current_past_key_values_bucket,
-                    past_key_values_buckets,
-                )
-                if past_key_values is not None:
-                    model_inputs.update({"past_key_values": past_key_values})
-                model_inputs["past_key_values_buckets"] = past_key_values_buckets
-
-            # forward pass to get next token
-            outputs = self(**model_inputs, return_dict=True)
-
-            # Update the actual sequence length after the first forward pass
-            if init_model_input and past_key_values_buckets is not None:
-                cur_len = past_key_values_buckets[self.current_past_key_values_bucket].get_seq_length().item()
-
-            # synced_gpus: don't waste resources running the code we don't need; kwargs must be updated before skipping
-            model_kwargs = self._update_model_kwargs_for_generation(
-                outputs,
-                model_kwargs,
-                is_encoder_decoder=self.config.is_encoder_decoder,
-                extend_attention_mask=True,
+            outputs, next_token_scores, next_token_logits = self._decode_step(
+                state,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                generation_config=generation_config,
+                streamer=streamer,
+                past_key_values_buckets=past_key_values_buckets,
+                synced_gpus=synced_gpus,
             )
 
-            # After the first forward pass, we can set init_model_input to False.
-            init_model_input = False
-
-            if synced_gpus and this_peer_finished:
+            if synced_gpus and next_token_scores is None:
                 continue
 
-            if is_audio_generation_mode:
-                # In audio generation mode, we sample the audio tokens from audio logits.
-                # It might also generate the audio eos token to end the audio generation.
-                (
-                    next_tokens,
-                    next_audio_tokens,
-                    next_audio_token_logits,
-                    next_audio_token_scores,
-                    num_delay,
-                    num_remaining_delays,
-                ) = self._sample_audio_tokens(
-                    hidden_states=outputs.audio_hidden_states,
-                    audio_logits=outputs.audio_logits,
-                    audio_out_ids=model_kwargs["audio_out_ids"],
-                    do_sample=do_sample,
-                    logits_processor=logits_processor,
-                    device=input_ids.device,
-                    torch_generator=torch_generator,
-                    generation_config=generation_config,
-                    num_delay=num_delay,
-                    num_remaining_delays=num_remaining_delays,
-                )
-
-                # update generated ids, model inputs, and length for next step
-                model_kwargs["audio_out_ids"] = torch.cat(
-                    [model_kwargs["audio_out_ids"], next_audio_tokens[:, None]], dim=-1
-                )
-                audio_sequences[-1] = torch.cat([audio_sequences[-1], next_audio_tokens[:, None]], dim=-1)
-
-                if streamer is not None:
-                    streamer.put(next_audio_tokens.cpu())
-            else:
-                # In text generation mode, we sample the text tokens from text logits.
-                # It might also generate the audio placeholder token to start the audio generation.
-                next_tokens, next_audio_tokens, next_token_logits, next_token_scores = self._sample_text_tokens(
-                    input_ids=input_ids,
-                    logits=outputs.logits,
-                    do_sample=do_sample,
-                    logits_processor=logits_processor,
-                    device=input_ids.device,
-                    generation_mode=generation_mode,
-                    torch_generator=torch_generator,
-                )
-
-                if streamer is not None:
-                    streamer.put(next_tokens.cpu())
-
-                if next_audio_tokens is not None:
-                    # If the token is audio bos token, we will generate the audio placeholder token
-                    # and the corrensponding audio stream bos token to start the audio generation.
-                    audio_sequences.append(next_audio_tokens[:, None])
-                    if streamer is not None:
-                        streamer.put(next_audio_tokens.cpu())
-                    if model_kwargs["audio_out_ids"] is None or model_kwargs["audio_out_ids"].shape[0] == 0:
-                        # Initialize audio_out_ids
-                        model_kwargs["audio_out_ids"] = next_audio_tokens[:, None]
-                        model_kwargs["audio_out_ids_start"] = torch.tensor(
-                            [0], dtype=torch.long, device=input_ids.device
-                        )
-                    else:
-                        model_kwargs["audio_out_ids_start"] = torch.concat(
-                            [
-                                model_kwargs["audio_out_ids_start"],
-                                torch.tensor(
-                                    [model_kwargs["audio_out_ids"].shape[1]],
-                                    dtype=torch.long,
-                                    device=input_ids.device,
-                                ),
-                            ],
-                            dim=0,
-                        )
-                        model_kwargs["audio_out_ids"] = torch.concat(
-                            [model_kwargs["audio_out_ids"], next_audio_tokens[:, None]],
-                            dim=1,
-                        )
-
             if return_dict_in_generate:
                 if output_scores:
-                    if is_audio_generation_mode:
-                        scores += (next_audio_token_scores,)
-                    else:
-                        scores += (next_token_scores,)
+                    scores += (next_token_scores,)
                 if output_logits:
-                    if is_audio_generation_mode:
-                        raw_logits += (next_audio_token_logits,)
-                    else:
-                        raw_logits += (next_token_logits,)
+                    raw_logits += (next_token_logits,)
                 if output_attentions:
                     decoder_attentions += (outputs.attentions,)
                 if output_hidden_states:
                     decoder_hidden_states += (outputs.hidden_states,)
 
-            # finished sentences should have their next token be a padding token
-            if has_eos_stopping_criteria:
-                next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
-
-            if "tokenizer_length" in generation_config.generation_kwargs:
-                tokenizer_length = generation_config.generation_kwargs["tokenizer_length"]
-                if torch.max(next_tokens) >= tokenizer_length:
-                    raise ValueError(
-                        f"Next generated token has max value {torch.max(next_tokens)} which is greater than the tokenizer's vocabulary size {tokenizer_length}, this is undesired behavior."
-                    )
-
-            # update generated ids, model inputs, and length for next step
-            if not is_audio_generation_mode or next_tokens[0] != self.audio_out_token_idx:
-                # We only add one <|AUDIO_OUT|> token to the input_ids for simplicity.
-                input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-            input_ids_full = torch.cat([input_ids_full, next_tokens[:, None]], dim=-1)
-            unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids_full, scores)
-            this_peer_finished = unfinished_sequences.max() == 0
-            cur_len += 1
-
             # This is needed to properly delete outputs.logits which may be very large for first iteration
             # Otherwise a reference to outputs is kept which keeps the logits alive in the next iteration
             del outputs
 
         if streamer is not None:
             streamer.end()
+        # The bucket holding the KV cache of the sequence, for the callers of `generate`
+        self.current_past_key_values_bucket = state.past_key_values_bucket
 
         if return_dict_in_generate:
             return HiggsAudioGenerationOutput(
-                sequences=input_ids,
-                audio_sequences=audio_sequences,
+                sequences=state.input_ids,
+                audio_sequences=state.audio_sequences,
                 scores=scores,
                 logits=raw_logits,
                 attentions=decoder_attentions,
                 hidden_states=decoder_hidden_states,
-                past_key_values=model_kwargs.get("past_key_values"),
+                past_key_values=state.model_kwargs.get("past_key_values"),
             )
         else:
-            return input_ids, audio_sequences
+            return state.input_ids, state.audio_sequences
 
     @torch.inference_mode()
     def generate(
@@ -2386,3 +3050,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 )
 
                 self.decode_graph_runners[kv_cache_length][is_decoding_audio_token] = runner
+
+            if isinstance(past_key_value, LazyResetStaticCache):
+                # The capture wrote dummy keys and values at the last position
+                past_key_value.mark_written(kv_cache_length)
@@ -0,0 +1,298 @@
+"""Block-paged KV cache whose sequences grow page by page out of a memory pool shared between sequences."""
+
+import threading
+import torch
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from transformers import PretrainedConfig
+from transformers.cache_utils import Cache, StaticCache
+
+
+def _kv_cache_shape(config: PretrainedConfig) -> Tuple[int, int]:
+    head_dim = config.head_dim if hasattr(config, "head_dim") else config.hidden_size // config.num_attention_heads
+    num_key_value_heads = (
+        config.num_attention_heads
+        if getattr(config, "num_key_value_heads", None) is None
+        else config.num_key_value_heads
+    )
+    return num_key_value_heads, head_dim
+
+
+class PagedKVCachePool:
+    """Memory pool of fixed-size KV cache pages, shared by the `PagedKVCache` of concurrent sequences.
+
+    The pool holds the keys and values of `num_pages` pages of `page_size` positions for every layer. It is sized by a
+    byte budget instead of a maximum sequence length: a sequence takes pages as it grows and gives them back when its
+    cache is reset, so short and long sequences share the same memory.
+
+    The keys and values of a layer are stored as one `(num_key_value_heads, num_pages * page_size, head_dim)` tensor.
+    A sequence can hold any of the pages, listed in the page table of its `PagedKVCache`, so it grows as long as the
+    pool has free pages, wherever they are, and its cached positions are never moved. A new page is taken right after
+    the last page of the sequence when it is free, so that a sequence usually holds consecutive pages, which the
+    attention reads in place.
+
+    The pages are zeroed when they are handed out, which keeps the positions that are not written yet neutral for the
+    attention, and lets the pool leave its memory untouched until it is used.
+
+    Args:
+        config (`PretrainedConfig`):
+            The config of the cached layers, with the same fields as for `StaticCache` (`num_hidden_layers`,
+            `num_attention_heads`, `num_key_value_heads`, `head_dim` or `hidden_size`).
+        max_bytes (`int`):
+            The size budget of the pool, in bytes.
+        page_size (`int`, *optional*, defaults to 128):
+            The number of positions per page.
+        device (`torch.device` or `str`, *optional*):
+            The device of the pool.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            The dtype of the keys and values.
+    """
+
+    def __init__(
+        self,
+        config: PretrainedConfig,
+        max_bytes: int,
+        page_size: int = 128,
+        device: Optional[Union[torch.device, str]] = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.page_size = page_size
+        self.num_layers = config.num_hidden_layers
+        self.num_key_value_heads, self.head_dim = _kv_cache_shape(config)
+        self.num_pages = max_bytes // (page_size * self.bytes_per_token(config, dtype))
+        if self.num_pages == 0:
+            raise ValueError(f"A KV cache pool of {max_bytes} bytes cannot hold a single page of {page_size} tokens.")
+
+        pool_shape = (self.num_layers, self.num_key_value_heads, self.num_pages * page_size, self.head_dim)
+        self.key_cache = torch.empty(pool_shape, dtype=dtype, device=device)
+        self.value_cache = torch.empty(pool_shape, dtype=dtype, device=device)
+        self._free_pages = set(range(self.num_pages))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bytes_per_token(config: PretrainedConfig, dtype: torch.dtype) -> int:
+        """The size of the keys and values of one position, over all the layers."""
+        num_key_value_heads, head_dim = _kv_cache_shape(config)
+        element_size = torch.empty((), dtype=dtype).element_size()
+        return 2 * config.num_hidden_layers * num_key_value_heads * head_dim * element_size
+
+    @property
+    def max_num_tokens(self) -> int:
+        return self.num_pages * self.page_size
+
+    @property
+    def num_free_pages(self) -> int:
+        return len(self._free_pages)
+
+    def allocate(self, num_pages: int, after: Optional[int] = None) -> List[int]:
+        """Take `num_pages` free pages, and return them in the order of the positions they hold.
+
+        Every page is taken right after the previous one, starting after the page `after`, if it is free, and is the
+        first free page otherwise.
+        """
+        with self._lock:
+            if num_pages > len(self._free_pages):
+                raise RuntimeError(
+                    f"The KV cache pool is exhausted: {num_pages} pages requested, and {len(self._free_pages)} of "
+                    f"{self.num_pages} pages are free. Consider increasing the size of the pool."
+                )
+            pages = []
+            for _ in range(num_pages):
+                page = after + 1 if after is not None and after + 1 in self._free_pages else min(self._free_pages)
+                self._free_pages.remove(page)
+                pages.append(page)
+                after = page
+            for start, end in _runs(pages):
+                positions = slice(start * self.page_size, end * self.page_size)
+                self.key_cache[:, :, positions] = 0
+                self.value_cache[:, :, positions] = 0
+        return pages
+
+    def free(self, pages: List[int]):
+        with self._lock:
+            self._free_pages.update(pages)
+
+
+def _runs(pages: List[int]) -> Iterator[Tuple[int, int]]:
+    """The runs of consecutive pages in `pages`, as `(first_page, last_page + 1)`."""
+    start = None
+    for page_idx, page in enumerate(pages):
+        if start is None:
+            start = page
+        if page_idx + 1 == len(pages) or pages[page_idx + 1] != page + 1:
+            yield start, page + 1
+            start = None
+
+
+class PagedKVCache(StaticCache):
+    """KV cache of one sequence, made of pages taken from a `PagedKVCachePool` and listed in a page table.
+
+    The cache grows by whole pages: `reserve` takes new pages from the pool when the next forward pass needs more
+    positions, and the positions already cached stay where they are. Position `i` of the sequence is stored at
+    position `i % page_size` of the page `pages[i // page_size]`. Between two calls to `reserve`, the cache behaves
+    like a `StaticCache` whose maximum length is the number of reserved positions, so `HiggsAudioModel.forward` builds
+    its attention masks the same way for both.
+
+    `update` writes the new keys and values into the pool in place, through the page table, and returns the keys and
+    values of the reserved positions, of shape `(1, num_key_value_heads, max_cache_len, head_dim)`. When the pages of
+    the sequence are consecutive, they are views of the pool, so a decoding step neither allocates nor copies the
+    cache. Otherwise the attention reads them with a gather of the reserved positions, which copies the cache of the
+    sequence once per layer. CUDA graphs are not captured for paged caches, since their shape changes as they grow.
+
+    Args:
+        pool (`PagedKVCachePool`):
+            The pool the pages are taken from.
+    """
+
+    def __init__(self, pool: PagedKVCachePool):
+        # The storage lives in the pool, so the allocation of `StaticCache.__init__` is skipped
+        Cache.__init__(self)
+        self.pool = pool
+        self.page_size = pool.page_size
+        self.batch_size = 1
+        self.max_batch_size = 1
+        self.num_key_value_heads = pool.num_key_value_heads
+        self.head_dim = pool.head_dim
+        self.dtype = pool.key_cache.dtype
+        self.device = pool.key_cache.device
+        self.pages: List[int] = []
+        # The page table on the device, and the position in the pool of every reserved position
+        self._page_table = torch.empty(pool.num_pages, dtype=torch.long, device=self.device)
+        self._page_offsets = torch.arange(self.page_size, device=self.device)
+        self.slots = self._page_offsets[:0]
+        self._is_contiguous = True
+        self._seq_length = 0
+
+    @property
+    def num_pages(self) -> int:
+        return len(self.pages)
+
+    @property
+    def max_cache_len(self) -> int:
+        return self.num_pages * self.page_size
+
+    def reserve(self, seq_length: int):
+        """Make room for the first `seq_length` positions, which the next forward pass fills up."""
+        num_pages = -(-seq_length // self.page_size)
+        if num_pages > self.num_pages:
+            new_pages = self.pool.allocate(num_pages - self.num_pages, after=self.pages[-1] if self.pages else None)
+            # One page at a time, copying the list to the device would wait for it
+            for page_idx, page in enumerate(new_pages, start=self.num_pages):
+                self._page_table[page_idx] = page
+            self.pages.extend(new_pages)
+            self.slots = (self._page_table[:num_pages, None] * self.page_size + self._page_offsets).flatten()
+            self._is_contiguous = len(list(_runs(self.pages))) == 1
+        self._seq_length = seq_length
+
+    def read(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the keys and values of the reserved positions, each of shape `(1, num_heads, max_cache_len,
+        head_dim)`. They are views of the pool if the pages are consecutive, and copies otherwise."""
+        key_cache, value_cache = self.pool.key_cache[layer_idx], self.pool.value_cache[layer_idx]
+        if self._is_contiguous:
+            start = self.pages[0] * self.page_size if self.pages else 0
+            positions = slice(start, start + self.max_cache_len)
+            return key_cache[None, :, positions], value_cache[None, :, positions]
+        return key_cache.index_select(1, self.slots)[None], value_cache.index_select(1, self.slots)[None]
+
+    def write(
+        self,
+        layer_idx: int,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        cache_position: torch.LongTensor,
+    ):
+        """Write the keys and values of the positions `cache_position`, which must have been reserved."""
+        slots = self.slots[cache_position]
+        key_cache, value_cache = self.pool.key_cache[layer_idx], self.pool.value_cache[layer_idx]
+        key_cache.index_copy_(1, slots, key_states[0].to(key_cache.dtype))
+        value_cache.index_copy_(1, slots, value_states[0].to(value_cache.dtype))
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        self.write(layer_idx, key_states, value_states, cache_kwargs["cache_position"])
+        return self.read(layer_idx)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._seq_length
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def reset(self):
+        """Give the pages back to the pool."""
+        if self.pages:
+            self.pool.free(self.pages)
+        self.pages = []
+        self.slots = self._page_offsets[:0]
+        self._is_contiguous = True
+        self._seq_length = 0
+
+
+class PagedKVCacheBatch(StaticCache):
+    """The `PagedKVCache` of several sequences of a pool, seen as one cache by a decoding step over all of them.
+
+    Row `b` of the batch is the sequence of `kv_caches[b]`, whose positions must have been reserved. The page tables of
+    the sequences are stacked, and the shorter ones are padded with their first page, so every row spans
+    `max_cache_len` positions, the reserved positions of the longest sequence. The positions past the end of a
+    sequence hold whatever its padding pages hold, and the attention masks of the step must mask them.
+
+    `update` takes one new position per row, at the positions of `cache_position` of shape `(batch_size, 1)`, and
+    returns the keys and values of every row, of shape `(batch_size, num_key_value_heads, max_cache_len, head_dim)`,
+    gathered from the pool once per layer.
+
+    Args:
+        kv_caches (`List[PagedKVCache]`):
+            The caches of the sequences of the batch, in the order of the rows. They share the same pool.
+    """
+
+    def __init__(self, kv_caches: List[PagedKVCache]):
+        Cache.__init__(self)
+        pool = kv_caches[0].pool
+        self.pool = pool
+        self.kv_caches = kv_caches
+        self.page_size = pool.page_size
+        self.batch_size = len(kv_caches)
+        self.max_batch_size = len(kv_caches)
+        self.num_key_value_heads = pool.num_key_value_heads
+        self.head_dim = pool.head_dim
+        self.dtype = pool.key_cache.dtype
+        self.device = pool.key_cache.device
+        max_num_pages = max(kv_cache.num_pages for kv_cache in kv_caches)
+        self.max_cache_len = max_num_pages * self.page_size
+        page_table = [
+            kv_cache.pages + kv_cache.pages[:1] * (max_num_pages - kv_cache.num_pages) for kv_cache in kv_caches
+        ]
+        page_table = torch.tensor(page_table, dtype=torch.long).to(self.device, non_blocking=True)
+        # The position in the pool of every position of every row, of shape `(batch_size, max_cache_len)`
+        self.slots = (
+            page_table[:, :, None] * self.page_size + torch.arange(self.page_size, device=self.device)
+        ).flatten(1)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        slots = self.slots.gather(1, cache_kwargs["cache_position"]).flatten()
+        key_cache, value_cache = self.pool.key_cache[layer_idx], self.pool.value_cache[layer_idx]
+        key_cache.index_copy_(1, slots, key_states[:, :, 0].transpose(0, 1).to(key_cache.dtype))
+        value_cache.index_copy_(1, slots, value_states[:, :, 0].transpose(0, 1).to(value_cache.dtype))
+
+        shape = (self.num_key_value_heads, self.batch_size, self.max_cache_len, self.head_dim)
+        slots = self.slots.flatten()
+        return (
+            key_cache.index_select(1, slots).view(shape).transpose(0, 1),
+            value_cache.index_select(1, slots).view(shape).transpose(0, 1),
+        )
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return max(kv_cache.get_seq_length() for kv_cache in self.kv_caches)
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return self.max_cache_len
@@ -0,0 +1,120 @@
+"""Static KV cache that only clears the positions written since its last reset, and the masks of its decoding steps."""
+
+import torch
+from typing import Optional, Tuple
+from transformers.cache_utils import StaticCache
+
+
+class LazyResetStaticCache(StaticCache):
+    """`StaticCache` that keeps track of the highest position written, so `reset` only clears the positions in use.
+
+    The positions past the high-water mark are kept at zero, so they do not need to be cleared again. Clearing a
+    bucket after a short request then costs the positions the request wrote instead of the full length of the bucket.
+
+    The sequence is written from the first position on, so the high-water mark is also its length. `get_seq_length`
+    returns it from the host, where `StaticCache.get_seq_length` counts the non-zero positions on the device and the
+    caller has to read the count back.
+
+    Everything that writes into the cache outside of `update` must call `mark_written`. `HiggsAudioModel.forward`
+    marks the positions of every forward pass before running it. A cache the CUDA graphs were captured with must be
+    reset before it holds a sequence.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_written = 0
+
+    def mark_written(self, seq_length: int):
+        """Record that the first `seq_length` positions may hold non-zero keys and values."""
+        self.num_written = max(self.num_written, min(seq_length, self.max_cache_len))
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """The number of cached positions, known on the host."""
+        return self.num_written
+
+    def reset(self):
+        """Clear the positions written since the last reset."""
+        if self.num_written == 0:
+            return
+        for layer_idx in range(len(self.key_cache)):
+            self.key_cache[layer_idx][:, :, : self.num_written].zero_()
+            self.value_cache[layer_idx][:, :, : self.num_written].zero_()
+        self.num_written = 0
+
+
+class StaticKVCacheMasks:
+    """Attention masks of the decoding steps of one sequence with a static KV cache, updated in place at every step.
+
+    With a static cache, a decoding step attends over the whole length of the cache bucket, and
+    `HiggsAudioModel._prepare_all_static_kv_cache_masks` builds its masks over that length. From one step to the next,
+    only the column of the new position changes, so the masks of the single query row are kept here and each step
+    only writes that column. The rows are built from the full masks of the prefill, and carried over to the larger
+    bucket when the sequence is promoted.
+
+    The rows, of shape `(batch_size, 1, 1, max_cache_len)`, hold 0 for the attended positions and the minimum of the
+    dtype for the others:
+        - `causal`: the cached positions.
+        - `text`: the cached text positions, attended by the text tokens in the fast-forward layers.
+        - `audio`: the cached audio positions, attended by the audio tokens in the audio attention.
+        - `masked`: no position. The fast-forward mask of the audio tokens, and the audio mask of the text tokens.
+    """
+
+    def __init__(self):
+        self.causal: Optional[torch.Tensor] = None
+        self.text: Optional[torch.Tensor] = None
+        self.audio: Optional[torch.Tensor] = None
+        self.masked: Optional[torch.Tensor] = None
+
+    @property
+    def is_built(self) -> bool:
+        return self.causal is not None
+
+    @property
+    def max_cache_len(self) -> int:
+        return self.causal.shape[-1]
+
+    def build(self, causal_mask: torch.Tensor, audio_discrete_codes_mask: torch.Tensor):
+        """Build the rows from the masks of a forward pass over the cache.
+
+        Args:
+            causal_mask (`torch.Tensor` of shape `(batch_size, 1, query_length, max_cache_len)`):
+                The causal mask of the forward pass. The row of its last query is kept.
+            audio_discrete_codes_mask (`torch.BoolTensor` of shape `(batch_size, num_cached_tokens)`):
+                The mask of the audio positions in the cache, the ones of the forward pass included.
+        """
+        min_dtype = torch.finfo(causal_mask.dtype).min
+        causal = causal_mask[:, :, -1:, :]
+        batch_size, max_cache_len = causal.shape[0], causal.shape[-1]
+        is_audio = torch.nn.functional.pad(
+            audio_discrete_codes_mask, (0, max_cache_len - audio_discrete_codes_mask.shape[1]), value=False
+        ).reshape(batch_size, 1, 1, max_cache_len)
+        self.causal = causal.clone()
+        self.text = causal.masked_fill(is_audio, min_dtype)
+        self.audio = causal.masked_fill(~is_audio, min_dtype)
+        self.masked = torch.full_like(self.causal, min_dtype)
+
+    def resize(self, max_cache_len: int):
+        """Carry the rows over to a cache of `max_cache_len` positions, after a bucket promotion."""
+        min_dtype = torch.finfo(self.causal.dtype).min
+        num_kept = min(max_cache_len, self.max_cache_len)
+        for name in ("causal", "text", "audio", "masked"):
+            row = getattr(self, name)
+            resized = row.new_full((*row.shape[:-1], max_cache_len), min_dtype)
+            resized[..., :num_kept] = row[..., :num_kept]
+            setattr(self, name, resized)
+
+    def step(
+        self, cache_position: torch.LongTensor, is_decoding_audio_token: bool
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Add the position of a decoding step to the rows.
+
+        Returns:
+            The causal mask, the fast-forward attention mask and the audio attention mask of the step.
+        """
+        # The new column is masked in all the rows so far, unmask it where the new position is attended
+        self.causal.index_fill_(-1, cache_position, 0)
+        if is_decoding_audio_token:
+            self.audio.index_fill_(-1, cache_position, 0)
+            return self.causal, self.masked, self.audio
+        self.text.index_fill_(-1, cache_position, 0)
+        return self.causal, self.text, self.masked
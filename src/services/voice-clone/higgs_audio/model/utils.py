@@ -1,7 +1,8 @@
 import contextlib
 from contextlib import contextmanager
-from functools import wraps
+from functools import lru_cache, wraps
 import torch
+from typing import List
 from transformers.integrations import is_deepspeed_available
 
 if is_deepspeed_available():
@@ -101,11 +102,100 @@ def revert_delay_pattern(data):
             Recovered data with delay pattern removed. It will have shape (num_codebooks, seq_len).
     """
     assert len(data.shape) == 2
-    out_l = []
-    num_codebooks = data.shape[0]
-    for i in range(num_codebooks):
-        out_l.append(data[i : (i + 1), i : (data.shape[1] - num_codebooks + 1 + i)])
-    return torch.cat(out_l, dim=0)
+    return data.gather(1, _revert_delay_pattern_index(data.shape[0], data.shape[1], data.device))
+
+
+@lru_cache(maxsize=256)
+def _delay_pattern_index(num_codebooks: int, seq_len: int, device: torch.device):
+    """Gather index of the delay pattern of a segment of `seq_len` positions, see `build_delay_pattern_segments`.
+
+    Returns the position in the segment of every element of the delayed segment, shifted by 2, or 0 for the delay
+    tokens and 1 for the padding tokens, as well as the mask of the elements that come from the segment.
+    """
+    source = (
+        torch.arange(seq_len + num_codebooks - 1, device=device)[None, :]
+        - torch.arange(num_codebooks, device=device)[:, None]
+    )
+    is_data = (source >= 0) & (source < seq_len)
+    index = torch.where(is_data, source + 2, (source >= seq_len).long())
+    return index, is_data
+
+
+@lru_cache(maxsize=256)
+def _revert_delay_pattern_index(num_codebooks: int, seq_len: int, device: torch.device):
+    """Gather index that reverts the delay pattern of a delayed segment of `seq_len` positions."""
+    return (
+        torch.arange(max(seq_len - num_codebooks + 1, 0), device=device)[None, :]
+        + torch.arange(num_codebooks, device=device)[:, None]
+    )
+
+
+def build_delay_pattern_segments(
+    segments: List[torch.LongTensor],
+    bos_token_id: int,
+    pad_token_id: int,
+) -> torch.LongTensor:
+    """Apply the delay pattern to a list of audio segments and concatenate them along the time axis.
+
+    Same as calling `build_delay_pattern_mask` on every segment and concatenating the first outputs, with a single
+    gather over all the segments. The gather index of each segment length is cached.
+
+    Args:
+        segments (`List[torch.LongTensor]`):
+            The audio segments. Each of them has shape (num_codebooks, seq_len), with its own seq_len.
+        bos_token_id (`int`):
+            The id of the special delay token
+        pad_token_id (`int`):
+            The id of the padding token.
+
+    Returns:
+        input_ids (`torch.LongTensor`):
+            The segments with delay pattern applied, concatenated. It will have shape
+            (num_codebooks, sum(seq_len + num_codebooks - 1)).
+    """
+    num_codebooks = segments[0].shape[0]
+    # The delay and padding tokens come first, followed by the segments
+    data = torch.cat(
+        [
+            segments[0].new_tensor([bos_token_id, pad_token_id]).expand(num_codebooks, 2),
+            *segments,
+        ],
+        dim=1,
+    )
+    index_l = []
+    offset = 0
+    for segment in segments:
+        index, is_data = _delay_pattern_index(num_codebooks, segment.shape[1], data.device)
+        index_l.append(index + is_data * offset if offset > 0 else index)
+        offset += segment.shape[1]
+    return data.gather(1, torch.cat(index_l, dim=1))
+
+
+def revert_delay_pattern_segments(segments: List[torch.Tensor]) -> List[torch.Tensor]:
+    """Convert a list of samples encoded with delay pattern back to the original form.
+
+    Same as calling `revert_delay_pattern` on every segment, with a single gather over all the segments. The gather
+    index of each segment length is cached.
+
+    Args:
+        segments (`List[torch.Tensor]`):
+            The data with delay pattern applied. Each of them has shape (num_codebooks, seq_len + num_codebooks - 1),
+            with its own seq_len.
+
+    Returns:
+        ret (`List[torch.Tensor]`):
+            Recovered data with delay pattern removed. Each of them has shape (num_codebooks, seq_len).
+    """
+    num_codebooks = segments[0].shape[0]
+    data = torch.cat(segments, dim=1) if len(segments) > 1 else segments[0]
+    index_l = []
+    offset = 0
+    for segment in segments:
+        index = _revert_delay_pattern_index(num_codebooks, segment.shape[1], data.device)
+        index_l.append(index + offset if offset > 0 else index)
+        offset += segment.shape[1]
+    ret = data.gather(1, torch.cat(index_l, dim=1))
+    return list(ret.split([index.shape[1] for index in index_l], dim=1))
 
 
 def merge_input_ids_with_audio_features(
@@ -0,0 +1,255 @@
+"""Asyncio front-end of HiggsAudioServeEngine with admission control, cancellation and deadlines."""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, List, Optional
+import numpy as np
+from loguru import logger
+
+from ..dataset.chatml_dataset import ChatMLSample
+from .serve_engine import HiggsAudioResponse, HiggsAudioServeEngine
+
+
+class EngineOverloadedError(RuntimeError):
+    """Raised when a request is submitted while the admission queue of the engine is full."""
+
+
+class RequestCancelledError(RuntimeError):
+    """Raised on the executor thread when a request is cancelled before it produced a result."""
+
+
+class AsyncHiggsAudioServeEngine:
+    """Asyncio front-end of a `HiggsAudioServeEngine`.
+
+    Every request runs on a dedicated executor thread, so the event loop is never blocked by the model. A request owns
+    a stop event that is checked by `AsyncStoppingCriteria` at every decoding step: cancelling the awaiting task or
+    reaching the deadline of the request sets the event, and the model stops working on the request at the next step
+    instead of generating up to `max_new_tokens`. Requests that are cancelled before they start never reach the model.
+
+    The number of admitted requests (queued or running) is bounded by `max_queue_size`. Requests submitted while the
+    engine is full fail immediately with `EngineOverloadedError`, so the caller can shed the load or retry elsewhere.
+
+    Example:
+
+        ```python
+        >>> engine = AsyncHiggsAudioServeEngine(HiggsAudioServeEngine(...), max_queue_size=8)
+        >>> async def main():
+        ...     try:
+        ...         response = await engine.generate(chat_ml_sample, max_new_tokens=1024, timeout=60.0)
+        ...     except EngineOverloadedError:
+        ...         ...  # reject the request
+        ...     except TimeoutError:
+        ...         ...  # the generation was stopped at the deadline
+        ```
+
+    Args:
+        engine (`HiggsAudioServeEngine`):
+            The engine that runs the requests.
+        max_queue_size (`int`, *optional*, defaults to 16):
+            The maximum number of requests admitted at the same time, running ones included.
+        num_workers (`int`, *optional*):
+            The number of executor threads. Defaults to the number of sequences the engine decodes concurrently, so
+            the requests beyond it wait in the executor queue without holding the engine.
+        default_timeout (`float`, *optional*):
+            The deadline, in seconds, of the requests that do not set their own `timeout`. No deadline if not set.
+    """
+
+    def __init__(
+        self,
+        engine: HiggsAudioServeEngine,
+        max_queue_size: int = 16,
+        num_workers: Optional[int] = None,
+        default_timeout: Optional[float] = None,
+    ):
+        if max_queue_size < 1:
+            raise ValueError(f"max_queue_size must be at least 1, got {max_queue_size}")
+        if num_workers is None:
+            num_workers = engine.scheduler.max_num_seqs if engine.scheduler is not None else 1
+        self.engine = engine
+        self.max_queue_size = max_queue_size
+        self.default_timeout = default_timeout
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="higgs-audio-engine")
+        self.num_admitted = 0
+        self._lock = threading.Lock()
+
+    async def generate(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        timeout: Optional[float] = None,
+    ) -> HiggsAudioResponse:
+        """
+        Generate audio from a chatml sample, see `HiggsAudioServeEngine.generate`.
+
+        Args:
+            timeout: The deadline of the request, in seconds from the call, including the time spent waiting for a
+                worker. Defaults to `default_timeout`.
+        Raises:
+            EngineOverloadedError: If the admission queue is full.
+            TimeoutError: If the request did not finish before its deadline. The generation is stopped.
+        """
+        stop_signal = threading.Event()
+        deadline = self._deadline(timeout)
+        future = self._submit(
+            self._generate,
+            chat_ml_sample,
+            stop_signal=stop_signal,
+            deadline=deadline,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_strings=stop_strings,
+            force_audio_gen=force_audio_gen,
+            ras_win_len=ras_win_len,
+            ras_win_max_num_repeat=ras_win_max_num_repeat,
+        )
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), None if deadline is None else deadline - time.monotonic()
+            )
+        except asyncio.CancelledError:
+            # Stop the generation at its next decoding step, or before it starts
+            stop_signal.set()
+            raise
+        except asyncio.TimeoutError as e:
+            stop_signal.set()
+            # `asyncio.TimeoutError` is only an alias of `TimeoutError` from Python 3.11
+            raise TimeoutError("The request did not finish before its deadline.") from e
+
+    async def generate_stream(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        chunk_size: int = 16,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[np.ndarray]:
+        """
+        Generate audio from a chatml sample and yield it while it is being generated, see
+        `HiggsAudioServeEngine.generate_stream`. Closing the iterator, cancelling the consuming task or reaching the
+        deadline stops the generation. The request holds its admission until the executor thread is done with it,
+        which can be one decoding step after the iterator is closed.
+
+        Raises:
+            EngineOverloadedError: If the admission queue is full.
+            TimeoutError: If the request did not finish before its deadline.
+        """
+        deadline = self._deadline(timeout)
+        self._admit()
+        generation_submitted = False
+
+        def _hold_admission(generation: asyncio.Future):
+            # Closing the stream only stops the generation at its next decoding step, so the request holds its
+            # admission until the executor thread is done with it
+            nonlocal generation_submitted
+            generation_submitted = True
+            generation.add_done_callback(self._release)
+
+        try:
+            chunks = self.engine.generate_stream_async(
+                chat_ml_sample,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                stop_strings=stop_strings,
+                force_audio_gen=force_audio_gen,
+                ras_win_len=ras_win_len,
+                ras_win_max_num_repeat=ras_win_max_num_repeat,
+                chunk_size=chunk_size,
+                executor=self.executor,
+                on_generation_submitted=_hold_admission,
+            )
+            try:
+                while True:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError as e:
+                        raise TimeoutError("The request did not finish before its deadline.") from e
+                    yield chunk
+            finally:
+                # Sets the stop signal of the generation
+                await chunks.aclose()
+        finally:
+            if not generation_submitted:
+                self._release()
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting requests and shut the executor down. Requests that did not start are cancelled."""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _deadline(self, timeout: Optional[float]) -> Optional[float]:
+        if timeout is None:
+            timeout = self.default_timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _admit(self):
+        with self._lock:
+            if self.num_admitted >= self.max_queue_size:
+                raise EngineOverloadedError(
+                    f"The engine is full ({self.num_admitted} requests admitted), try again later."
+                )
+            self.num_admitted += 1
+
+    def _release(self, *args: Any):
+        with self._lock:
+            self.num_admitted -= 1
+
+    def _submit(self, fn, *args, **kwargs):
+        self._admit()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        # The request holds its admission until the executor is done with it, including after a cancellation
+        future.add_done_callback(self._release)
+        return future
+
+    def _generate(
+        self,
+        chat_ml_sample: ChatMLSample,
+        stop_signal: threading.Event,
+        deadline: Optional[float],
+        **kwargs,
+    ) -> HiggsAudioResponse:
+        if stop_signal.is_set() or (deadline is not None and time.monotonic() >= deadline):
+            raise RequestCancelledError("The request was cancelled before it started.")
+
+        timer = None
+        if deadline is not None:
+            # Also stop the generation at the deadline when the awaiting task is not scheduled in time
+            timer = threading.Timer(deadline - time.monotonic(), stop_signal.set)
+            timer.daemon = True
+            timer.start()
+        try:
+            prompt_token_ids, sequences, audio_sequences, cached_tokens = self.engine._generate_tokens(
+                chat_ml_sample, stop_signal=stop_signal, **kwargs
+            )
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if stop_signal.is_set():
+            # Nobody waits for the result, skip the audio decoding
+            logger.info("Generation stopped, the request was cancelled or reached its deadline.")
+            raise RequestCancelledError("The request was cancelled.")
+        return self.engine._build_response(prompt_token_ids, sequences, audio_sequences, cached_tokens=cached_tokens)
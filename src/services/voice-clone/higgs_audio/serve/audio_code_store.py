@@ -0,0 +1,176 @@
+"""Append-only on-disk store of the audio codec tokens of reference audios."""
+
+import json
+import numpy as np
+import os
+import threading
+import torch
+from typing import Any, Dict, Iterator, Optional
+
+
+class AudioCodeStore:
+    """On-disk store mapping keys, e.g., voice ids, to the codes produced by `HiggsAudioTokenizer.encode`.
+
+    The store is a directory with three files:
+        - `store.json`: the audio tokenizer the codes come from. Reopening the store with another one raises.
+        - `codes.bin`: the codes of all the entries, one after the other, as `uint16` arrays of shape
+          `(num_codebooks, num_frames)`. That is 4x smaller than the `int64` codes, and the file is memory-mapped by
+          the readers, so the processes that read the same store share its pages.
+        - `index.jsonl`: one line per entry, with its key, its position in `codes.bin` and its metadata.
+
+    Entries are only ever appended: the codes are written first, then the line of the index that makes them
+    visible. When an entry is added again, the last one wins. An interrupted writer leaves at most a partial entry,
+    which is discarded when the store is reopened for writing, so ingestion can resume where it stopped.
+
+    Args:
+        path (`str`):
+            The directory of the store. It is created when opening for writing.
+        audio_tokenizer_id (`str`, *optional*):
+            The identity of the audio tokenizer, e.g., `HiggsAudioServeEngine.audio_tokenizer_id`. Required to create
+            a store, and checked against the one of an existing store.
+        writable (`bool`, *optional*, defaults to `False`):
+            Whether to open the store for writing. Only one process should write to a store at a time.
+    """
+
+    METADATA_FILE = "store.json"
+    CODES_FILE = "codes.bin"
+    INDEX_FILE = "index.jsonl"
+    DTYPE = np.uint16
+
+    def __init__(self, path: str, audio_tokenizer_id: Optional[str] = None, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._codes: Optional[np.memmap] = None
+        self._codes_file = None
+        self._index_file = None
+
+        metadata_path = os.path.join(path, self.METADATA_FILE)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                self.metadata = json.load(f)
+            if audio_tokenizer_id is not None and audio_tokenizer_id != self.metadata["audio_tokenizer_id"]:
+                raise ValueError(
+                    f"The audio code store at {path} holds codes of {self.metadata['audio_tokenizer_id']}, "
+                    f"not of {audio_tokenizer_id}."
+                )
+        elif writable:
+            if audio_tokenizer_id is None:
+                raise ValueError("`audio_tokenizer_id` is required to create an audio code store.")
+            os.makedirs(path, exist_ok=True)
+            self.metadata = {"audio_tokenizer_id": audio_tokenizer_id}
+            with open(metadata_path, "w") as f:
+                json.dump(self.metadata, f)
+        else:
+            raise FileNotFoundError(f"No audio code store at {path}.")
+
+        self._load_index()
+        if writable:
+            self._open_for_append()
+
+    @property
+    def audio_tokenizer_id(self) -> str:
+        return self.metadata["audio_tokenizer_id"]
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as f:
+            for line in f:
+                # A line without its newline was being written when the writer stopped
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                self._entries[entry["key"]] = entry
+
+    def _open_for_append(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        codes_path = os.path.join(self.path, self.CODES_FILE)
+        # Drop what an interrupted writer left past the last complete entry
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                index = f.read()
+            if not index.endswith(b"\n"):
+                with open(index_path, "r+b") as f:
+                    f.truncate(index.rfind(b"\n") + 1)
+        num_elements = max((entry["offset"] + entry["size"] for entry in self._entries.values()), default=0)
+        with open(codes_path, "ab") as f:
+            f.truncate(num_elements * np.dtype(self.DTYPE).itemsize)
+        self._codes_file = open(codes_path, "ab")
+        self._index_file = open(index_path, "a")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    def metadata_of(self, key: str) -> Dict[str, Any]:
+        """The metadata stored with an entry."""
+        return self._entries[key].get("metadata", {})
+
+    def get(self, key: str) -> Optional[torch.LongTensor]:
+        """The codes of an entry, of shape `(num_codebooks, num_frames)`, or None if the key is not in the store."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["size"] == 0:
+            return torch.zeros((entry["num_codebooks"], 0), dtype=torch.long)
+        end = entry["offset"] + entry["size"]
+        with self._lock:
+            if self._codes is None or self._codes.shape[0] < end:
+                # Map the file again to see the entries appended since the last mapping
+                self._codes = np.memmap(os.path.join(self.path, self.CODES_FILE), dtype=self.DTYPE, mode="r")
+            codes = self._codes[entry["offset"] : end]
+        return torch.from_numpy(codes.astype(np.int64)).reshape(entry["num_codebooks"], -1)
+
+    def put(self, key: str, codes: torch.Tensor, metadata: Optional[Dict[str, Any]] = None):
+        """Append the codes of shape `(num_codebooks, num_frames)` of an entry.
+
+        Args:
+            key (`str`):
+                The key of the entry.
+            codes (`torch.Tensor`):
+                The codes. They must fit in `uint16`.
+            metadata (`dict`, *optional*):
+                JSON-serializable metadata stored with the entry, e.g., the source of the audio.
+        """
+        if not self.writable:
+            raise RuntimeError(f"The audio code store at {self.path} was not opened for writing.")
+        codes = codes.detach().cpu()
+        if codes.numel() > 0 and (codes.min() < 0 or codes.max() > np.iinfo(self.DTYPE).max):
+            raise ValueError(f"The codes of {key} do not fit in {np.dtype(self.DTYPE).name}.")
+        data = codes.numpy().astype(self.DTYPE)
+        with self._lock:
+            offset = self._codes_file.tell() // data.itemsize
+            self._codes_file.write(data.tobytes())
+            self._codes_file.flush()
+            entry = {
+                "key": key,
+                "offset": offset,
+                "size": data.size,
+                "num_codebooks": data.shape[0],
+                "metadata": metadata or {},
+            }
+            self._index_file.write(json.dumps(entry) + "\n")
+            self._index_file.flush()
+            self._entries[key] = entry
+
+    def close(self):
+        for f in (self._codes_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._codes_file = None
+        self._index_file = None
+        self._codes = None
+
+    def __enter__(self) -> "AudioCodeStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,162 @@
+"""Incremental decoding of the audio tokens streamed during generation into PCM chunks."""
+
+import numpy as np
+import torch
+from typing import List, Optional
+
+from ..audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer
+
+
+class HiggsAudioStreamDecoder:
+    """Turn the audio tokens streamed by `HiggsAudioModel.generate` into PCM chunks.
+
+    The audio tokens arrive one column at a time. With the delay pattern, codebook `k` of a codec frame arrives `k`
+    columns after codebook 0, so a frame is reverted as soon as its last codebook is available. Like the non-streaming
+    decoding of `HiggsAudioServeEngine.generate`, the first frame (audio stream bos) and the last frame of a segment
+    are dropped, so the newest frame is only decoded once the next one arrives.
+
+    The frames are decoded by blocks of `chunk_size` new frames. With `stateful=True`, the blocks go through a
+    `HiggsAudioStreamingDecoder`, which carries the state of the codec decoder between blocks: every frame is decoded
+    once, and the chunks add up to the non-streaming decoding of the segment. The samples that still depend on the
+    next frames, a few frames' worth, are returned with the next block.
+
+    Otherwise, e.g., for a tokenizer whose decoder is scripted, every block is decoded as a window of its own. The
+    last frames of a window (up to half of the Hamming window, and at most half of the new frames) are held back and
+    decoded again by the next window. The samples decoded twice are blended with the two halves of a Hamming window,
+    which hides the discontinuities at the window boundaries.
+
+    Args:
+        audio_tokenizer (`HiggsAudioTokenizer`):
+            The audio tokenizer used to decode the codes.
+        audio_num_codebooks (`int`):
+            The number of codebooks of the audio tokens.
+        audio_codebook_size (`int`):
+            The size of each codebook. The decoded codes are clipped to `[0, audio_codebook_size - 1]`.
+        audio_stream_bos_id (`int`):
+            The audio stream bos id. A column made of bos ids starts a new audio segment.
+        samples_per_token (`int`):
+            The number of audio samples decoded from one frame.
+        hamming_window_len (`int`):
+            The length, in samples, of the Hamming window used for the overlap-add. Consecutive windows overlap by
+            at most half of it.
+        chunk_size (`int`, *optional*, defaults to 16):
+            The number of new frames decoded by every window.
+        use_delay_pattern (`bool`, *optional*, defaults to `True`):
+            Whether the audio tokens follow the delay pattern.
+        stateful (`bool`, *optional*, defaults to `True`):
+            Whether to decode with `audio_tokenizer.streaming_decoder()` instead of overlapping windows.
+    """
+
+    def __init__(
+        self,
+        audio_tokenizer: HiggsAudioTokenizer,
+        audio_num_codebooks: int,
+        audio_codebook_size: int,
+        audio_stream_bos_id: int,
+        samples_per_token: int,
+        hamming_window_len: int,
+        chunk_size: int = 16,
+        use_delay_pattern: bool = True,
+        stateful: bool = True,
+    ):
+        self.audio_tokenizer = audio_tokenizer
+        self.audio_num_codebooks = audio_num_codebooks
+        self.audio_codebook_size = audio_codebook_size
+        self.audio_stream_bos_id = audio_stream_bos_id
+        self.chunk_size = chunk_size
+        self.num_delay = audio_num_codebooks - 1 if use_delay_pattern else 0
+        self.overlap_frames = max(1, hamming_window_len // 2 // samples_per_token)
+        self._streaming = audio_tokenizer.streaming_decoder() if stateful else None
+        self.reset()
+
+    def reset(self):
+        """Start a new audio segment."""
+        self._columns: List[np.ndarray] = []
+        self._frames: List[np.ndarray] = []
+        # Number of frames reverted from the columns, including the bos frame
+        self._num_reverted = 0
+        self._num_decoded = 0
+        # The samples of the last `_num_held` decoded frames, not returned yet
+        self._num_held = 0
+        self._tail: Optional[np.ndarray] = None
+        if self._streaming is not None:
+            self._streaming.reset()
+
+    def push(self, audio_tokens: torch.Tensor) -> List[np.ndarray]:
+        """Add the audio tokens of one generation step, of shape `(audio_num_codebooks,)`.
+
+        Returns:
+            The PCM chunks that are ready, possibly none.
+        """
+        column = audio_tokens.cpu().numpy()
+        chunks = []
+        if (column == self.audio_stream_bos_id).all():
+            chunks.extend(self.flush())
+
+        self._columns.append(column)
+        while len(self._columns) - self.num_delay > self._num_reverted:
+            frame_idx = self._num_reverted
+            self._num_reverted += 1
+            if frame_idx > 0:
+                frame = np.array([self._columns[frame_idx + k][k] for k in range(self.audio_num_codebooks)])
+                self._frames.append(frame.clip(0, self.audio_codebook_size - 1))
+
+        if self._num_ready - self._num_decoded >= self.chunk_size:
+            wv = self._decode(final=False)
+            if wv.shape[-1] > 0:
+                chunks.append(wv)
+        return chunks
+
+    def flush(self) -> List[np.ndarray]:
+        """Decode the remaining frames of the current audio segment and start a new one."""
+        chunks = []
+        # The streaming decoder holds back the last samples of the frames it decoded
+        if self._num_ready > self._num_decoded or self._tail is not None or self._streaming is not None:
+            wv = self._decode(final=True)
+            if wv.shape[-1] > 0:
+                chunks.append(wv)
+        self.reset()
+        return chunks
+
+    @property
+    def _num_ready(self) -> int:
+        # The newest frame is the last frame of the segment until another frame arrives
+        return max(0, len(self._frames) - 1)
+
+    def _decode(self, final: bool) -> np.ndarray:
+        if self._streaming is not None:
+            return self._decode_stateful(final)
+
+        num_frames = self._num_ready
+        start = self._num_decoded - self._num_held
+        codes = torch.from_numpy(np.stack(self._frames[start:num_frames], axis=1)).to(self.audio_tokenizer.device)
+        wv = self.audio_tokenizer.decode(codes.unsqueeze(0))[0, 0]
+        samples_per_frame = wv.shape[-1] // (num_frames - start)
+
+        if self._tail is not None:
+            # Overlap-add the frames decoded by both windows
+            overlap = min(self._tail.shape[-1], wv.shape[-1])
+            window = np.hamming(2 * overlap)
+            fade_in, fade_out = window[:overlap], window[overlap:]
+            blended = (self._tail[:overlap] * fade_out + wv[:overlap] * fade_in) / (fade_in + fade_out)
+            wv = np.concatenate([blended.astype(wv.dtype), wv[overlap:]])
+
+        self._num_held = 0 if final else min(self.overlap_frames, (num_frames - self._num_decoded) // 2)
+        self._num_decoded = num_frames
+        if self._num_held == 0:
+            self._tail = None
+            return wv
+        num_held_samples = self._num_held * samples_per_frame
+        self._tail = wv[-num_held_samples:]
+        return wv[:-num_held_samples]
+
+    def _decode_stateful(self, final: bool) -> np.ndarray:
+        num_frames = self._num_ready
+        chunks = []
+        if num_frames > self._num_decoded:
+            codes = torch.from_numpy(np.stack(self._frames[self._num_decoded : num_frames], axis=1))
+            chunks.append(self._streaming.push(codes))
+            self._num_decoded = num_frames
+        if final:
+            chunks.append(self._streaming.flush())
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
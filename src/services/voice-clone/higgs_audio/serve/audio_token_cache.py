@@ -0,0 +1,77 @@
+"""Content-addressed cache of the audio codec tokens of reference audios."""
+
+import hashlib
+import threading
+import torch
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class AudioTokenCache:
+    """Bounded LRU cache mapping raw audio bytes to the codes produced by `HiggsAudioTokenizer.encode`.
+
+    Entries are keyed by a hash of the raw audio bytes and the identity of the audio tokenizer, so the same
+    reference clip is only encoded once per tokenizer. The cache is bounded by the total size in bytes of the
+    stored tensors, and the least recently used entries are evicted first.
+
+    Args:
+        max_bytes (`int`):
+            The maximum total size of the cached tensors, in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(audio_bytes: bytes, tokenizer_id: str) -> str:
+        digest = hashlib.blake2b(audio_bytes, digest_size=32)
+        digest.update(tokenizer_id.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self._lock:
+            audio_ids = self._entries.get(key)
+            if audio_ids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return audio_ids
+
+    def put(self, key: str, audio_ids: torch.Tensor):
+        size = audio_ids.numel() * audio_ids.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = audio_ids
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+        }
@@ -0,0 +1,138 @@
+"""
+Tokenize a batch of reference audios offline into an `AudioCodeStore`.
+
+Walks a directory of audio files, or reads a manifest, and encodes every clip with an encode-only
+`HiggsAudioTokenizer` in a pool of worker processes. The codes are appended to the store as they complete. Clips
+whose key is already in the store are skipped, so an interrupted run resumes where it stopped.
+
+The manifest is either a text file with one audio path per line, or a JSONL file whose lines hold an `audio_path`
+and optionally a `key`. Relative paths are resolved against the directory of the manifest. By default, the key of a
+clip is its path relative to the input directory (or to the manifest directory) without the extension.
+
+Usage (from src/services/voice-clone):
+    python -m higgs_audio.serve.ingest_voices --input voices/ --output voice_codes/ --num-workers 4
+"""
+
+import argparse
+import json
+import librosa
+import os
+import time
+import torch
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from loguru import logger
+from typing import List, Tuple
+
+from ..audio_processing.higgs_audio_tokenizer import load_higgs_audio_tokenizer
+from .audio_code_store import AudioCodeStore
+
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a", ".opus")
+
+# The audio tokenizer of a worker process, loaded once by `_init_worker`
+_worker_audio_tokenizer = None
+
+
+def list_audio_files(input_path: str) -> List[Tuple[str, str]]:
+    """List the `(key, audio_path)` pairs of a directory of audio files or of a manifest."""
+    if os.path.isdir(input_path):
+        items = []
+        for root, _, files in os.walk(input_path):
+            for name in sorted(files):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    audio_path = os.path.join(root, name)
+                    key = os.path.splitext(os.path.relpath(audio_path, input_path))[0]
+                    items.append((key, audio_path))
+        return sorted(items)
+
+    manifest_dir = os.path.dirname(os.path.abspath(input_path))
+    items = []
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if input_path.endswith(".jsonl"):
+                record = json.loads(line)
+                audio_path, key = record["audio_path"], record.get("key", None)
+            else:
+                audio_path, key = line, None
+            if not os.path.isabs(audio_path):
+                audio_path = os.path.join(manifest_dir, audio_path)
+            if key is None:
+                key = os.path.splitext(os.path.relpath(audio_path, manifest_dir))[0]
+            items.append((key, audio_path))
+    return items
+
+
+def _init_worker(audio_tokenizer_name_or_path: str, device: str, num_threads: int):
+    global _worker_audio_tokenizer
+    torch.set_num_threads(num_threads)
+    _worker_audio_tokenizer = load_higgs_audio_tokenizer(
+        audio_tokenizer_name_or_path, device=device, encode_only=True
+    ).prepare_for_inference()
+
+
+def _encode(key: str, audio_path: str) -> Tuple[str, torch.Tensor, float]:
+    """Load, resample and encode a clip, the same way as `HiggsAudioServeEngine._encode_audio_content`."""
+    raw_audio, _ = librosa.load(audio_path, sr=_worker_audio_tokenizer.sampling_rate)
+    audio_ids = _worker_audio_tokenizer.encode(raw_audio, _worker_audio_tokenizer.sampling_rate).squeeze(0).cpu()
+    return key, audio_ids, len(raw_audio) / _worker_audio_tokenizer.sampling_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize reference audios into an audio code store")
+    parser.add_argument("--input", type=str, required=True, help="A directory of audio files, or a manifest.")
+    parser.add_argument("--output", type=str, required=True, help="The directory of the audio code store.")
+    parser.add_argument("--audio-tokenizer", type=str, default="bosonai/higgs-audio-v2-tokenizer")
+    parser.add_argument("--num-workers", type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument("--threads-per-worker", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--overwrite", action="store_true", help="Encode again the clips already in the store.")
+    args = parser.parse_args()
+
+    items = list_audio_files(args.input)
+    # Load the tokenizer once here to check that it can be loaded, and to identify its codes in the store
+    audio_tokenizer = load_higgs_audio_tokenizer(args.audio_tokenizer, device="cpu", encode_only=True)
+    audio_tokenizer_id = f"{args.audio_tokenizer}:{audio_tokenizer.sampling_rate}:{audio_tokenizer.num_codebooks}"
+    del audio_tokenizer
+
+    with AudioCodeStore(args.output, audio_tokenizer_id=audio_tokenizer_id, writable=True) as store:
+        pending = [(key, audio_path) for key, audio_path in items if args.overwrite or key not in store]
+        logger.info(
+            f"{len(items)} clips, {len(items) - len(pending)} already in {args.output}, {len(pending)} to encode"
+        )
+        if not pending:
+            return
+
+        start = time.time()
+        num_failed = 0
+        total_seconds = 0.0
+        # Spawn the workers, CUDA cannot be used in forked processes
+        with ProcessPoolExecutor(
+            max_workers=args.num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(args.audio_tokenizer, args.device, args.threads_per_worker),
+        ) as executor:
+            futures = {executor.submit(_encode, key, audio_path): audio_path for key, audio_path in pending}
+            for i, future in enumerate(as_completed(futures), start=1):
+                audio_path = futures[future]
+                try:
+                    key, audio_ids, seconds = future.result()
+                except Exception as e:
+                    num_failed += 1
+                    logger.warning(f"Failed to encode {audio_path}: {e}")
+                    continue
+                store.put(key, audio_ids, metadata={"audio_path": audio_path, "duration": seconds})
+                total_seconds += seconds
+                if i % 100 == 0 or i == len(pending):
+                    elapsed = time.time() - start
+                    logger.info(f"{i}/{len(pending)} clips, {total_seconds / elapsed:.1f} seconds of audio per second")
+
+        logger.info(f"Encoded {len(pending) - num_failed} clips into {args.output}, {num_failed} failed")
+
+
+if __name__ == "__main__":
+    main()
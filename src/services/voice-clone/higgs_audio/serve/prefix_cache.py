@@ -0,0 +1,191 @@
+"""Radix tree of KV cache snapshots of the prompt prefixes shared between requests."""
+
+import threading
+import torch
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+from transformers.cache_utils import Cache
+
+from ..model.paged_kv_cache import PagedKVCache
+from ..model.static_kv_cache import LazyResetStaticCache
+
+
+@dataclass(eq=False)
+class PrefixKVSnapshot:
+    """The KV cache entries of a prompt prefix.
+
+    The snapshot covers the first `num_tokens` positions of the merged sequence, i.e., after the audio placeholders
+    have been expanded into their audio codes by `HiggsAudioModel.forward`.
+
+    Args:
+        num_input_ids (`int`):
+            The number of prompt `input_ids` covered by the snapshot. Every audio placeholder counts as one id.
+        audio_discrete_codes_mask (`torch.BoolTensor` of shape `(1, num_tokens)`):
+            The mask of the audio positions in the merged prefix, passed to `HiggsAudioModel.generate` as
+            `cache_audio_discrete_codes_mask`.
+        key_cache (`List[torch.Tensor]`):
+            The keys of every layer, each of shape `(1, num_key_value_heads, num_tokens, head_dim)`.
+        value_cache (`List[torch.Tensor]`):
+            The values of every layer, each of shape `(1, num_key_value_heads, num_tokens, head_dim)`.
+    """
+
+    num_input_ids: int
+    audio_discrete_codes_mask: torch.BoolTensor
+    key_cache: List[torch.Tensor] = field(default_factory=list)
+    value_cache: List[torch.Tensor] = field(default_factory=list)
+
+    @property
+    def num_tokens(self) -> int:
+        return self.audio_discrete_codes_mask.shape[1]
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.key_cache + self.value_cache)
+
+    def copy_from(self, kv_cache: Cache):
+        """Capture the prefix from a KV cache that holds (at least) the prefix positions."""
+        if isinstance(kv_cache, PagedKVCache):
+            layers = [kv_cache.read(layer_idx) for layer_idx in range(kv_cache.pool.num_layers)]
+            self.key_cache = [key[:, :, : self.num_tokens].clone() for key, _ in layers]
+            self.value_cache = [value[:, :, : self.num_tokens].clone() for _, value in layers]
+            return
+        self.key_cache = [key[:, :, : self.num_tokens].clone() for key in kv_cache.key_cache]
+        self.value_cache = [value[:, :, : self.num_tokens].clone() for value in kv_cache.value_cache]
+
+    def copy_to(self, kv_cache: Cache):
+        """Restore the prefix into the first positions of a KV cache. The rest of the cache is left untouched."""
+        if isinstance(kv_cache, PagedKVCache):
+            kv_cache.reserve(self.num_tokens)
+            cache_position = torch.arange(self.num_tokens, device=kv_cache.device)
+            for layer_idx, (key, value) in enumerate(zip(self.key_cache, self.value_cache)):
+                kv_cache.write(layer_idx, key, value, cache_position)
+            return
+        if isinstance(kv_cache, LazyResetStaticCache):
+            kv_cache.mark_written(self.num_tokens)
+        for layer_idx, (key, value) in enumerate(zip(self.key_cache, self.value_cache)):
+            kv_cache.key_cache[layer_idx][:, :, : self.num_tokens] = key
+            kv_cache.value_cache[layer_idx][:, :, : self.num_tokens] = value
+
+
+class _RadixNode:
+    __slots__ = ("edge", "parent", "children", "snapshot")
+
+    def __init__(self, edge: Tuple[Hashable, ...] = (), parent: Optional["_RadixNode"] = None):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[Hashable, _RadixNode] = {}
+        self.snapshot: Optional[PrefixKVSnapshot] = None
+
+
+class PrefixCache:
+    """Bounded radix tree mapping prompt prefixes to their `PrefixKVSnapshot`.
+
+    A prefix is keyed by a sequence of hashable elements: the text token ids of the prompt, with every audio
+    placeholder replaced by a hash of the audio codes it expands to. A lookup returns the snapshot of the longest
+    cached prefix of the key, so a request can reuse e.g. the system prompt and the reference voice of a previous
+    request. The tree is bounded by the total size in bytes of the snapshots, and the least recently used snapshots
+    are evicted first.
+
+    Args:
+        max_bytes (`int`):
+            The maximum total size of the cached snapshots, in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._root = _RadixNode()
+        self._lru: OrderedDict[_RadixNode, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match(self, key: Sequence[Hashable]) -> Optional[PrefixKVSnapshot]:
+        """Return the snapshot of the longest cached prefix of `key`, if any."""
+        key = tuple(key)
+        with self._lock:
+            node, pos, best = self._root, 0, None
+            while True:
+                if node.snapshot is not None:
+                    best = node
+                if pos == len(key):
+                    break
+                child = node.children.get(key[pos])
+                if child is None or key[pos : pos + len(child.edge)] != child.edge:
+                    break
+                node, pos = child, pos + len(child.edge)
+
+            if best is None:
+                self.misses += 1
+                return None
+            self._lru.move_to_end(best)
+            self.hits += 1
+            return best.snapshot
+
+    def insert(self, key: Sequence[Hashable], snapshot: PrefixKVSnapshot):
+        """Store the snapshot of the prefix `key`, replacing the previous snapshot of the same prefix."""
+        key = tuple(key)
+        size = snapshot.num_bytes
+        if size > self.max_bytes or len(key) == 0:
+            return
+        with self._lock:
+            node, pos = self._root, 0
+            while pos < len(key):
+                child = node.children.get(key[pos])
+                if child is None:
+                    leaf = _RadixNode(key[pos:], parent=node)
+                    node.children[key[pos]] = leaf
+                    node, pos = leaf, len(key)
+                    break
+                common = 0
+                max_common = min(len(child.edge), len(key) - pos)
+                while common < max_common and child.edge[common] == key[pos + common]:
+                    common += 1
+                if common < len(child.edge):
+                    # Split the edge of the child at the end of the common part
+                    middle = _RadixNode(child.edge[:common], parent=node)
+                    node.children[key[pos]] = middle
+                    child.edge = child.edge[common:]
+                    child.parent = middle
+                    middle.children[child.edge[0]] = child
+                    child = middle
+                node, pos = child, pos + common
+
+            if node.snapshot is not None:
+                self.num_bytes -= node.snapshot.num_bytes
+            node.snapshot = snapshot
+            self.num_bytes += size
+            self._lru[node] = None
+            self._lru.move_to_end(node)
+            while self.num_bytes > self.max_bytes:
+                evicted, _ = self._lru.popitem(last=False)
+                self._remove_snapshot(evicted)
+                self.evictions += 1
+
+    def _remove_snapshot(self, node: _RadixNode):
+        self.num_bytes -= node.snapshot.num_bytes
+        node.snapshot = None
+        # Prune the branches that no longer lead to a snapshot
+        while node.parent is not None and node.snapshot is None and not node.children:
+            del node.parent.children[node.edge[0]]
+            node = node.parent
+
+    def clear(self):
+        with self._lock:
+            self._root = _RadixNode()
+            self._lru.clear()
+            self.num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._lru),
+            "bytes": self.num_bytes,
+        }
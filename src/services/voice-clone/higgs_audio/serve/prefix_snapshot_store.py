@@ -0,0 +1,180 @@
+"""
+On-disk store of the KV cache snapshots of shared prompt prefixes, e.g., the system prompt and reference voice.
+
+Workers that start cold restore the prefix of a voice from disk instead of prefilling it again. Precompute the
+snapshots of all the voices of a `VoiceLibrary` with:
+
+Usage (from src/services/voice-clone):
+    python -m higgs_audio.serve.prefix_snapshot_store --voice-library voice_library --output prefix_snapshots \
+        --system-prompt "" --system-prompt "Generate audio following instruction."
+
+Then pass the directory to the engine with `HiggsAudioServeEngine(..., prefix_snapshot_dir="prefix_snapshots")`.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from typing import Hashable, List, Optional, Sequence
+
+from ..data_types import ChatMLSample, Message
+from .prefix_cache import PrefixKVSnapshot
+
+
+def model_checksum(model: torch.nn.Module) -> str:
+    """Checksum of a model, that identifies the KV caches it produces.
+
+    Hashes the config, and the name, shape, dtype and a strided sample of the values of every parameter and buffer,
+    which distinguishes fine-tunes and dtypes of the same architecture without reading all the weights.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    # Where the model was loaded from and with which library version do not change its outputs
+    config = model.config.to_dict()
+    config.pop("_name_or_path", None)
+    config.pop("transformers_version", None)
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode("utf-8"))
+    with torch.no_grad():
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+            digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode("utf-8"))
+            flat = tensor.detach().reshape(-1)
+            sample = flat[:: max(1, flat.numel() // 1024)][:1024]
+            digest.update(sample.float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def prefix_hash(key: Sequence[Hashable]) -> str:
+    """Hash of a prefix key of the `PrefixCache`, i.e., token ids and hashes of audio codes."""
+    return hashlib.blake2b(json.dumps(list(key)).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class PrefixSnapshotStore:
+    """Directory of `PrefixKVSnapshot`s, keyed by the checksum of the model and the hash of the prefix.
+
+    Every snapshot is a file `<model_checksum>/<prefix_hash>.pt`, with the keys and values of all the layers stacked
+    into one tensor each, so it is loaded with a single memory mapping. Files are written to a temporary file and
+    renamed, so several workers can share the directory. Snapshots are saved on a background thread, off the
+    critical path of the request that captured them.
+
+    Args:
+        path (`str`):
+            The directory of the store.
+        model_id (`str`):
+            The checksum of the model, see `model_checksum`.
+    """
+
+    def __init__(self, path: str, model_id: str):
+        self.path = path
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self._dir = os.path.join(path, model_id)
+        os.makedirs(self._dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefix-snapshot-store")
+
+    def _file(self, key: Sequence[Hashable]) -> str:
+        return os.path.join(self._dir, f"{prefix_hash(key)}.pt")
+
+    def __contains__(self, key: Sequence[Hashable]) -> bool:
+        return os.path.exists(self._file(key))
+
+    def load(self, key: Sequence[Hashable], device: Optional[torch.device] = None) -> Optional[PrefixKVSnapshot]:
+        """The snapshot of the prefix `key`, on `device`, or None if it is not in the store."""
+        path = self._file(key)
+        try:
+            data = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # The tensors are views of the memory mapping until they are copied to the device
+        return PrefixKVSnapshot(
+            num_input_ids=data["num_input_ids"],
+            audio_discrete_codes_mask=data["audio_discrete_codes_mask"].to(device),
+            key_cache=list(data["key_cache"].to(device).unbind(0)),
+            value_cache=list(data["value_cache"].to(device).unbind(0)),
+        )
+
+    def save(self, key: Sequence[Hashable], snapshot: PrefixKVSnapshot):
+        """Write the snapshot of the prefix `key` in the background, unless it is already in the store."""
+        path = self._file(key)
+        with self._lock:
+            if path in self._pending or os.path.exists(path):
+                return
+            self._pending.add(path)
+        self._executor.submit(self._write, path, snapshot)
+
+    def _write(self, path: str, snapshot: PrefixKVSnapshot):
+        try:
+            data = {
+                "num_input_ids": snapshot.num_input_ids,
+                "audio_discrete_codes_mask": snapshot.audio_discrete_codes_mask.cpu(),
+                "key_cache": torch.stack(snapshot.key_cache).cpu(),
+                "value_cache": torch.stack(snapshot.value_cache).cpu(),
+            }
+            fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                torch.save(data, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to save the prefix snapshot {path}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(path)
+
+    def flush(self):
+        """Wait for the snapshots being saved."""
+        self._executor.submit(lambda: None).result()
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self._dir) if name.endswith(".pt"))
+
+
+def main():
+    from .serve_engine import HiggsAudioServeEngine
+
+    parser = argparse.ArgumentParser(description="Precompute the prefix KV snapshots of the voices of a library")
+    parser.add_argument("--voice-library", type=str, required=True, help="The voice library of the voices.")
+    parser.add_argument("--output", type=str, required=True, help="The directory of the prefix snapshot store.")
+    parser.add_argument("--model", type=str, default="bosonai/higgs-audio-v2-generation-3B-base")
+    parser.add_argument("--audio-tokenizer", type=str, default="bosonai/higgs-audio-v2-tokenizer")
+    parser.add_argument(
+        "--system-prompt",
+        type=str,
+        action="append",
+        default=None,
+        help="A system prompt the voices are served with, repeatable. An empty prompt means no system message.",
+    )
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    engine = HiggsAudioServeEngine(
+        args.model,
+        args.audio_tokenizer,
+        device=args.device,
+        audio_tokenizer_decode_only=True,
+        voice_library_path=args.voice_library,
+        prefix_snapshot_dir=args.output,
+    )
+    system_prompts: List[str] = args.system_prompt or [""]
+    voice_ids = list(engine.voice_library.voice_ids())
+    for voice_id in voice_ids:
+        for system_prompt in system_prompts:
+            messages = [Message(role="system", content=system_prompt)] if system_prompt else []
+            messages += engine.voice_library.reference_messages(voice_id)
+            # Only the messages before the last one are captured, the text to synthesize does not matter
+            messages.append(Message(role="user", content="Hello."))
+            engine._generate_tokens(ChatMLSample(messages=messages), max_new_tokens=1, temperature=0.0)
+        logger.info(f"Captured the prefixes of {voice_id}")
+    engine.prefix_snapshot_store.flush()
+    logger.info(f"{len(engine.prefix_snapshot_store)} prefix snapshots in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
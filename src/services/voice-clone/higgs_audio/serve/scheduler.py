@@ -0,0 +1,375 @@
+"""Step-level scheduler that batches the decoding of several requests on one HiggsAudioModel."""
+
+import threading
+import torch
+from collections import deque
+from concurrent.futures import Future
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from loguru import logger
+from transformers import AutoTokenizer
+from transformers.cache_utils import Cache
+from transformers.generation import (
+    GenerationConfig,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+)
+from transformers.generation.logits_process import (
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.stopping_criteria import (
+    EosTokenCriteria,
+    MaxLengthCriteria,
+    StoppingCriteria,
+    StopStringCriteria,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from ..model import HiggsAudioModel
+from ..model.modeling_higgs_audio import HiggsAudioDecodeState
+from ..model.paged_kv_cache import PagedKVCache
+from .prefix_cache import PrefixKVSnapshot
+
+
+@dataclass
+class HiggsAudioSchedulerOutput:
+    """The result of a scheduled request, in the same layout as `HiggsAudioModel.generate`."""
+
+    sequences: torch.LongTensor
+    audio_sequences: List[torch.LongTensor]
+
+
+@dataclass(eq=False)
+class _ScheduledSequence:
+    inputs: Dict[str, Any]
+    generation_config: GenerationConfig
+    logits_processor: LogitsProcessorList
+    stopping_criteria: StoppingCriteriaList
+    streamer: Optional[BaseStreamer]
+    future: Future
+    prefix_snapshot: Optional[PrefixKVSnapshot] = None
+    capture_prefix: Optional[PrefixKVSnapshot] = None
+    slot: Optional[int] = None
+    state: Optional[HiggsAudioDecodeState] = None
+
+
+class HiggsAudioScheduler:
+    """Scheduler that batches the decoding steps of several `HiggsAudioModel` generation requests.
+
+    Requests join and leave the set of running sequences at token granularity: every iteration of the scheduler
+    loop admits waiting requests into the free KV cache slots, runs the prefill of the new sequences one at a time
+    (`HiggsAudioModel._decode_step`), then one decoding step of all the other running sequences in a single batched
+    forward pass (`HiggsAudioModel._decode_step_batch`), and retires the sequences that met their stopping criteria.
+    Each sequence keeps its own `HiggsAudioDecodeState` (generation mode, delay pattern counters, KV cache, stop state)
+    and its own KV cache slot, so a long generation does not block the requests that arrive after it, and the
+    running sequences share the weight reads of every decoding step.
+
+    The batched steps need every slot to hold a single `PagedKVCache`, and all of them to share one
+    `PagedKVCachePool`. A sequence whose cache cannot grow because the pool is full skips the step and waits for the
+    pages of the sequences that finish, and fails if none of the running sequences can grow. The slots with static
+    KV cache buckets are decoded one sequence at a time instead, interleaved with the other sequences.
+
+    Args:
+        model (`HiggsAudioModel`):
+            The model used for generation. Only the scheduler thread should run it.
+        tokenizer (`AutoTokenizer`):
+            The text tokenizer, used for the stop strings.
+        kv_cache_slots (`List[Dict[int, Cache]]`):
+            The KV caches of every concurrently running sequence, keyed by length like the buckets of
+            `HiggsAudioModel.generate`. A slot can hold a single cache, e.g., a `PagedKVCache` whose pages go back to
+            the shared pool when the sequence finishes, which lets the sequence join the batched decoding steps.
+    """
+
+    def __init__(
+        self,
+        model: HiggsAudioModel,
+        tokenizer: AutoTokenizer,
+        kv_cache_slots: List[Dict[int, Cache]],
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.kv_cache_slots = kv_cache_slots
+        self.free_slots = deque(range(len(kv_cache_slots)))
+        self.waiting: deque[_ScheduledSequence] = deque()
+        self.running: List[_ScheduledSequence] = []
+
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, name="higgs-audio-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def max_num_seqs(self) -> int:
+        return len(self.kv_cache_slots)
+
+    def submit(
+        self,
+        inputs: Dict[str, Any],
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        seed: Optional[int] = None,
+        streamer: Optional[BaseStreamer] = None,
+        stopping_criteria: Optional[List[StoppingCriteria]] = None,
+        prefix_snapshot: Optional[PrefixKVSnapshot] = None,
+        capture_prefix: Optional[PrefixKVSnapshot] = None,
+    ) -> Future:
+        """Queue a request prepared by `HiggsAudioServeEngine._prepare_inputs`.
+
+        Args:
+            stopping_criteria (`List[StoppingCriteria]`, *optional*):
+                Stopping criteria checked in addition to the ones built from the arguments, e.g., to cancel the
+                request.
+            prefix_snapshot (`PrefixKVSnapshot`, *optional*):
+                The KV cache of a prompt prefix that is not part of `inputs`. It is restored into the KV cache of the
+                sequence when the sequence is admitted.
+            capture_prefix (`PrefixKVSnapshot`, *optional*):
+                An empty snapshot filled with the KV cache of its prefix once the sequence finishes, before the KV
+                cache is handed to another sequence.
+
+        Returns:
+            A future resolved with a `HiggsAudioSchedulerOutput` once the sequence finishes.
+        """
+        generation_config = self._build_generation_config(
+            max_new_tokens=max_new_tokens,
+            prompt_length=inputs["input_ids"].shape[-1],
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            ras_win_len=ras_win_len,
+            ras_win_max_num_repeat=ras_win_max_num_repeat,
+            seed=seed,
+        )
+        sequence = _ScheduledSequence(
+            inputs=inputs,
+            generation_config=generation_config,
+            logits_processor=self._build_logits_processor(generation_config),
+            stopping_criteria=self._build_stopping_criteria(generation_config, stop_strings, stopping_criteria),
+            streamer=streamer,
+            future=Future(),
+            prefix_snapshot=prefix_snapshot,
+            capture_prefix=capture_prefix,
+        )
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("The scheduler has been shut down.")
+            self.waiting.append(sequence)
+            self._cond.notify()
+        return sequence.future
+
+    def shutdown(self):
+        """Stop the scheduler loop and fail the requests that did not finish."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _build_generation_config(
+        self,
+        max_new_tokens: int,
+        prompt_length: int,
+        temperature: float,
+        top_k: Optional[int],
+        top_p: float,
+        ras_win_len: Optional[int],
+        ras_win_max_num_repeat: int,
+        seed: Optional[int],
+    ) -> GenerationConfig:
+        generation_config = deepcopy(self.model.generation_config)
+        generation_config.update(
+            do_sample=temperature != 0.0,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            use_cache=True,
+            max_new_tokens=max_new_tokens,
+            max_length=prompt_length + max_new_tokens,
+            output_attentions=False,
+            output_hidden_states=False,
+        )
+        pad_token_id = generation_config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.model.config.pad_token_id
+        generation_config._pad_token_tensor = torch.tensor(pad_token_id, dtype=torch.long, device=self.model.device)
+        generation_config.generation_kwargs = {
+            "audio_out_bos_token_id": self.model.audio_out_bos_token_id,
+            "audio_eos_token_id": self.model.audio_eos_token_id,
+            "ras_win_len": ras_win_len,
+            "ras_win_max_num_repeat": ras_win_max_num_repeat,
+            "tokenizer_length": len(self.tokenizer),
+        }
+        if seed is not None:
+            generation_config.generation_kwargs["seed"] = seed
+        return generation_config
+
+    def _build_logits_processor(self, generation_config: GenerationConfig) -> LogitsProcessorList:
+        # Mirrors the warpers that `GenerationMixin.generate` adds for multinomial sampling.
+        logits_processor = LogitsProcessorList()
+        if not generation_config.do_sample:
+            return logits_processor
+        if generation_config.temperature is not None and generation_config.temperature != 1.0:
+            logits_processor.append(TemperatureLogitsWarper(generation_config.temperature))
+        if generation_config.top_k is not None and generation_config.top_k != 0:
+            logits_processor.append(TopKLogitsWarper(top_k=generation_config.top_k, min_tokens_to_keep=1))
+        if generation_config.top_p is not None and generation_config.top_p < 1.0:
+            logits_processor.append(TopPLogitsWarper(top_p=generation_config.top_p, min_tokens_to_keep=1))
+        return logits_processor
+
+    def _build_stopping_criteria(
+        self,
+        generation_config: GenerationConfig,
+        stop_strings: Optional[List[str]],
+        custom_stopping_criteria: Optional[List[StoppingCriteria]] = None,
+    ) -> StoppingCriteriaList:
+        stopping_criteria = StoppingCriteriaList([MaxLengthCriteria(max_length=generation_config.max_length)])
+        if custom_stopping_criteria:
+            stopping_criteria.extend(custom_stopping_criteria)
+        if stop_strings:
+            stopping_criteria.append(StopStringCriteria(tokenizer=self.tokenizer, stop_strings=stop_strings))
+        if generation_config.eos_token_id is not None:
+            stopping_criteria.append(EosTokenCriteria(eos_token_id=generation_config.eos_token_id))
+        return stopping_criteria
+
+    def _admit(self):
+        """Move waiting requests into the free KV cache slots. Must be called with `self._cond` held."""
+        while self.waiting and self.free_slots:
+            sequence = self.waiting.popleft()
+            if not sequence.future.set_running_or_notify_cancel():
+                continue
+            inputs = dict(sequence.inputs, use_cache=True)
+            input_ids = inputs.pop("input_ids")
+            slot = self.free_slots.popleft()
+            kv_caches = self.kv_cache_slots[slot]
+            try:
+                sequence.state = self.model._init_decode_state(input_ids, sequence.generation_config, inputs)
+                for kv_cache in kv_caches.values():
+                    kv_cache.reset()
+                if sequence.prefix_snapshot is not None:
+                    # Restore into the bucket that the first decoding step will select
+                    kv_cache, _ = self.model._prepare_kv_cache(sequence.state.cur_len, None, kv_caches)
+                    sequence.prefix_snapshot.copy_to(kv_cache)
+            except Exception as e:
+                logger.exception(f"Failed to initialize the generation: {e}")
+                self.free_slots.appendleft(slot)
+                sequence.future.set_exception(e)
+                continue
+            sequence.slot = slot
+            if sequence.streamer is not None:
+                # Same as `GenerationMixin.generate`, the streamer receives the prompt first
+                sequence.streamer.put(input_ids.cpu())
+            self.running.append(sequence)
+
+    def _retire(self, sequence: _ScheduledSequence, exception: Optional[BaseException] = None):
+        kv_caches = self.kv_cache_slots[sequence.slot]
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+        if exception is not None:
+            sequence.future.set_exception(exception)
+        else:
+            if sequence.capture_prefix is not None:
+                sequence.capture_prefix.copy_from(kv_caches[sequence.state.past_key_values_bucket])
+            sequence.future.set_result(
+                HiggsAudioSchedulerOutput(
+                    sequences=sequence.state.input_ids,
+                    audio_sequences=sequence.state.audio_sequences,
+                )
+            )
+        for kv_cache in kv_caches.values():
+            if isinstance(kv_cache, PagedKVCache):
+                # Hand the pages back to the pool shared with the other slots
+                kv_cache.reset()
+        with self._cond:
+            self.running.remove(sequence)
+            self.free_slots.append(sequence.slot)
+
+    def _paged_kv_cache(self, sequence: _ScheduledSequence) -> Optional[PagedKVCache]:
+        """The KV cache of the sequence if its slot holds a single `PagedKVCache`, as needed by the batched steps."""
+        kv_caches = self.kv_cache_slots[sequence.slot]
+        if len(kv_caches) != 1:
+            return None
+        kv_cache = next(iter(kv_caches.values()))
+        return kv_cache if isinstance(kv_cache, PagedKVCache) else None
+
+    def _step(self, sequence: _ScheduledSequence):
+        self.model._decode_step(
+            sequence.state,
+            logits_processor=sequence.logits_processor,
+            stopping_criteria=sequence.stopping_criteria,
+            generation_config=sequence.generation_config,
+            streamer=sequence.streamer,
+            past_key_values_buckets=self.kv_cache_slots[sequence.slot],
+        )
+
+    def _step_batch(self, sequences: List[_ScheduledSequence]) -> List[_ScheduledSequence]:
+        """Run one batched decoding step of the sequences that have room for it, and return them."""
+        # Take the pages of the new positions first, a sequence that does not get them waits for the next step
+        batch, exception = [], None
+        for sequence in sequences:
+            try:
+                self._paged_kv_cache(sequence).reserve(sequence.state.audio_discrete_codes_mask_buffer.length + 1)
+            except RuntimeError as e:
+                exception = e
+                continue
+            batch.append(sequence)
+        if not batch:
+            # None of the sequences can grow, so none of them will finish and give its pages back
+            raise exception
+        self.model._decode_step_batch(
+            [sequence.state for sequence in batch],
+            logits_processors=[sequence.logits_processor for sequence in batch],
+            stopping_criteria=[sequence.stopping_criteria for sequence in batch],
+            generation_configs=[sequence.generation_config for sequence in batch],
+            streamers=[sequence.streamer for sequence in batch],
+            kv_caches=[self._paged_kv_cache(sequence) for sequence in batch],
+        )
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self.waiting and not self.running:
+                    self._cond.wait()
+                if self._shutdown:
+                    break
+                self._admit()
+                running = list(self.running)
+
+            with torch.inference_mode():
+                batch = []
+                for sequence in running:
+                    if not sequence.state.init_model_input and self._paged_kv_cache(sequence) is not None:
+                        batch.append(sequence)
+                        continue
+                    # The prefill, and the decoding steps of the static KV caches, run one sequence at a time
+                    try:
+                        self._step(sequence)
+                    except Exception as e:
+                        logger.exception(f"Generation failed: {e}")
+                        self._retire(sequence, exception=e)
+                        continue
+                    if sequence.state.this_peer_finished:
+                        self._retire(sequence)
+
+                if batch:
+                    try:
+                        stepped = self._step_batch(batch)
+                    except Exception as e:
+                        logger.exception(f"Generation failed: {e}")
+                        for sequence in batch:
+                            self._retire(sequence, exception=e)
+                        continue
+                    for sequence in stepped:
+                        if sequence.state.this_peer_finished:
+                            self._retire(sequence)
+
+        for sequence in list(self.running):
+            self._retire(sequence, exception=RuntimeError("The scheduler has been shut down."))
+        while self.waiting:
+            self.waiting.popleft().future.cancel()
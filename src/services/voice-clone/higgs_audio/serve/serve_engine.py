@@ -1,30 +1,44 @@
 import asyncio
 import base64
+import hashlib
+import queue
 import torch
 import numpy as np
+from concurrent.futures import Executor, ThreadPoolExecutor
 from io import BytesIO
-from dataclasses import dataclass, field
-from typing import List, Optional, Union
+from dataclasses import dataclass, field, replace
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
 from copy import deepcopy
 from transformers import AutoTokenizer, AutoProcessor
-from transformers.cache_utils import StaticCache
 from transformers.generation.streamers import BaseStreamer
-from transformers.generation.stopping_criteria import StoppingCriteria
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
 from dataclasses import asdict
 from loguru import logger
 import threading
 import librosa
 
 
+from ..data_types import AudioContent, TextContent
 from ..dataset.chatml_dataset import (
     ChatMLSample,
     ChatMLDatasetSample,
     prepare_chatml_sample,
 )
 from ..model import HiggsAudioModel
-from ..model.utils import revert_delay_pattern
+from ..model.paged_kv_cache import PagedKVCache, PagedKVCachePool
+from ..model.static_kv_cache import LazyResetStaticCache
+from ..model.utils import revert_delay_pattern_segments
 from ..data_collator.higgs_audio_collator import HiggsAudioSampleCollator
+from ..audio_processing.audio_code_file import AudioCodeFile
 from ..audio_processing.higgs_audio_tokenizer import load_higgs_audio_tokenizer
+from .audio_stream import HiggsAudioStreamDecoder
+from .audio_token_cache import AudioTokenCache
+from .prefix_cache import PrefixCache, PrefixKVSnapshot
+from .prefix_snapshot_store import PrefixSnapshotStore, model_checksum
+from .scheduler import HiggsAudioScheduler
+from .utils import contains_chinese, split_paragraph
+from .voice_library import Voice, VoiceLibrary
 
 
 def normalize_chinese_punctuation(text):
@@ -76,10 +90,10 @@ class HiggsAudioStreamerDelta:
     finish_reason: Optional[str] = None
 
 
-class AsyncHiggsAudioStreamer(BaseStreamer):
+class HiggsAudioStreamer(BaseStreamer):
     """
-    Async streamer that handles both text and audio token generation from Higgs-Audio model.
-    Stores chunks in a queue to be consumed by downstream applications.
+    Streamer that handles both text and audio token generation from Higgs-Audio model.
+    Stores chunks in a thread-safe queue, to be consumed by iterating over the streamer from another thread.
 
     Parameters:
         tokenizer (`AutoTokenizer`):
@@ -90,30 +104,6 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
             The timeout for the queue. If `None`, the queue will block indefinitely.
         decode_kwargs (`dict`, *optional*):
             Additional keyword arguments to pass to the tokenizer's `decode` method.
-
-    Examples:
-        ```python
-        >>> from transformers import AutoTokenizer
-        >>> from threading import Thread
-        >>> import asyncio
-
-        >>> tokenizer = AutoTokenizer.from_pretrained("path/to/higgs/tokenizer")
-        >>> model = HiggsAudioModel.from_pretrained("path/to/higgs/model")
-        >>> inputs = tokenizer(["Generate some text and audio:"], return_tensors="pt")
-
-        >>> async def main():
-        ...     streamer = AsyncHiggsAudioStreamer(tokenizer)
-        ...     generation_kwargs = dict(inputs, streamer=streamer, max_new_tokens=20)
-        ...     thread = Thread(target=model.generate, kwargs=generation_kwargs)
-        ...     thread.start()
-        ...
-        ...     async for delta in streamer:
-        ...         if delta.text is not None:
-        ...             print("Text:", delta.text)
-        ...         if delta.audio_tokens is not None:
-        ...             print("Audio tokens shape:", delta.audio_tokens.shape)
-        >>> asyncio.run(main())
-        ```
     """
 
     def __init__(
@@ -131,13 +121,9 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
         self.audio_num_codebooks = audio_num_codebooks
 
         # Queue to store generated chunks
-        self.queue = asyncio.Queue()
+        self.queue = queue.Queue()
         self.stop_signal = None
 
-        # Get running event loop
-        self.loop = asyncio.get_running_loop()
-        self.has_asyncio_timeout = hasattr(asyncio, "timeout")
-
         # State tracking
         self.next_tokens_are_prompt = True
 
@@ -151,7 +137,7 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
             # This is likely audio tokens (shape: [audio_num_codebooks])
             assert value.shape[0] == self.audio_num_codebooks, "Number of codebooks mismatch"
             delta = HiggsAudioStreamerDelta(audio_tokens=value)
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+            self._put_delta(delta)
             return
 
         # Skip prompt tokens if configured
@@ -165,12 +151,92 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
 
         text = self.tokenizer.decode(value, **self.decode_kwargs)
         delta = HiggsAudioStreamerDelta(text=text, text_tokens=value)
-        self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+        self._put_delta(delta)
 
     def end(self):
         """Flushes any remaining text tokens and signals the end of generation."""
         self.next_tokens_are_prompt = True
-        self.loop.call_soon_threadsafe(self.queue.put_nowait, self.stop_signal)
+        self._put_delta(self.stop_signal)
+
+    def _put_delta(self, delta: Optional[HiggsAudioStreamerDelta]):
+        self.queue.put(delta)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            value = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError()
+        if value == self.stop_signal:
+            raise StopIteration()
+        return value
+
+
+class AsyncHiggsAudioStreamer(HiggsAudioStreamer):
+    """
+    Async streamer that handles both text and audio token generation from Higgs-Audio model.
+    Stores chunks in a queue to be consumed by downstream applications.
+
+    Parameters:
+        tokenizer (`AutoTokenizer`):
+            The tokenizer used to decode text tokens.
+        skip_prompt (`bool`, *optional*, defaults to `False`):
+            Whether to skip the prompt tokens in generation.
+        timeout (`float`, *optional*):
+            The timeout for the queue. If `None`, the queue will block indefinitely.
+        decode_kwargs (`dict`, *optional*):
+            Additional keyword arguments to pass to the tokenizer's `decode` method.
+
+    Examples:
+        ```python
+        >>> from transformers import AutoTokenizer
+        >>> from threading import Thread
+        >>> import asyncio
+
+        >>> tokenizer = AutoTokenizer.from_pretrained("path/to/higgs/tokenizer")
+        >>> model = HiggsAudioModel.from_pretrained("path/to/higgs/model")
+        >>> inputs = tokenizer(["Generate some text and audio:"], return_tensors="pt")
+
+        >>> async def main():
+        ...     streamer = AsyncHiggsAudioStreamer(tokenizer)
+        ...     generation_kwargs = dict(inputs, streamer=streamer, max_new_tokens=20)
+        ...     thread = Thread(target=model.generate, kwargs=generation_kwargs)
+        ...     thread.start()
+        ...
+        ...     async for delta in streamer:
+        ...         if delta.text is not None:
+        ...             print("Text:", delta.text)
+        ...         if delta.audio_tokens is not None:
+        ...             print("Audio tokens shape:", delta.audio_tokens.shape)
+        >>> asyncio.run(main())
+        ```
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        skip_prompt: bool = False,
+        timeout: Optional[float] = None,
+        audio_num_codebooks: int = 1,
+        **decode_kwargs,
+    ):
+        super().__init__(
+            tokenizer,
+            skip_prompt=skip_prompt,
+            timeout=timeout,
+            audio_num_codebooks=audio_num_codebooks,
+            **decode_kwargs,
+        )
+        self.queue = asyncio.Queue()
+
+        # Get running event loop
+        self.loop = asyncio.get_running_loop()
+        self.has_asyncio_timeout = hasattr(asyncio, "timeout")
+
+    def _put_delta(self, delta: Optional[HiggsAudioStreamerDelta]):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
 
     def __aiter__(self):
         return self
@@ -228,6 +294,14 @@ class HiggsAudioServeEngine:
         device: str = "cuda",
         torch_dtype: Union[torch.dtype, str] = "auto",
         kv_cache_lengths: List[int] = [1024, 4096, 8192],  # Multiple KV cache sizes
+        max_num_seqs: int = 1,
+        audio_token_cache_bytes: int = 64 * 1024 * 1024,
+        prefix_cache_bytes: int = 512 * 1024 * 1024,
+        kv_cache_pool_bytes: Optional[int] = None,
+        kv_cache_page_size: int = 128,
+        audio_tokenizer_decode_only: bool = False,
+        voice_library_path: Optional[str] = None,
+        prefix_snapshot_dir: Optional[str] = None,
     ):
         """
         Initialize the HiggsAudioServeEngine, a serving wrapper for the HiggsAudioModel.
@@ -246,6 +320,37 @@ class HiggsAudioServeEngine:
                 The lengths of the KV caches to use for the model. Used for cuda graph capture when device is cuda.
             torch_dtype (Union[torch.dtype, str]):
                 The dtype to use for the model.
+            max_num_seqs (int):
+                The maximum number of requests decoded concurrently. When larger than 1, requests are served by a
+                `HiggsAudioScheduler` that runs the decoding steps of the running requests as one batched forward
+                pass. The batched steps read the sequences from a paged KV cache, which is created with a budget of
+                `max(kv_cache_lengths)` tokens per sequence when `kv_cache_pool_bytes` is not set.
+            audio_token_cache_bytes (int):
+                The size budget, in bytes, of the cache of reference audio codes. Repeated reference audios skip
+                the audio tokenizer encoder. Set to 0 to disable the cache.
+            prefix_cache_bytes (int):
+                The size budget, in bytes, of the KV cache snapshots of shared prompt prefixes (all the messages but
+                the last one, e.g., the system prompt and the reference voice). The snapshots live on the model
+                device. Set to 0 to disable the cache.
+            kv_cache_pool_bytes (int):
+                The size budget, in bytes, of a paged KV cache shared by all the sequences. When set, every sequence
+                grows page by page in a `PagedKVCache` instead of being promoted through the `kv_cache_lengths`
+                buckets, and no CUDA graph is captured. Defaults to the buckets for a single sequence, and to
+                `PagedKVCachePool.bytes_per_token(...) * max(kv_cache_lengths) * max_num_seqs`, as many tokens as the
+                largest buckets of all the concurrent sequences, when `max_num_seqs` is larger than 1.
+            kv_cache_page_size (int):
+                The number of tokens per page of the paged KV cache.
+            audio_tokenizer_decode_only (bool):
+                Only load the decoder of the audio tokenizer, without its semantic teacher and encoders, for
+                deployments whose reference voices are already tokenized. Encoding a reference audio then raises.
+            voice_library_path (str):
+                The directory of a `VoiceLibrary`. The audio contents with a `voice_id` take their codes from it, see
+                `VoiceLibrary.reference_messages`.
+            prefix_snapshot_dir (str):
+                The directory of a `PrefixSnapshotStore`, a second tier of the prefix cache on disk. The snapshots
+                of the shared prefixes are saved to it, and the prefixes missing from the prefix cache are loaded
+                from it, so a new worker does not prefill again the prefixes of the voices served before. Requires
+                the prefix cache.
         """
         self.device = device
         self.model_name_or_path = model_name_or_path
@@ -261,7 +366,37 @@ class HiggsAudioServeEngine:
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
 
         logger.info(f"Initializing Higgs Audio Tokenizer")
-        self.audio_tokenizer = load_higgs_audio_tokenizer(audio_tokenizer_name_or_path, device=device)
+        self.audio_tokenizer = load_higgs_audio_tokenizer(
+            audio_tokenizer_name_or_path, device=device, decode_only=audio_tokenizer_decode_only
+        ).prepare_for_inference()
+        # Identifies the codes produced by the audio tokenizer in the cache keys
+        self.audio_tokenizer_id = (
+            f"{audio_tokenizer_name_or_path}:{self.audio_tokenizer.sampling_rate}:{self.audio_tokenizer.num_codebooks}"
+        )
+        self.audio_token_cache = AudioTokenCache(audio_token_cache_bytes) if audio_token_cache_bytes > 0 else None
+        if voice_library_path is not None:
+            self.voice_library = VoiceLibrary(
+                voice_library_path,
+                identity={
+                    "audio_tokenizer_id": self.audio_tokenizer_id,
+                    "text_tokenizer_id": f"{tokenizer_name_or_path}:{len(self.tokenizer)}",
+                    "audio_stream_bos_id": self.model.config.audio_stream_bos_id,
+                    "audio_stream_eos_id": self.model.config.audio_stream_eos_id,
+                },
+            )
+            logger.info(f"Loaded {len(self.voice_library)} voices from {voice_library_path}")
+        else:
+            self.voice_library = None
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        if prefix_snapshot_dir is not None:
+            if self.prefix_cache is None:
+                raise ValueError("`prefix_snapshot_dir` requires the prefix cache, set `prefix_cache_bytes`.")
+            self.prefix_snapshot_store = PrefixSnapshotStore(prefix_snapshot_dir, model_checksum(self.model))
+            logger.info(
+                f"Using the prefix snapshots of {self.prefix_snapshot_store.model_id} in {prefix_snapshot_dir}"
+            )
+        else:
+            self.prefix_snapshot_store = None
 
         self.audio_num_codebooks = self.model.config.audio_num_codebooks
         self.audio_codebook_size = self.model.config.audio_codebook_size
@@ -276,17 +411,24 @@ class HiggsAudioServeEngine:
         cache_config.num_hidden_layers = self.model.config.text_config.num_hidden_layers
         if self.model.config.audio_dual_ffn_layers:
             cache_config.num_hidden_layers += len(self.model.config.audio_dual_ffn_layers)
-        # A list of KV caches for different lengths
-        self.kv_caches = {
-            length: StaticCache(
-                config=cache_config,
-                max_batch_size=1,
-                max_cache_len=length,
+        if kv_cache_pool_bytes is None and max_num_seqs > 1:
+            # The batched decoding steps of the scheduler need the sequences to share a paged KV cache
+            kv_cache_pool_bytes = (
+                PagedKVCachePool.bytes_per_token(cache_config, self.model.dtype) * max(kv_cache_lengths) * max_num_seqs
+            )
+        if kv_cache_pool_bytes is not None:
+            self.kv_cache_pool = PagedKVCachePool(
+                cache_config,
+                kv_cache_pool_bytes,
+                page_size=kv_cache_page_size,
                 device=self.model.device,
                 dtype=self.model.dtype,
             )
-            for length in sorted(kv_cache_lengths)
-        }
+            logger.info(f"Using a paged KV cache of {self.kv_cache_pool.max_num_tokens} tokens")
+        else:
+            self.kv_cache_pool = None
+        # A list of KV caches for different lengths
+        self.kv_caches = self._create_kv_caches(cache_config, kv_cache_lengths)
 
         if self.model.config.encode_whisper_embed:
             logger.info(f"Loading whisper processor")
@@ -305,7 +447,6 @@ class HiggsAudioServeEngine:
             audio_in_token_id=self.model.config.audio_in_token_idx,
             audio_out_token_id=self.model.config.audio_out_token_idx,
             audio_stream_bos_id=self.model.config.audio_stream_bos_id,
-            audio_stream_eos_id=self.model.config.audio_stream_eos_id,
             pad_token_id=self.model.config.pad_token_id,
             return_audio_in_tokens=False,
             use_delay_pattern=self.model.config.use_delay_pattern,
@@ -317,10 +458,36 @@ class HiggsAudioServeEngine:
         self.generate_lock = threading.Lock()
 
         # Capture CUDA graphs for each KV cache length
-        if device == "cuda":
+        if device == "cuda" and self.kv_cache_pool is None:
             logger.info(f"Capturing CUDA graphs for each KV cache length")
             self.model.capture_model(self.kv_caches.values())
 
+        # Batch the decoding of concurrent requests. The first slot reuses the KV cache of the engine, and every slot
+        # holds a `PagedKVCache` of the pool created above.
+        if max_num_seqs > 1:
+            logger.info(f"Starting the scheduler with {max_num_seqs} concurrent sequences")
+            kv_cache_slots = [self.kv_caches] + [
+                self._create_kv_caches(cache_config, kv_cache_lengths) for _ in range(max_num_seqs - 1)
+            ]
+            self.scheduler = HiggsAudioScheduler(self.model, self.tokenizer, kv_cache_slots)
+        else:
+            self.scheduler = None
+
+    def _create_kv_caches(self, cache_config, kv_cache_lengths: List[int]):
+        if self.kv_cache_pool is not None:
+            # A single bucket that grows up to the size of the pool
+            return {self.kv_cache_pool.max_num_tokens: PagedKVCache(self.kv_cache_pool)}
+        return {
+            length: LazyResetStaticCache(
+                config=cache_config,
+                max_batch_size=1,
+                max_cache_len=length,
+                device=self.model.device,
+                dtype=self.model.dtype,
+            )
+            for length in sorted(kv_cache_lengths)
+        }
+
     def _prepare_inputs(self, chat_ml_sample: ChatMLSample, force_audio_gen: bool = False):
         input_tokens, _, audio_contents, _ = prepare_chatml_sample(
             chat_ml_sample,
@@ -335,20 +502,18 @@ class HiggsAudioServeEngine:
 
         # Configure the audio inputs
         audio_ids_l = []
+        audio_ids_delayed_l = []
         for audio_content in audio_contents:
-            if audio_content.audio_url not in ["placeholder", ""]:
-                raw_audio, _ = librosa.load(audio_content.audio_url, sr=self.audio_tokenizer.sampling_rate)
-            elif audio_content.raw_audio is not None:
-                raw_audio, _ = librosa.load(
-                    BytesIO(base64.b64decode(audio_content.raw_audio)),
-                    sr=self.audio_tokenizer.sampling_rate,
-                )
-            else:
-                raw_audio = None
-
-            if raw_audio is not None:
-                audio_ids = self.audio_tokenizer.encode(raw_audio, self.audio_tokenizer.sampling_rate)
-                audio_ids_l.append(audio_ids.squeeze(0).cpu())
+            if audio_content.voice_id is not None:
+                # The voices of the library come with their delayed codes
+                voice = self._get_voice(audio_content.voice_id)
+                audio_ids_l.append(voice.audio_ids)
+                audio_ids_delayed_l.append(voice.audio_ids_delayed if self.model.config.use_delay_pattern else None)
+                continue
+            audio_ids = self._encode_audio_content(audio_content)
+            if audio_ids is not None:
+                audio_ids_l.append(audio_ids)
+                audio_ids_delayed_l.append(None)
 
         if len(audio_ids_l) > 0:
             audio_ids_start = torch.tensor(
@@ -370,6 +535,7 @@ class HiggsAudioServeEngine:
             audio_waveforms_start=None,
             audio_sample_rate=None,
             audio_speaker_indices=None,
+            audio_ids_delayed=audio_ids_delayed_l if any(ids is not None for ids in audio_ids_delayed_l) else None,
         )
         data = self.collator([sample])
         inputs = asdict(data)
@@ -379,9 +545,174 @@ class HiggsAudioServeEngine:
 
         return inputs
 
-    def _prepare_kv_caches(self):
+    def _get_voice(self, voice_id: str) -> Voice:
+        voice = self.voice_library.get(voice_id) if self.voice_library is not None else None
+        if voice is None:
+            raise ValueError(f"Voice {voice_id} is not in the voice library.")
+        return voice
+
+    def _encode_audio_content(self, audio_content: AudioContent) -> Optional[torch.Tensor]:
+        """Encode the audio of an AudioContent into codes of shape (num_codebooks, seq_len).
+
+        The codes are looked up in the audio token cache first, keyed by the raw audio bytes.
+        """
+        if audio_content.audio_url not in ["placeholder", ""]:
+            with open(audio_content.audio_url, "rb") as f:
+                audio_bytes = f.read()
+            audio_source = audio_content.audio_url
+        elif audio_content.raw_audio is not None:
+            audio_bytes = base64.b64decode(audio_content.raw_audio)
+            audio_source = BytesIO(audio_bytes)
+        else:
+            return None
+
+        if self.audio_token_cache is not None:
+            cache_key = AudioTokenCache.make_key(audio_bytes, self.audio_tokenizer_id)
+            audio_ids = self.audio_token_cache.get(cache_key)
+            if audio_ids is not None:
+                return audio_ids
+
+        raw_audio, _ = librosa.load(audio_source, sr=self.audio_tokenizer.sampling_rate)
+        audio_ids = self.audio_tokenizer.encode(raw_audio, self.audio_tokenizer.sampling_rate).squeeze(0).cpu()
+
+        if self.audio_token_cache is not None:
+            self.audio_token_cache.put(cache_key, audio_ids)
+        return audio_ids
+
+    def _count_shared_prefix_ids(self, chat_ml_sample: ChatMLSample, prompt_token_ids: torch.LongTensor) -> int:
+        """Count the prompt ids of all the messages but the last one, which are shared between requests."""
+        if not isinstance(chat_ml_sample, ChatMLSample) or len(chat_ml_sample.messages) < 2:
+            return 0
+        prefix_tokens, _, _, _ = prepare_chatml_sample(
+            replace(chat_ml_sample, messages=chat_ml_sample.messages[:-1]),
+            self.tokenizer,
+        )
+        if prefix_tokens is None or prompt_token_ids[: len(prefix_tokens)].tolist() != prefix_tokens:
+            return 0
+        return len(prefix_tokens)
+
+    def _prefix_cache_key(self, inputs: Dict[str, Any]) -> List[Hashable]:
+        """Key of the prompt in the prefix cache.
+
+        The key holds the prompt ids, with every `<|AUDIO_OUT|>` replaced by a hash of its audio codes. It stops
+        before the first `<|AUDIO|>`, since the audio-in features are not part of the key.
+        """
+        audio_out_ids = inputs["audio_out_ids"]
+        if audio_out_ids is not None and audio_out_ids.shape[-1] > 0:
+            audio_out_ids = audio_out_ids.cpu().numpy()
+            audio_out_ends = inputs["audio_out_ids_start"].tolist()[1:] + [audio_out_ids.shape[1]]
+            audio_out_starts = inputs["audio_out_ids_start"].tolist()
+        key = []
+        audio_idx = 0
+        for token_id in inputs["input_ids"][0].tolist():
+            if token_id == self.model.config.audio_in_token_idx:
+                break
+            if token_id == self.model.config.audio_out_token_idx:
+                codes = audio_out_ids[:, audio_out_starts[audio_idx] : audio_out_ends[audio_idx]]
+                key.append(hashlib.blake2b(codes.tobytes(), digest_size=16).hexdigest())
+                audio_idx += 1
+            else:
+                key.append(token_id)
+        return key
+
+    def _has_audio_placeholders(self, input_ids: torch.LongTensor) -> bool:
+        return bool(
+            (
+                (input_ids == self.model.config.audio_in_token_idx)
+                | (input_ids == self.model.config.audio_out_token_idx)
+            )
+            .any()
+            .item()
+        )
+
+    def _merged_audio_mask(self, inputs: Dict[str, Any], num_input_ids: int) -> torch.BoolTensor:
+        """Mask of the audio positions of the first `num_input_ids` prompt ids, once merged with the audio codes."""
+        input_ids = inputs["input_ids"][0, :num_input_ids]
+        is_audio_out = input_ids == self.model.config.audio_out_token_idx
+        num_tokens = torch.ones_like(input_ids)
+        num_audio_out = int(is_audio_out.sum().item())
+        if num_audio_out > 0:
+            audio_out_ids_start = inputs["audio_out_ids_start"]
+            audio_out_lengths = torch.diff(
+                audio_out_ids_start,
+                append=audio_out_ids_start.new_tensor([inputs["audio_out_ids"].shape[1]]),
+            )
+            num_tokens[is_audio_out] = audio_out_lengths[:num_audio_out]
+        return torch.repeat_interleave(is_audio_out, num_tokens).unsqueeze(0)
+
+    def _apply_prefix_cache(
+        self, chat_ml_sample: ChatMLSample, inputs: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Optional[PrefixKVSnapshot], Optional[Tuple[List[Hashable], PrefixKVSnapshot]]]:
+        """Look up the longest cached prefix of the prompt and strip it from the inputs.
+
+        Returns:
+            The inputs to prefill, the snapshot to restore into the KV cache before the generation (if any), and the
+            key and empty snapshot of the shared prefix of this prompt if it should be captured after the generation.
+        """
+        if self.prefix_cache is None:
+            return inputs, None, None
+
+        input_ids = inputs["input_ids"]
+        key = self._prefix_cache_key(inputs)
+        # Only the prompt ids after the snapshot are prefilled, which requires them to be free of audio
+        snapshot = self.prefix_cache.match(key)
+        if snapshot is not None and self._has_audio_placeholders(input_ids[:, snapshot.num_input_ids :]):
+            snapshot = None
+
+        capture = None
+        num_shared_ids = self._count_shared_prefix_ids(chat_ml_sample, input_ids[0])
+        if (
+            0 < num_shared_ids <= len(key)
+            and (snapshot is None or snapshot.num_input_ids < num_shared_ids)
+            and not self._has_audio_placeholders(input_ids[:, num_shared_ids:])
+        ):
+            stored_snapshot = None
+            if self.prefix_snapshot_store is not None:
+                stored_snapshot = self.prefix_snapshot_store.load(key[:num_shared_ids], device=self.model.device)
+            if stored_snapshot is not None:
+                self.prefix_cache.insert(key[:num_shared_ids], stored_snapshot)
+                snapshot = stored_snapshot
+            else:
+                capture = (
+                    key[:num_shared_ids],
+                    PrefixKVSnapshot(
+                        num_input_ids=num_shared_ids,
+                        audio_discrete_codes_mask=self._merged_audio_mask(inputs, num_shared_ids),
+                    ),
+                )
+
+        if snapshot is None:
+            return inputs, None, capture
+
+        num_cached_ids = snapshot.num_input_ids
+        inputs = dict(inputs)
+        inputs["input_ids"] = input_ids[:, num_cached_ids:]
+        inputs["attention_mask"] = inputs["attention_mask"][:, num_cached_ids:]
+        if inputs["label_ids"] is not None:
+            inputs["label_ids"] = inputs["label_ids"][:, num_cached_ids:]
+        # All the audio-out segments belong to the cached prefix
+        if inputs["audio_out_ids"] is not None:
+            inputs["audio_out_ids"] = inputs["audio_out_ids"][:, :0]
+            inputs["audio_out_ids_start"] = inputs["audio_out_ids_start"][:0]
+            if inputs["audio_out_ids_start_group_loc"] is not None:
+                inputs["audio_out_ids_start_group_loc"] = inputs["audio_out_ids_start_group_loc"][:0]
+        inputs["cache_audio_discrete_codes_mask"] = snapshot.audio_discrete_codes_mask
+        return inputs, snapshot, capture
+
+    def _insert_prefix_snapshot(self, key: List[Hashable], snapshot: PrefixKVSnapshot):
+        self.prefix_cache.insert(key, snapshot)
+        if self.prefix_snapshot_store is not None:
+            self.prefix_snapshot_store.save(key, snapshot)
+
+    def _prepare_kv_caches(self, prefix_snapshot: Optional[PrefixKVSnapshot] = None, num_input_ids: int = 0):
         for kv_cache in self.kv_caches.values():
             kv_cache.reset()
+        if prefix_snapshot is not None:
+            # Restore into the bucket that the first decoding step will select
+            kv_cache, _ = self.model._prepare_kv_cache(
+                prefix_snapshot.num_tokens + num_input_ids, None, self.kv_caches
+            )
+            prefix_snapshot.copy_to(kv_cache)
 
     def generate(
         self,
@@ -407,60 +738,470 @@ class HiggsAudioServeEngine:
                 audio: The generated audio.
                 sampling_rate: The sampling rate of the generated audio.
         """
-        # Default stop strings
-        if stop_strings is None:
-            stop_strings = ["<|end_of_text|>", "<|eot_id|>"]
+        prompt_token_ids, sequences, audio_sequences, cached_tokens = self._generate_tokens(
+            chat_ml_sample,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_strings=stop_strings,
+            force_audio_gen=force_audio_gen,
+            ras_win_len=ras_win_len,
+            ras_win_max_num_repeat=ras_win_max_num_repeat,
+        )
+        return self._build_response(prompt_token_ids, sequences, audio_sequences, cached_tokens=cached_tokens)
+
+    def generate_stream(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        chunk_size: int = 16,
+    ) -> Iterator[np.ndarray]:
+        """
+        Generate audio from a chatml sample, and yield the audio while it is being generated.
+
+        The generation runs on a background thread. Its audio tokens are decoded by blocks of `chunk_size` new
+        tokens, by a streaming decoder that carries its state between blocks, so the chunks add up to the audio of
+        `generate` (see `HiggsAudioStreamDecoder`). Closing the iterator stops the generation.
+
+        Args:
+            chat_ml_sample: A chatml sample.
+            max_new_tokens: The maximum number of new tokens to generate.
+            temperature: The temperature to use for the generation.
+            top_p: The top p to use for the generation.
+            chunk_size: The number of audio tokens decoded at once.
+        Yields:
+            Chunks of PCM samples at `self.audio_tokenizer.sampling_rate`.
+        """
+        streamer = HiggsAudioStreamer(self.tokenizer, skip_prompt=True, audio_num_codebooks=self.audio_num_codebooks)
+        stop_signal = threading.Event()
+        errors = []
 
-        with torch.no_grad(), self.generate_lock:
-            inputs = self._prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
-            prompt_token_ids = inputs["input_ids"][0].cpu().numpy()
+        def _generate():
+            try:
+                self._generate_tokens_to_streamer(
+                    chat_ml_sample,
+                    streamer=streamer,
+                    stop_signal=stop_signal,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    stop_strings=stop_strings,
+                    force_audio_gen=force_audio_gen,
+                    ras_win_len=ras_win_len,
+                    ras_win_max_num_repeat=ras_win_max_num_repeat,
+                )
+            except Exception as e:
+                errors.append(e)
 
-            self._prepare_kv_caches()
+        thread = threading.Thread(target=_generate, daemon=True)
+        thread.start()
+        decoder = self._create_stream_decoder(chunk_size)
+        try:
+            for delta in streamer:
+                if delta.audio_tokens is not None:
+                    yield from decoder.push(delta.audio_tokens)
+            yield from decoder.flush()
+        finally:
+            stop_signal.set()
+            thread.join()
+        if errors:
+            raise errors[0]
 
-            outputs = self.model.generate(
-                **inputs,
+    async def generate_stream_async(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        chunk_size: int = 16,
+        executor: Optional[Executor] = None,
+        on_generation_submitted: Optional[Callable[[asyncio.Future], Any]] = None,
+    ) -> AsyncIterator[np.ndarray]:
+        """
+        Async version of `generate_stream`. The generation and the audio decoding run on executor threads, so the
+        event loop is never blocked.
+
+        Args:
+            executor: The executor that runs the generation. Defaults to the default executor of the event loop.
+            on_generation_submitted: Called with the future of the generation once it is submitted to the executor.
+                Closing the iterator only asks the generation to stop at its next decoding step, so the future is
+                the way to know when the executor thread is done with it.
+        """
+        streamer = AsyncHiggsAudioStreamer(
+            self.tokenizer, skip_prompt=True, audio_num_codebooks=self.audio_num_codebooks
+        )
+        stop_signal = threading.Event()
+        generation = asyncio.get_running_loop().run_in_executor(
+            executor,
+            partial(
+                self._generate_tokens_to_streamer,
+                chat_ml_sample,
+                streamer=streamer,
+                stop_signal=stop_signal,
                 max_new_tokens=max_new_tokens,
-                use_cache=True,
-                stop_strings=stop_strings,
-                tokenizer=self.tokenizer,
-                do_sample=False if temperature == 0.0 else True,
                 temperature=temperature,
                 top_k=top_k,
                 top_p=top_p,
-                past_key_values_buckets=self.kv_caches,
+                stop_strings=stop_strings,
+                force_audio_gen=force_audio_gen,
                 ras_win_len=ras_win_len,
                 ras_win_max_num_repeat=ras_win_max_num_repeat,
-            )
+            ),
+        )
+        if on_generation_submitted is not None:
+            on_generation_submitted(generation)
+        decoder = self._create_stream_decoder(chunk_size)
+        try:
+            async for delta in streamer:
+                if delta.audio_tokens is not None:
+                    for chunk in await asyncio.to_thread(decoder.push, delta.audio_tokens):
+                        yield chunk
+            for chunk in await asyncio.to_thread(decoder.flush):
+                yield chunk
+        finally:
+            stop_signal.set()
+        await generation
 
-            if len(outputs[1]) > 0:
-                wv_list = []
-                for output_audio in outputs[1]:
-                    vq_code = revert_delay_pattern(output_audio).clip(0, self.audio_codebook_size - 1)[:, 1:-1]
-                    wv_numpy = self.audio_tokenizer.decode(vq_code.unsqueeze(0))[0, 0]
-                    wv_list.append(wv_numpy)
-                wv_numpy = np.concatenate(wv_list)
-            else:
-                wv_numpy = None
-
-            # We only support one request at a time now
-            generated_text_tokens = outputs[0][0].cpu().numpy()[len(prompt_token_ids) :]
-            generated_text = self.tokenizer.decode(generated_text_tokens)
-            generated_audio_tokens = outputs[1][0].cpu().numpy()
-            return HiggsAudioResponse(
-                audio=wv_numpy,
-                generated_audio_tokens=generated_audio_tokens,
-                sampling_rate=self.audio_tokenizer.sampling_rate,
-                generated_text=generated_text,
-                generated_text_tokens=generated_text_tokens,
-                usage={
-                    "prompt_tokens": prompt_token_ids.shape[0],
-                    "completion_tokens": generated_text_tokens.shape[0] + generated_audio_tokens.shape[1],
-                    "total_tokens": (
-                        prompt_token_ids.shape[0] + generated_text_tokens.shape[0] + generated_audio_tokens.shape[1]
-                    ),
-                    "cached_tokens": 0,
-                },
-            )
+    def generate_long_form(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = True,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        lang: Optional[str] = None,
+        token_max_n: int = 80,
+        token_min_n: int = 60,
+        merge_len: int = 20,
+        crossfade_len: Optional[int] = None,
+    ) -> HiggsAudioResponse:
+        """
+        Generate audio for a long text, one group of sentences at a time.
+
+        The text of the last message is split with `split_paragraph`, and every group of sentences is generated with
+        the same preceding messages (e.g., the system prompt and the reference voice), which are restored from the
+        prefix cache after the first group. The audio of a group is decoded and crossfaded with the previous one on a
+        worker thread, while the next group is generated.
+
+        Args:
+            chat_ml_sample: A chatml sample whose last message holds the text to synthesize.
+            max_new_tokens: The maximum number of new tokens to generate for every group of sentences.
+            temperature: The temperature to use for the generation.
+            top_p: The top p to use for the generation.
+            lang: The language passed to `split_paragraph`. Detected from the text if not set.
+            token_max_n: The maximum length of a group of sentences, see `split_paragraph`.
+            token_min_n: The minimum length of a group of sentences, see `split_paragraph`.
+            merge_len: The length under which the last group is merged into the previous one.
+            crossfade_len: The number of samples crossfaded between consecutive groups. Defaults to half of the
+                Hamming window used for streaming.
+        Returns:
+            A `HiggsAudioResponse` with the concatenated audio, tokens and usage of all the groups.
+        Raises:
+            ValueError: If the last message is not a text message, or its text is empty or only whitespace.
+        """
+        *context_messages, last_message = chat_ml_sample.messages
+        content = last_message.content
+        if isinstance(content, TextContent):
+            content = content.text
+        if not isinstance(content, str):
+            raise ValueError("The last message of a long-form sample must be a text message.")
+        # `split_paragraph` fails on an empty text, and keeps a whitespace-only one as a group of its own
+        content = content.strip()
+        if len(content) == 0:
+            raise ValueError("The last message of a long-form sample has no text to synthesize.")
+        if lang is None:
+            lang = "zh" if contains_chinese(content) else "en"
+        if crossfade_len is None:
+            crossfade_len = self.hamming_window_len // 2
+
+        texts = split_paragraph(
+            content,
+            tokenize=partial(self.tokenizer.encode, add_special_tokens=False),
+            lang=lang,
+            token_max_n=token_max_n,
+            token_min_n=token_min_n,
+            merge_len=merge_len,
+        )
+        if len(texts) == 0:
+            raise ValueError("The last message of a long-form sample has no sentence to synthesize.")
+        logger.info(f"Generating {len(texts)} groups of sentences")
+
+        wv_list = []
+
+        def _decode_and_crossfade(audio_sequences: List[torch.LongTensor]):
+            wv_numpy = self._decode_audio_sequences(audio_sequences)
+            if wv_numpy is None:
+                return
+            overlap = min(crossfade_len, wv_list[-1].shape[-1], wv_numpy.shape[-1]) if len(wv_list) > 0 else 0
+            # No blending when either chunk is empty, e.g., a short group consumed by the previous blend
+            if overlap > 0:
+                window = np.hamming(2 * overlap)
+                fade_in, fade_out = window[:overlap], window[overlap:]
+                blended = (wv_list[-1][-overlap:] * fade_out + wv_numpy[:overlap] * fade_in) / (fade_in + fade_out)
+                wv_list[-1] = wv_list[-1][:-overlap]
+                wv_list.append(blended.astype(wv_numpy.dtype))
+                wv_numpy = wv_numpy[overlap:]
+            wv_list.append(wv_numpy)
+
+        text_tokens_list, audio_tokens_list = [], []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+        # A single worker keeps the groups in order
+        with ThreadPoolExecutor(max_workers=1) as decode_executor:
+            decode_futures = []
+            for text in texts:
+                sample = replace(chat_ml_sample, messages=context_messages + [replace(last_message, content=text)])
+                prompt_token_ids, sequences, audio_sequences, cached_tokens = self._generate_tokens(
+                    sample,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    stop_strings=stop_strings,
+                    force_audio_gen=force_audio_gen,
+                    ras_win_len=ras_win_len,
+                    ras_win_max_num_repeat=ras_win_max_num_repeat,
+                )
+                decode_futures.append(decode_executor.submit(_decode_and_crossfade, audio_sequences))
+
+                generated_text_tokens = sequences[0].cpu().numpy()[len(prompt_token_ids) - cached_tokens :]
+                generated_audio_tokens = [audio_sequence.cpu().numpy() for audio_sequence in audio_sequences]
+                text_tokens_list.append(generated_text_tokens)
+                audio_tokens_list.extend(generated_audio_tokens)
+                completion_tokens = generated_text_tokens.shape[0] + sum(a.shape[1] for a in generated_audio_tokens)
+                usage["prompt_tokens"] += prompt_token_ids.shape[0]
+                usage["completion_tokens"] += completion_tokens
+                usage["total_tokens"] += prompt_token_ids.shape[0] + completion_tokens
+                usage["cached_tokens"] += cached_tokens
+            for decode_future in decode_futures:
+                decode_future.result()
+
+        generated_text_tokens = (
+            np.concatenate(text_tokens_list) if len(text_tokens_list) > 0 else np.zeros(0, dtype=np.int64)
+        )
+        return HiggsAudioResponse(
+            audio=np.concatenate(wv_list) if len(wv_list) > 0 else None,
+            generated_audio_tokens=np.concatenate(audio_tokens_list, axis=1) if len(audio_tokens_list) > 0 else None,
+            sampling_rate=self.audio_tokenizer.sampling_rate,
+            generated_text=self.tokenizer.decode(generated_text_tokens),
+            generated_text_tokens=generated_text_tokens,
+            usage=usage,
+        )
+
+    def _create_stream_decoder(self, chunk_size: int) -> HiggsAudioStreamDecoder:
+        return HiggsAudioStreamDecoder(
+            self.audio_tokenizer,
+            audio_num_codebooks=self.audio_num_codebooks,
+            audio_codebook_size=self.audio_codebook_size,
+            audio_stream_bos_id=self.model.config.audio_stream_bos_id,
+            samples_per_token=self.samples_per_token,
+            hamming_window_len=self.hamming_window_len,
+            chunk_size=chunk_size,
+            use_delay_pattern=self.model.config.use_delay_pattern,
+        )
+
+    def _generate_tokens_to_streamer(self, chat_ml_sample: ChatMLSample, streamer: HiggsAudioStreamer, **kwargs):
+        """Run `_generate_tokens` with a streamer, and end the streamer if the generation fails before it ends."""
+        try:
+            return self._generate_tokens(chat_ml_sample, streamer=streamer, **kwargs)
+        except Exception:
+            streamer.end()
+            raise
+
+    def _generate_tokens(
+        self,
+        chat_ml_sample: ChatMLSample,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = None,
+        ras_win_max_num_repeat: int = 2,
+        streamer: Optional[BaseStreamer] = None,
+        stop_signal: Optional[threading.Event] = None,
+    ) -> Tuple[np.ndarray, torch.LongTensor, List[torch.LongTensor], int]:
+        """Generate the text and audio tokens of a chatml sample.
+
+        Returns:
+            The prompt ids, the generated sequences, the generated audio sequences and the number of prompt ids that
+            were restored from the prefix cache instead of being part of the sequences.
+        """
+        # Default stop strings
+        if stop_strings is None:
+            stop_strings = ["<|end_of_text|>", "<|eot_id|>"]
+        stopping_criteria = [AsyncStoppingCriteria(stop_signal)] if stop_signal is not None else []
+
+        if self.scheduler is not None:
+            with torch.no_grad():
+                inputs = self._prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
+                prompt_token_ids = inputs["input_ids"][0].cpu().numpy()
+                inputs, prefix_snapshot, prefix_capture = self._apply_prefix_cache(chat_ml_sample, inputs)
+                future = self.scheduler.submit(
+                    inputs,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    stop_strings=stop_strings,
+                    ras_win_len=ras_win_len,
+                    ras_win_max_num_repeat=ras_win_max_num_repeat,
+                    streamer=streamer,
+                    stopping_criteria=stopping_criteria,
+                    prefix_snapshot=prefix_snapshot,
+                    capture_prefix=prefix_capture[1] if prefix_capture is not None else None,
+                )
+                scheduler_output = future.result()
+                if prefix_capture is not None:
+                    self._insert_prefix_snapshot(*prefix_capture)
+                sequences, audio_sequences = scheduler_output.sequences, scheduler_output.audio_sequences
+        else:
+            with torch.no_grad(), self.generate_lock:
+                inputs = self._prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
+                prompt_token_ids = inputs["input_ids"][0].cpu().numpy()
+                inputs, prefix_snapshot, prefix_capture = self._apply_prefix_cache(chat_ml_sample, inputs)
+
+                self._prepare_kv_caches(prefix_snapshot, inputs["input_ids"].shape[1])
+
+                sequences, audio_sequences = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                    stop_strings=stop_strings,
+                    tokenizer=self.tokenizer,
+                    do_sample=False if temperature == 0.0 else True,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    past_key_values_buckets=self.kv_caches,
+                    ras_win_len=ras_win_len,
+                    ras_win_max_num_repeat=ras_win_max_num_repeat,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList(stopping_criteria),
+                )
+                if prefix_capture is not None:
+                    key, snapshot = prefix_capture
+                    snapshot.copy_from(self.kv_caches[self.model.current_past_key_values_bucket])
+                    self._insert_prefix_snapshot(key, snapshot)
+
+        cached_tokens = prefix_snapshot.num_input_ids if prefix_snapshot is not None else 0
+        return prompt_token_ids, sequences, audio_sequences, cached_tokens
+
+    def _decode_audio_sequences(self, audio_sequences: List[torch.LongTensor]) -> Optional[np.ndarray]:
+        if len(audio_sequences) == 0:
+            return None
+        wv_list = []
+        # Revert the delay pattern of all the segments at once
+        for vq_code in revert_delay_pattern_segments(audio_sequences):
+            vq_code = vq_code.clip(0, self.audio_codebook_size - 1)[:, 1:-1]
+            wv_numpy = self.audio_tokenizer.decode(vq_code.unsqueeze(0))[0, 0]
+            wv_list.append(wv_numpy)
+        return np.concatenate(wv_list)
+
+    def _build_response(
+        self,
+        prompt_token_ids: np.ndarray,
+        sequences: torch.LongTensor,
+        audio_sequences: List[torch.LongTensor],
+        cached_tokens: int = 0,
+    ) -> HiggsAudioResponse:
+        """Decode the generated audio codes and assemble the response.
+
+        `sequences` does not contain the first `cached_tokens` prompt ids, which were restored from the prefix cache.
+        """
+        wv_numpy = self._decode_audio_sequences(audio_sequences)
+
+        # We only support one request at a time now
+        generated_text_tokens = sequences[0].cpu().numpy()[len(prompt_token_ids) - cached_tokens :]
+        generated_text = self.tokenizer.decode(generated_text_tokens)
+        generated_audio_tokens = audio_sequences[0].cpu().numpy()
+        return HiggsAudioResponse(
+            audio=wv_numpy,
+            generated_audio_tokens=generated_audio_tokens,
+            sampling_rate=self.audio_tokenizer.sampling_rate,
+            generated_text=generated_text,
+            generated_text_tokens=generated_text_tokens,
+            usage={
+                "prompt_tokens": prompt_token_ids.shape[0],
+                "completion_tokens": generated_text_tokens.shape[0] + generated_audio_tokens.shape[1],
+                "total_tokens": (
+                    prompt_token_ids.shape[0] + generated_text_tokens.shape[0] + generated_audio_tokens.shape[1]
+                ),
+                "cached_tokens": cached_tokens,
+            },
+        )
+
+    def save_audio_codes(self, path: str, generated_audio_tokens: np.ndarray) -> AudioCodeFile:
+        """Archive the `generated_audio_tokens` of a `HiggsAudioResponse` as an `AudioCodeFile`.
+
+        The tokens are split into audio segments at their audio stream bos frames. The delay pattern of every segment
+        is reverted and its bos and eos frames are dropped, as in `_decode_audio_sequences`, so the file holds the
+        codes the audio tokenizer decodes, in 10-bit lanes, and a time offset maps to a frame. The metadata records
+        the audio tokenizer and the number of frames of every segment.
+
+        Returns:
+            The written file, opened for reading.
+        """
+        tokens = torch.from_numpy(np.asarray(generated_audio_tokens))
+        starts = (tokens == self.model.config.audio_stream_bos_id).all(dim=0).nonzero().flatten().tolist()
+        segments = tokens.tensor_split([start for start in starts if start > 0], dim=1)
+        codes = [
+            vq_code.clip(0, self.audio_codebook_size - 1)[:, 1:-1]
+            for vq_code in revert_delay_pattern_segments(list(segments))
+        ]
+        return AudioCodeFile.write(
+            path,
+            torch.cat(codes, dim=1).numpy(),
+            sample_rate=self.audio_tokenizer.sampling_rate,
+            tps=self.audio_tokenizer_tps,
+            metadata={
+                "audio_tokenizer_id": self.audio_tokenizer_id,
+                "segment_lengths": [vq_code.shape[1] for vq_code in codes],
+            },
+        )
+
+    def decode_audio_codes(self, path: str, start: float = 0.0, end: Optional[float] = None) -> np.ndarray:
+        """Re-render the audio between the time offsets `start` and `end` (in seconds) of a file written by
+        `save_audio_codes`. Only the frames of that range are read, and every audio segment is decoded on its own.
+        """
+        with AudioCodeFile(path) as code_file:
+            if code_file.delay_pattern:
+                raise ValueError(f"{path} holds codes with the delay pattern, which cannot be decoded directly.")
+            audio_tokenizer_id = code_file.metadata.get("audio_tokenizer_id", self.audio_tokenizer_id)
+            if audio_tokenizer_id != self.audio_tokenizer_id:
+                raise ValueError(f"{path} holds codes of {audio_tokenizer_id}, not of {self.audio_tokenizer_id}.")
+            start_frame = code_file.frame_at(start)
+            end_frame = code_file.frame_at(end) if end is not None else code_file.num_frames
+            codes = torch.from_numpy(code_file.read(start_frame, end_frame))
+            segment_lengths = code_file.metadata.get("segment_lengths", [code_file.num_frames])
+
+        # The segment boundaries, relative to the start of the range
+        boundaries = np.cumsum(segment_lengths)[:-1] - start_frame
+        boundaries = [int(b) for b in boundaries if 0 < b < codes.shape[1]]
+        wv_list = []
+        for vq_code in codes.tensor_split(boundaries, dim=1):
+            if vq_code.shape[1] > 0:
+                vq_code = vq_code.to(self.audio_tokenizer.device).unsqueeze(0)
+                wv_list.append(self.audio_tokenizer.decode(vq_code)[0, 0])
+        return np.concatenate(wv_list) if len(wv_list) > 0 else np.zeros(0, dtype=np.float32)
 
     def text_normalize(self, text: str) -> str:
         """
@@ -110,12 +110,6 @@ def split_paragraph(
         else:
             return len(tokenize(_text))
 
-    def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
-
     if lang == "zh":
         pounc = ["。", "？", "！", "；", "：", "、", ".", "?", "!", ";"]
     else:
@@ -142,15 +136,22 @@ def split_paragraph(
             else:
                 st = i + 1
 
+    # The length of the current group is the sum of the lengths of its sentences, so every sentence is only
+    # measured once
     final_utts = []
-    cur_utt = ""
+    cur_utts = []
+    cur_len = 0
     for utt in utts:
-        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
-            final_utts.append(cur_utt)
-            cur_utt = ""
-        cur_utt = cur_utt + utt
-    if len(cur_utt) > 0:
-        if should_merge(cur_utt) and len(final_utts) != 0:
+        utt_len = calc_utt_length(utt)
+        if cur_len + utt_len > token_max_n and cur_len > token_min_n:
+            final_utts.append("".join(cur_utts))
+            cur_utts = []
+            cur_len = 0
+        cur_utts.append(utt)
+        cur_len += utt_len
+    if len(cur_utts) > 0:
+        cur_utt = "".join(cur_utts)
+        if cur_len < merge_len and len(final_utts) != 0:
             final_utts[-1] = final_utts[-1] + cur_utt
         else:
             final_utts.append(cur_utt)
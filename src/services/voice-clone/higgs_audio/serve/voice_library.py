@@ -0,0 +1,286 @@
+"""
+Persistent library of reference voices, with everything the prompt needs precomputed.
+
+Build a library from a directory of voice presets, the `voice_examples` layout of `app.py` (a `config.json` mapping
+every voice name to its `transcript`, and one `<name>.wav` per voice):
+
+Usage (from src/services/voice-clone):
+    python -m higgs_audio.serve.voice_library --voices-dir voice_examples --output voice_library
+
+The codes of the voices can also come from the audio code store written by `higgs_audio.serve.ingest_voices`, with
+`--audio-code-store`, in which case the audio tokenizer is not needed. Then pass the library to the engine with
+`HiggsAudioServeEngine(..., voice_library_path="voice_library")`.
+"""
+
+import argparse
+import json
+import librosa
+import os
+import threading
+import torch
+from dataclasses import dataclass
+from loguru import logger
+from transformers import AutoTokenizer
+from typing import Any, Dict, Iterator, List, Optional
+
+from ..audio_processing.higgs_audio_tokenizer import load_higgs_audio_tokenizer
+from ..data_types import AudioContent, Message, TextContent
+from ..model import HiggsAudioConfig
+from ..model.utils import build_delay_pattern_segments
+from .audio_code_store import AudioCodeStore
+
+
+@dataclass
+class Voice:
+    """A voice of a `VoiceLibrary`.
+
+    Args:
+        voice_id (`str`):
+            The id of the voice.
+        transcript (`str`):
+            The transcript of the reference audio.
+        transcript_ids (`List[int]`):
+            The transcript, tokenized by the text tokenizer of the library.
+        audio_ids (`torch.LongTensor` of shape `(num_codebooks, num_frames)`):
+            The codes of the reference audio.
+        audio_ids_delayed (`torch.LongTensor` of shape `(num_codebooks, num_frames + num_codebooks + 1)`):
+            The codes surrounded by the audio stream bos and eos tokens, with the delay pattern applied, as the
+            collator feeds them to the model.
+        metadata (`dict`):
+            The metadata stored with the voice, e.g., its model name and emotion.
+    """
+
+    voice_id: str
+    transcript: str
+    transcript_ids: List[int]
+    audio_ids: torch.LongTensor
+    audio_ids_delayed: torch.LongTensor
+    metadata: Dict[str, Any]
+
+
+class VoiceLibrary:
+    """On-disk library of voices, keyed by voice id, e.g., `make_voice_id(model_name, emotion)`.
+
+    Stores, for every voice, the codes of its reference audio, its tokenized transcript and the delayed codes that
+    the model is fed, so using a voice neither reads nor encodes audio, nor applies the delay pattern. The library
+    is a directory with:
+        - `library.json`: the identity of what the entries depend on, i.e., the audio tokenizer, the text tokenizer
+          and the audio stream bos and eos tokens. Reopening the library with another identity raises.
+        - `codes/`: an `AudioCodeStore` of the codes, whose index also holds the transcripts.
+        - `delayed/`: an `AudioCodeStore` of the delayed codes.
+    The codes are memory-mapped, so all the worker processes serving the same library share their pages.
+
+    Args:
+        path (`str`):
+            The directory of the library. It is created when opening for writing.
+        identity (`dict`, *optional*):
+            The `audio_tokenizer_id`, `text_tokenizer_id`, `audio_stream_bos_id` and `audio_stream_eos_id` the
+            entries depend on. Required to create a library. The ones given are checked against the ones of an
+            existing library.
+        writable (`bool`, *optional*, defaults to `False`):
+            Whether to open the library for writing. Only one process should write to a library at a time.
+    """
+
+    METADATA_FILE = "library.json"
+    IDENTITY_KEYS = ("audio_tokenizer_id", "text_tokenizer_id", "audio_stream_bos_id", "audio_stream_eos_id")
+
+    def __init__(self, path: str, identity: Optional[Dict[str, Any]] = None, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        identity = identity or {}
+
+        metadata_path = os.path.join(path, self.METADATA_FILE)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                self.identity = json.load(f)
+            for key, value in identity.items():
+                if value != self.identity.get(key):
+                    raise ValueError(
+                        f"The voice library at {path} was built with {key}={self.identity.get(key)}, not {value}."
+                    )
+        elif writable:
+            missing_keys = [key for key in self.IDENTITY_KEYS if key not in identity]
+            if missing_keys:
+                raise ValueError(f"{missing_keys} are required to create a voice library.")
+            os.makedirs(path, exist_ok=True)
+            self.identity = {key: identity[key] for key in self.IDENTITY_KEYS}
+            with open(metadata_path, "w") as f:
+                json.dump(self.identity, f)
+        else:
+            raise FileNotFoundError(f"No voice library at {path}.")
+
+        audio_tokenizer_id = self.identity["audio_tokenizer_id"]
+        self.codes = AudioCodeStore(os.path.join(path, "codes"), audio_tokenizer_id, writable=writable)
+        self.delayed = AudioCodeStore(os.path.join(path, "delayed"), audio_tokenizer_id, writable=writable)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_voice_id(model_name: str, emotion: Optional[str] = None) -> str:
+        """The id of the voice of a model name, e.g., a voice preset, and an emotion."""
+        return model_name if emotion is None else f"{model_name}/{emotion}"
+
+    def __contains__(self, voice_id: str) -> bool:
+        # A voice is complete once its delayed codes are written
+        return voice_id in self.delayed
+
+    def __len__(self) -> int:
+        return len(self.delayed)
+
+    def voice_ids(self) -> Iterator[str]:
+        return self.delayed.keys()
+
+    def get(self, voice_id: str) -> Optional[Voice]:
+        """The voice of an id, or None if it is not in the library."""
+        if voice_id not in self:
+            return None
+        metadata = dict(self.codes.metadata_of(voice_id))
+        return Voice(
+            voice_id=voice_id,
+            transcript=metadata.pop("transcript"),
+            transcript_ids=metadata.pop("transcript_ids"),
+            audio_ids=self.codes.get(voice_id),
+            audio_ids_delayed=self.delayed.get(voice_id),
+            metadata=metadata,
+        )
+
+    def put(
+        self,
+        voice_id: str,
+        audio_ids: torch.LongTensor,
+        transcript: str,
+        transcript_ids: List[int],
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """Add a voice, or replace it.
+
+        Args:
+            voice_id (`str`):
+                The id of the voice.
+            audio_ids (`torch.LongTensor` of shape `(num_codebooks, num_frames)`):
+                The codes of the reference audio, as produced by the audio tokenizer of the library.
+            transcript (`str`):
+                The transcript of the reference audio.
+            transcript_ids (`List[int]`):
+                The transcript, tokenized by the text tokenizer of the library.
+            metadata (`dict`, *optional*):
+                JSON-serializable metadata stored with the voice.
+        """
+        audio_ids = audio_ids.long().cpu()
+        bos_id, eos_id = self.identity["audio_stream_bos_id"], self.identity["audio_stream_eos_id"]
+        # The same segment as the one the collator builds from the codes
+        audio_ids_delayed = build_delay_pattern_segments(
+            [
+                torch.cat(
+                    [
+                        audio_ids.new_full((audio_ids.shape[0], 1), bos_id),
+                        audio_ids,
+                        audio_ids.new_full((audio_ids.shape[0], 1), eos_id),
+                    ],
+                    dim=1,
+                )
+            ],
+            bos_token_id=bos_id,
+            pad_token_id=eos_id,
+        )
+        with self._lock:
+            self.codes.put(
+                voice_id,
+                audio_ids,
+                metadata={**(metadata or {}), "transcript": transcript, "transcript_ids": list(transcript_ids)},
+            )
+            self.delayed.put(voice_id, audio_ids_delayed)
+
+    def reference_messages(self, voice_id: str) -> List[Message]:
+        """The messages that give a voice as reference to the model: the transcript, then the audio, whose codes
+        and tokens are taken from the library.
+
+        Raises:
+            KeyError: If the voice is not in the library.
+        """
+        voice = self.get(voice_id)
+        if voice is None:
+            raise KeyError(f"Voice {voice_id} is not in the voice library at {self.path}.")
+        return [
+            Message(role="user", content=TextContent(text=voice.transcript, token_ids=voice.transcript_ids)),
+            Message(role="assistant", content=AudioContent(audio_url="", voice_id=voice_id)),
+        ]
+
+    def close(self):
+        self.codes.close()
+        self.delayed.close()
+
+    def __enter__(self) -> "VoiceLibrary":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a voice library from voice presets")
+    parser.add_argument("--voices-dir", type=str, required=True, help="Directory with config.json and the wavs.")
+    parser.add_argument("--output", type=str, required=True, help="The directory of the voice library.")
+    parser.add_argument("--model", type=str, default="bosonai/higgs-audio-v2-generation-3B-base")
+    parser.add_argument("--tokenizer", type=str, default=None, help="The text tokenizer. Defaults to the model.")
+    parser.add_argument("--audio-tokenizer", type=str, default="bosonai/higgs-audio-v2-tokenizer")
+    parser.add_argument(
+        "--audio-code-store",
+        type=str,
+        default=None,
+        help="An audio code store written by ingest_voices, whose codes are used instead of encoding the wavs.",
+    )
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    config = HiggsAudioConfig.from_pretrained(args.model)
+    tokenizer_name_or_path = args.tokenizer or args.model
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+    with open(os.path.join(args.voices_dir, "config.json")) as f:
+        voices = json.load(f)
+
+    audio_tokenizer = None
+    audio_code_store = None
+    if args.audio_code_store is not None:
+        audio_code_store = AudioCodeStore(args.audio_code_store)
+        audio_tokenizer_id = audio_code_store.audio_tokenizer_id
+    else:
+        audio_tokenizer = load_higgs_audio_tokenizer(
+            args.audio_tokenizer, device=args.device, encode_only=True
+        ).prepare_for_inference()
+        audio_tokenizer_id = f"{args.audio_tokenizer}:{audio_tokenizer.sampling_rate}:{audio_tokenizer.num_codebooks}"
+
+    identity = {
+        "audio_tokenizer_id": audio_tokenizer_id,
+        "text_tokenizer_id": f"{tokenizer_name_or_path}:{len(tokenizer)}",
+        "audio_stream_bos_id": config.audio_stream_bos_id,
+        "audio_stream_eos_id": config.audio_stream_eos_id,
+    }
+    with VoiceLibrary(args.output, identity=identity, writable=True) as library:
+        for name, voice in voices.items():
+            model_name, emotion = voice.get("model_name", name), voice.get("emotion", None)
+            voice_id = VoiceLibrary.make_voice_id(model_name, emotion)
+            if audio_code_store is not None:
+                audio_ids = audio_code_store.get(name)
+                if audio_ids is None:
+                    logger.warning(f"Skipping {voice_id}: {name} is not in {args.audio_code_store}")
+                    continue
+            else:
+                raw_audio, _ = librosa.load(
+                    os.path.join(args.voices_dir, f"{name}.wav"), sr=audio_tokenizer.sampling_rate
+                )
+                with torch.no_grad():
+                    audio_ids = audio_tokenizer.encode(raw_audio, audio_tokenizer.sampling_rate).squeeze(0).cpu()
+            transcript = voice["transcript"]
+            library.put(
+                voice_id,
+                audio_ids[: config.audio_num_codebooks],
+                transcript=transcript,
+                transcript_ids=tokenizer.encode(transcript, add_special_tokens=False),
+                metadata={"name": name, "model_name": model_name, "emotion": emotion},
+            )
+            logger.info(f"Added {voice_id}, {audio_ids.shape[1]} frames")
+        logger.info(f"{len(library)} voices in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Parity of `HiggsAudioTokenizer.prepare_for_inference` with the weight-normalized convolutions."""
+
+import numpy as np
+import pytest
+import torch
+
+from higgs_audio.audio_processing.descriptaudiocodec.dac.model import dac as dac2
+from higgs_audio.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer
+
+
+ATOL = 1e-5
+RATIOS = [4, 2]
+BINS = 64
+
+
+def _tokenizer(backend=None, prepare=False):
+    """A small decode-only tokenizer with random weights, the same at every call, and an acoustic encoder.
+
+    The full tokenizer downloads its semantic teacher to encode, so the acoustic encoder is built on its own, the same
+    way the tokenizer builds it, and attached to the tokenizer so that `prepare_for_inference` folds it too.
+    """
+    torch.manual_seed(0)
+    tokenizer = HiggsAudioTokenizer(D=16, ratios=RATIOS, bins=BINS, n_q=4, decode_only=True, device="cpu")
+    tokenizer.encoder = dac2.Encoder(64, RATIOS, 16)
+    tokenizer.eval()
+    return tokenizer.prepare_for_inference(backend) if prepare else tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return _tokenizer()
+
+
+@pytest.fixture(scope="module")
+def codes(tokenizer):
+    generator = torch.Generator().manual_seed(1)
+    return torch.randint(0, BINS, (1, tokenizer.num_codebooks, 37), generator=generator)
+
+
+@pytest.mark.parametrize("backend", [None, "torchscript"])
+def test_decode_parity(tokenizer, codes, backend):
+    with torch.no_grad():
+        expected = tokenizer.decode(codes)
+        actual = _tokenizer(backend, prepare=True).decode(codes)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=ATOL)
+
+
+def test_encoder_parity(tokenizer):
+    audio = torch.randn(1, 1, 1000, generator=torch.Generator().manual_seed(2))
+    with torch.no_grad():
+        expected = tokenizer.encoder(audio)
+        actual = _tokenizer(prepare=True).encoder(audio)
+    torch.testing.assert_close(actual, expected, rtol=0, atol=ATOL)
+
+
+def test_prepare_for_inference_folds_and_freezes():
+    prepared = _tokenizer(prepare=True)
+    assert not any(hasattr(module, "weight_g") for module in prepared.modules())
+    assert not any(param.requires_grad for param in prepared.parameters())
+    assert not prepared.training
+
+
+def test_prepare_for_inference_rejects_unknown_backend(tokenizer):
+    with pytest.raises(ValueError):
+        tokenizer.prepare_for_inference("tensorrt")
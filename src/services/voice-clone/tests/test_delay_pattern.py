@@ -0,0 +1,94 @@
+"""Equivalence of the gather-based delay pattern helpers with `build_delay_pattern_mask` and the per-codebook loop."""
+
+import pytest
+import torch
+
+from higgs_audio.model.utils import (
+    build_delay_pattern_mask,
+    build_delay_pattern_segments,
+    revert_delay_pattern,
+    revert_delay_pattern_segments,
+)
+
+
+BOS_TOKEN_ID = 1024
+PAD_TOKEN_ID = 1025
+
+
+def _reference_revert_delay_pattern(data):
+    """The per-codebook loop that `revert_delay_pattern` replaced."""
+    assert len(data.shape) == 2
+    out_l = []
+    num_codebooks = data.shape[0]
+    for i in range(num_codebooks):
+        out_l.append(data[i : (i + 1), i : (data.shape[1] - num_codebooks + 1 + i)])
+    return torch.cat(out_l, dim=0)
+
+
+def _reference_build_delay_pattern_segments(segments):
+    return torch.cat(
+        [build_delay_pattern_mask(segment[None], BOS_TOKEN_ID, PAD_TOKEN_ID)[0][0] for segment in segments], dim=1
+    )
+
+
+def _random_segments(num_codebooks, seq_lens, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randint(0, BOS_TOKEN_ID, (num_codebooks, seq_len), generator=generator) for seq_len in seq_lens]
+
+
+def _seq_lens(num_codebooks, seed):
+    """Empty segments, segments shorter than the number of codebooks, and random longer ones."""
+    generator = torch.Generator().manual_seed(seed)
+    random_lens = torch.randint(num_codebooks, 64, (6,), generator=generator).tolist()
+    return [0, 1, max(num_codebooks - 1, 0), num_codebooks, *random_lens, 0]
+
+
+@pytest.mark.parametrize("num_codebooks", [1, 4, 8])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_build_delay_pattern_segments(num_codebooks, seed):
+    segments = _random_segments(num_codebooks, _seq_lens(num_codebooks, seed), seed)
+    expected = _reference_build_delay_pattern_segments(segments)
+    actual = build_delay_pattern_segments(segments, BOS_TOKEN_ID, PAD_TOKEN_ID)
+    assert torch.equal(actual, expected)
+
+
+@pytest.mark.parametrize("num_codebooks", [1, 4, 8])
+@pytest.mark.parametrize("seq_len", [0, 1, 3, 7, 8, 37])
+def test_build_delay_pattern_single_segment(num_codebooks, seq_len):
+    segments = _random_segments(num_codebooks, [seq_len], seq_len)
+    expected = build_delay_pattern_mask(segments[0][None], BOS_TOKEN_ID, PAD_TOKEN_ID)[0][0]
+    actual = build_delay_pattern_segments(segments, BOS_TOKEN_ID, PAD_TOKEN_ID)
+    assert actual.shape == (num_codebooks, seq_len + num_codebooks - 1)
+    assert torch.equal(actual, expected)
+
+
+@pytest.mark.parametrize("num_codebooks", [1, 4, 8])
+@pytest.mark.parametrize("seq_len", [0, 1, 3, 7, 8, 37])
+def test_revert_delay_pattern(num_codebooks, seq_len):
+    segment = _random_segments(num_codebooks, [seq_len], seq_len)[0]
+    delayed = build_delay_pattern_mask(segment[None], BOS_TOKEN_ID, PAD_TOKEN_ID)[0][0]
+    actual = revert_delay_pattern(delayed)
+    assert torch.equal(actual, _reference_revert_delay_pattern(delayed))
+    assert torch.equal(actual, segment)
+
+
+@pytest.mark.parametrize("num_codebooks", [1, 4, 8])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_revert_delay_pattern_segments(num_codebooks, seed):
+    segments = _random_segments(num_codebooks, _seq_lens(num_codebooks, seed), seed)
+    delayed = [build_delay_pattern_mask(segment[None], BOS_TOKEN_ID, PAD_TOKEN_ID)[0][0] for segment in segments]
+    actual = revert_delay_pattern_segments(delayed)
+    assert len(actual) == len(segments)
+    for reverted, data, segment in zip(actual, delayed, segments):
+        assert torch.equal(reverted, _reference_revert_delay_pattern(data))
+        assert torch.equal(reverted, segment)
+
+
+@pytest.mark.parametrize("num_codebooks", [1, 4, 8])
+def test_delay_pattern_round_trip(num_codebooks):
+    seq_lens = _seq_lens(num_codebooks, 3)
+    segments = _random_segments(num_codebooks, seq_lens, 3)
+    delayed = build_delay_pattern_segments(segments, BOS_TOKEN_ID, PAD_TOKEN_ID)
+    delayed_segments = delayed.split([seq_len + num_codebooks - 1 for seq_len in seq_lens], dim=1)
+    for reverted, segment in zip(revert_delay_pattern_segments(list(delayed_segments)), segments):
+        assert torch.equal(reverted, segment)
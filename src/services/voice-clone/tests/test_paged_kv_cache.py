@@ -0,0 +1,120 @@
+"""Page tables of `PagedKVCache`: the sequences grow into any free page and their cached positions never move."""
+
+import pytest
+import torch
+from transformers import PretrainedConfig
+
+from higgs_audio.model.paged_kv_cache import PagedKVCache, PagedKVCacheBatch, PagedKVCachePool
+
+
+PAGE_SIZE = 4
+CONFIG = PretrainedConfig(num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, hidden_size=32)
+NUM_KEY_VALUE_HEADS, HEAD_DIM = 2, 8
+
+
+def _pool(num_pages):
+    max_bytes = num_pages * PAGE_SIZE * PagedKVCachePool.bytes_per_token(CONFIG, torch.float32)
+    return PagedKVCachePool(CONFIG, max_bytes, page_size=PAGE_SIZE)
+
+
+def _states(num_positions, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(1, NUM_KEY_VALUE_HEADS, num_positions, HEAD_DIM, generator=generator)
+
+
+def _append(kv_cache, key, value):
+    """Write the positions of `key` and `value` after the cached ones, like a forward pass."""
+    start = kv_cache.get_seq_length()
+    kv_cache.reserve(start + key.shape[2])
+    cache_position = torch.arange(start, start + key.shape[2])
+    for layer_idx in range(CONFIG.num_hidden_layers):
+        outputs = kv_cache.update(key, value, layer_idx, {"cache_position": cache_position})
+    return outputs
+
+
+def test_interleaved_sequences_read_back_their_positions():
+    pool = _pool(8)
+    caches = [PagedKVCache(pool), PagedKVCache(pool)]
+    keys = [_states(13, seed=0), _states(11, seed=1)]
+    values = [_states(13, seed=2), _states(11, seed=3)]
+    # One decoding step at a time, so that the sequences take every other page
+    for position in range(13):
+        for kv_cache, key, value in zip(caches, keys, values):
+            if position < key.shape[2]:
+                first_pages = list(kv_cache.pages)
+                key_cache, value_cache = _append(
+                    kv_cache, key[:, :, position : position + 1], value[:, :, position : position + 1]
+                )
+                assert kv_cache.pages[: len(first_pages)] == first_pages
+                assert key_cache.shape == (1, NUM_KEY_VALUE_HEADS, kv_cache.max_cache_len, HEAD_DIM)
+    for kv_cache, key, value in zip(caches, keys, values):
+        key_cache, value_cache = kv_cache.read(0)
+        num_positions = key.shape[2]
+        torch.testing.assert_close(key_cache[:, :, :num_positions], key, rtol=0, atol=0)
+        torch.testing.assert_close(value_cache[:, :, :num_positions], value, rtol=0, atol=0)
+        # The reserved positions that are not written yet are zero
+        assert not key_cache[:, :, num_positions:].any()
+    assert len({page for kv_cache in caches for page in kv_cache.pages}) == 7
+
+
+def test_consecutive_pages_are_read_in_place():
+    pool = _pool(4)
+    kv_cache = PagedKVCache(pool)
+    _append(kv_cache, _states(10, seed=0), _states(10, seed=1))
+    assert kv_cache.pages == [0, 1, 2]
+    key_cache, _ = kv_cache.read(1)
+    assert key_cache.data_ptr() == pool.key_cache[1].data_ptr()
+
+
+def test_fragmented_pool_serves_a_sequence_with_enough_free_pages():
+    pool = _pool(4)
+    first, second = PagedKVCache(pool), PagedKVCache(pool)
+    for _ in range(2):
+        _append(first, _states(PAGE_SIZE, seed=0), _states(PAGE_SIZE, seed=1))
+        _append(second, _states(PAGE_SIZE, seed=2), _states(PAGE_SIZE, seed=3))
+    assert first.pages == [0, 2] and second.pages == [1, 3]
+    second.reset()
+    assert pool.num_free_pages == 2
+
+    third = PagedKVCache(pool)
+    key, value = _states(2 * PAGE_SIZE, seed=4), _states(2 * PAGE_SIZE, seed=5)
+    _append(third, key, value)
+    assert third.pages == [1, 3]
+    torch.testing.assert_close(third.read(0)[0], key, rtol=0, atol=0)
+
+
+def test_exhausted_pool_raises():
+    pool = _pool(2)
+    kv_cache = PagedKVCache(pool)
+    _append(kv_cache, _states(2 * PAGE_SIZE, seed=0), _states(2 * PAGE_SIZE, seed=1))
+    with pytest.raises(RuntimeError):
+        kv_cache.reserve(2 * PAGE_SIZE + 1)
+    assert kv_cache.pages == [0, 1]
+    kv_cache.reset()
+    assert pool.num_free_pages == 2 and kv_cache.max_cache_len == 0
+
+
+def test_batch_writes_and_reads_the_positions_of_every_sequence():
+    pool = _pool(8)
+    caches = [PagedKVCache(pool), PagedKVCache(pool)]
+    _append(caches[0], _states(6, seed=0), _states(6, seed=1))
+    _append(caches[1], _states(2, seed=2), _states(2, seed=3))
+    for kv_cache in caches:
+        kv_cache.reserve(kv_cache.get_seq_length() + 1)
+    batch = PagedKVCacheBatch(caches)
+    assert batch.get_max_cache_shape() == 2 * PAGE_SIZE
+
+    key = torch.randn(2, NUM_KEY_VALUE_HEADS, 1, HEAD_DIM)
+    value = torch.randn(2, NUM_KEY_VALUE_HEADS, 1, HEAD_DIM)
+    cache_position = torch.tensor([[6], [2]])
+    key_cache, value_cache = batch.update(key, value, 1, {"cache_position": cache_position})
+    assert key_cache.shape == (2, NUM_KEY_VALUE_HEADS, 2 * PAGE_SIZE, HEAD_DIM)
+    for row, kv_cache in enumerate(caches):
+        position = int(cache_position[row])
+        expected_key, expected_value = kv_cache.read(1)
+        torch.testing.assert_close(expected_key[0, :, position], key[row, :, 0], rtol=0, atol=0)
+        torch.testing.assert_close(expected_value[0, :, position], value[row, :, 0], rtol=0, atol=0)
+        # Every row reads the positions of its own sequence
+        num_positions = kv_cache.max_cache_len
+        torch.testing.assert_close(key_cache[row, :, :num_positions], expected_key[0], rtol=0, atol=0)
+        torch.testing.assert_close(value_cache[row, :, :num_positions], expected_value[0], rtol=0, atol=0)
@@ -0,0 +1,68 @@
+"""Equivalence of `HiggsAudioStreamingDecoder` with the offline `HiggsAudioTokenizer.decode`."""
+
+import numpy as np
+import pytest
+import torch
+
+from higgs_audio.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer
+from higgs_audio.audio_processing.streaming_decoder import HiggsAudioStreamingDecoder, _StreamingLayer
+
+
+ATOL = 1e-5
+BINS = 64
+NUM_FRAMES = 37
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """A small decode-only tokenizer with random weights. The odd stride uses the output padding of the transposed
+    convolutions."""
+    torch.manual_seed(0)
+    tokenizer = HiggsAudioTokenizer(D=16, ratios=[5, 2], bins=BINS, n_q=4, decode_only=True, device="cpu")
+    return tokenizer.prepare_for_inference()
+
+
+@pytest.fixture(scope="module")
+def codes(tokenizer):
+    generator = torch.Generator().manual_seed(1)
+    return torch.randint(0, BINS, (tokenizer.num_codebooks, NUM_FRAMES), generator=generator)
+
+
+def _stream(decoder: HiggsAudioStreamingDecoder, codes: torch.LongTensor, block_size: int) -> np.ndarray:
+    chunks = [decoder.push(codes[:, i : i + block_size]) for i in range(0, codes.shape[-1], block_size)]
+    chunks.append(decoder.flush())
+    return np.concatenate(chunks)
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 8, 16, NUM_FRAMES, 64])
+def test_streaming_matches_decode(tokenizer, codes, block_size):
+    with torch.no_grad():
+        expected = tokenizer.decode(codes[None])[0, 0]
+    actual = _stream(tokenizer.streaming_decoder(), codes, block_size)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=ATOL)
+
+
+def test_streaming_decoder_is_reusable_after_flush(tokenizer, codes):
+    decoder = tokenizer.streaming_decoder()
+    first = _stream(decoder, codes, 5)
+    second = _stream(decoder, codes[:, :11], 4)
+    with torch.no_grad():
+        np.testing.assert_allclose(first, tokenizer.decode(codes[None])[0, 0], rtol=0, atol=ATOL)
+        np.testing.assert_allclose(second, tokenizer.decode(codes[None, :, :11])[0, 0], rtol=0, atol=ATOL)
+
+
+def test_flush_without_codes(tokenizer):
+    assert tokenizer.streaming_decoder().flush().shape == (0,)
+
+
+def test_streaming_decoder_rejects_scripted_decoder():
+    torch.manual_seed(0)
+    tokenizer = HiggsAudioTokenizer(D=16, ratios=[5, 2], bins=BINS, n_q=4, decode_only=True, device="cpu")
+    with pytest.raises(ValueError):
+        tokenizer.prepare_for_inference("torchscript").streaming_decoder()
+
+
+def test_streaming_layer_is_abstract():
+    with pytest.raises(TypeError):
+        _StreamingLayer()